@@ -6,6 +6,9 @@ Provides a unified parent class that all sensor drivers can inherit from
 
 from multiprocessing import Event, Value
 
+from helpers.Metrics import MetricsRegistry
+from helpers.Tracing import Tracer
+
 class DriverBase:
     """
     Driver base constructor takes in module name so we can make nice looking logs
@@ -19,6 +22,17 @@ class DriverBase:
         # The rate at which the thread this driver is running in will loop
         self.loopTime = 0.001
         self.initialized = False
+
+        # Metrics are created here before the driver's proccess is started so the main proccess can read them
+        self.metrics = MetricsRegistry(labels={"driver": modName})
+        self.measureTime = self.metrics.histogram("measure_seconds", "Time taken by each call to measure()")
+        self.loopOverruns = self.metrics.counter("loop_overruns_total", "Calls to measure() that took longer than the overrun threshold")
+
+        # A call to measure() taking longer than this or the loop time, whichever is larger, counts as an overrun
+        self.overrunThreshold = 0.1
+
+        # Replaced with the shared tracer by the DriverManager, on its own a driver records no spans
+        self.tracer = Tracer(enabled=False)
     
     """
     Should be overloaded on all sub drivers so initialize can be called on all drivers at once
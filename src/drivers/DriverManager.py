@@ -12,6 +12,8 @@ from multiprocessing import Pipe
 
 from drivers.DriverBase import DriverBase
 from drivers.ThreadedDriver import ThreadedDriver
+from helpers.Metrics import MetricsRegistry, readProcessStats, startMetricsServer
+from helpers.Tracing import Tracer
 
 class DriverManager():
 
@@ -19,22 +21,34 @@ class DriverManager():
     Create a new instance of our DriverManager to control all of the subproccess threads
 
     :param sensors: A list of as many sensors as we want to use on our current device
+    :param metricsPort: The localhost port metrics are served on in the Prometheus text format, None disables the server
     """
-    def __init__(self, *sensors: DriverBase):
+    def __init__(self, *sensors: DriverBase, metricsPort=9464):
         # Store a list of sensors, spawned sensor proccesses and a data dictionary to store our data
         self.sensors: list[DriverBase] = list(sensors)
         self.proccessList: list[ThreadedDriver] = []
         self.data = {}
         self.timeTriggers = {}
 
+        # Every driver's metrics are served from here along with the resource usage of each proccess
+        self.metrics = MetricsRegistry()
+        self.eventSetTimes = {}
+        self.metrics.addCollector(self.collectProcessStats)
+
+        # Every driver records the spans of each scan against the trace the main proccess starts
+        self.tracer = Tracer()
+        self.metrics.include(self.tracer.metrics)
+
         logging.info("Waiting for proccesses to initialize...")
     
+        # Format every sensor's shared data before any proccess is started so the AsyncPublisher's copy of the dictionary has the drivers started after it
+        for sensor in self.sensors:
+            self._formatNewSensor(sensor)
+            self.metrics.include(sensor.metrics)
+            sensor.tracer = self.tracer
+
         # Loop over all sensors we are using and "threadify" them
         for sensor in self.sensors:       
-
-            # Format a new sensor objecti in the dectionary
-            self._formatNewSensor(sensor)
-            
             # Spawn the sensor into a proccess passing the data object along to be manipulated, if our procces is the async publisher we want to pass the whole data object to it
             if sensor.moduleName == "AsyncPublisher":
                 sensor.data = self.data
@@ -73,9 +87,13 @@ class DriverManager():
         self.data["DriverManager"] = {}
         self.data["DriverManager"]["data"] = {}
         self.data["DriverManager"]["data"]["userTrigger"] = False
+        self.data["DriverManager"]["data"]["traceId"] = ""
         self.data["DriverManager"]["events"] = {}
 
         self.createJSONFormattedDict()
+
+        if metricsPort is not None:
+            startMetricsServer(self.metrics, port=metricsPort)
        
 
     """
@@ -102,6 +120,8 @@ class DriverManager():
         try:
             splitName = event.split(".")
             self.data[splitName[0]]["events"][splitName[1]][0].set()
+            # Setting it again restarts the clock, it is only counted once someone sees it set and waits for it to clear
+            self.eventSetTimes[event] = [time(), False]
         except KeyError:
             logging.error(f"Specified event/sensor doesn't exist: {event}")
 
@@ -113,7 +133,18 @@ class DriverManager():
     def getEvent(self, event):
         try:
             splitName = event.split(".")
-            return self.data[splitName[0]]["events"][splitName[1]][0].is_set()
+            isSet = self.data[splitName[0]]["events"][splitName[1]][0].is_set()
+
+            # The first time we see an event we set has been cleared by its driver we know how long it took to handle, events nobody
+            # polls while they are set (like LEDDriver.CAMERA) would only report how long ago they were set so they are left out
+            if event in self.eventSetTimes:
+                if isSet:
+                    self.eventSetTimes[event][1] = True
+                else:
+                    setTime, waited = self.eventSetTimes.pop(event)
+                    if waited:
+                        self.metrics.histogram("event_latency_seconds", "Time from an event being set to its driver clearing it", event=event).observe(time() - setTime)
+            return isSet
         except KeyError:
             logging.error(f"Specified event/sensor doesn't exist: {event}")
 
@@ -149,6 +180,28 @@ class DriverManager():
                     if(value[0].is_set()):
                         value[1](value[0])
 
+    """
+    Update the resource usage of every driver proccess and our own, called whenever metrics are read
+    """
+    def collectProcessStats(self):
+        proccesses = [("DriverManager", None)] + [(proccess.driver.moduleName, proccess.pid) for proccess in self.proccessList]
+        for name, pid in proccesses:
+            stats = readProcessStats(pid)
+            if stats is None:
+                continue
+            self.metrics.gauge("process_resident_memory_bytes", "Resident memory of the proccess", driver=name).set(stats["rss_bytes"])
+            self.metrics.counter("process_cpu_seconds_total", "User and system CPU time the proccess has used", driver=name).setTotal(stats["cpu_seconds"])
+            if "peak_rss_bytes" in stats:
+                self.metrics.gauge("process_peak_resident_memory_bytes", "Most resident memory the proccess has used", driver=name).set(stats["peak_rss_bytes"])
+            if "disk_write_bytes" in stats:
+                self.metrics.counter("process_disk_write_bytes_total", "Bytes the proccess has written to storage", driver=name).setTotal(stats["disk_write_bytes"])
+
+    """
+    Get a compact summary of every metric to include with an upload
+    """
+    def getMetricsSnapshot(self) -> dict:
+        return self.metrics.snapshot()
+
     """
     Get the data from the manager
 
@@ -168,10 +221,7 @@ class DriverManager():
             #self.jsonDict[key]["data"] = originalData[key]["data"]
             self.jsonDict[key]["data"] = {}
             for dataKey, value in originalData[key]["data"].items():
-                if type(value) == Synchronized:
-                    self.jsonDict[key]["data"][dataKey] = value.value
-                else:
-                    self.jsonDict[key]["data"][dataKey] = value
+                self.jsonDict[key]["data"][dataKey] = self._toJSONValue(value)
             self.jsonDict[key]["events"] = {}
             for eventKey, eventValue in originalData[key]["events"].items():
                 self.jsonDict[key]["events"][eventKey] = list(originalData[key]["events"][eventKey])
@@ -190,10 +240,7 @@ class DriverManager():
         # Update the data values for each sensor
         for key, _ in originalData.items():
             for dataKey, _ in self.jsonDict[key]["data"].items():
-                    if type(originalData[key]["data"][dataKey]) == Synchronized:
-                        self.jsonDict[key]["data"][dataKey] = originalData[key]["data"][dataKey].value
-                    else:
-                        self.jsonDict[key]["data"][dataKey] = originalData[key]["data"][dataKey]
+                    self.jsonDict[key]["data"][dataKey] = self._toJSONValue(originalData[key]["data"][dataKey])
         
         
         # Update the events for each sensor
@@ -205,6 +252,18 @@ class DriverManager():
                         self.jsonDict[key]["events"][eventKey][1] = originalData[key]["events"][eventKey][1].__name__
         return self.jsonDict
 
+    """
+    Convert a single data value into something that can be serialized, shared values are unwrapped and objects that provide toJSON (like the BME688 history) are summarized
+
+    :param value: The value stored in a sensors data dictionary
+    """
+    def _toJSONValue(self, value):
+        if type(value) == Synchronized:
+            return value.value
+        elif hasattr(value, "toJSON"):
+            return value.toJSON()
+        return value
+
     """
     Format a new dictionary for the given sensor
 
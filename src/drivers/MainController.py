@@ -5,6 +5,7 @@ Provides the top level of the whole system so individual components can be utili
 """
 
 import json
+import logging
 import os
 import time
 import uuid
@@ -14,7 +15,7 @@ from drivers.DriverManager import DriverManager
 from drivers.NetworkDriver import BluetoothDriver, WiFiManager
 from drivers.sensors.AsyncPublisher import AsyncPublisher
 from drivers.sensors.BME688 import BME688
-from drivers.sensors.LEDDriver import LEDDriver
+from drivers.sensors.LEDDriver import LEDCommand, LEDDriver, LEDMode
 from drivers.sensors.LidSwitch import LidSwitch
 from drivers.sensors.MLX90640 import MLX90640
 
@@ -31,21 +32,20 @@ class MainController:
 
     """
     Create a new instance of our main controlller
+
+    :param simulation: A drivers.Simulation.Simulation to run against instead of the real hardware, None uses the hardware
+    :param sessionRecorder: A helpers.SessionLog.SessionRecorder to record everything the drivers do to, None records nothing
     """
 
-    def __init__(self) -> None:
+    def __init__(self, simulation=None, sessionRecorder=None) -> None:
         self.is_initialized = False
+        self.sessionRecorder = sessionRecorder
         calibration = CalibrationLoader("CalibrationDetails.json")
 
         if not os.path.exists("../data/"):
             os.mkdir("../data/")
 
-        # Read in current commit number from git file
-        # NOTE: This for sure feels like some security vulnerablity like lfi or something but idc
-        with open("/firmware/.git/HEAD", "r") as HEADFile:
-            refPath = HEADFile.read().split(" ")[1].strip()
-            with open(f"/firmware/.git/{refPath}", "r") as commitIDFile:
-                self.commitID = commitIDFile.read().strip()
+        self.commitID = self.readCommitID()
 
         # Create pipes to all proccesses that create files so we can retrieve the file name that they save the most recent data as
         self.soundControllerConnection, soundControllerConnection = Pipe()
@@ -55,7 +55,11 @@ class MainController:
         # Queue of data that needs to be published to the server
         self.publisherQueue = Queue()
 
+        # Queue of timed patterns for the LEDs so nobody has to sleep while an animation plays
+        self.ledQueue = Queue()
+
         self.isMuted = False
+        self.streamingTranscription = False
         self.loadConfig()
         self.isBootFromUpdate = os.path.exists("../data/updated.txt")
         if self.isBootFromUpdate:
@@ -63,19 +67,38 @@ class MainController:
         print(self.isBootFromUpdate)
 
         # Create a manager device passing the NAU7802 in as well as a generic TestDriver that just adds two numbers
-        self.manager = DriverManager(
-            LEDDriver(self.isBootFromUpdate),
-            NAU7802(calibration.get("NAU7802_CALIBRATION_FACTOR")),
-            BME688(),
-            MLX90640(mlxControllerConenction),
-            LidSwitch(),
-            RealsenseCam(realsenseControllerConenction),
-            SoundController(soundControllerConnection, self.isMuted),
-            AsyncPublisher(self.publisherQueue, self.commitID),
-            BluetoothDriver(self.isMuted)
-        )
-
-        self.wifiManager = WiFiManager()
+        if simulation is None:
+            drivers = [
+                LEDDriver(self.isBootFromUpdate, commandQueue=self.ledQueue),
+                NAU7802(calibration.get("NAU7802_CALIBRATION_FACTOR")),
+                BME688(),
+                MLX90640(mlxControllerConenction),
+                LidSwitch(),
+                RealsenseCam(realsenseControllerConenction),
+                SoundController(soundControllerConnection, self.isMuted, streamingTranscription=self.streamingTranscription),
+                AsyncPublisher(self.publisherQueue, self.commitID, self.ledQueue),
+                BluetoothDriver(self.isMuted)
+            ]
+        else:
+            # Only imported when simulating so the device never loads the stand ins
+            from drivers import Simulation as sim
+            drivers = [
+                sim.SimulatedLEDDriver(simulation, self.isBootFromUpdate, commandQueue=self.ledQueue),
+                sim.SimulatedNAU7802(simulation, calibration.get("NAU7802_CALIBRATION_FACTOR")),
+                sim.SimulatedBME688(simulation),
+                sim.SimulatedMLX90640(simulation, mlxControllerConenction),
+                sim.SimulatedLidSwitch(simulation),
+                sim.SimulatedRealsenseCam(simulation, realsenseControllerConenction),
+                sim.SimulatedSoundController(simulation, soundControllerConnection, self.isMuted, streamingTranscription=self.streamingTranscription),
+                AsyncPublisher(self.publisherQueue, self.commitID, self.ledQueue),
+                sim.SimulatedBluetoothDriver(simulation, self.isMuted)
+            ]
+        self.manager = DriverManager(*drivers)
+        if self.sessionRecorder is not None:
+            self.sessionRecorder.start(self.manager, self.commitID)
+
+        # Read the connection state the BluetoothDriver publishes instead of checking it ourselves
+        self.wifiManager = WiFiManager(self.manager.getData()["BluetoothDriver"]["data"])
         self.lastRecording = ""
         
         # Preform the device setup
@@ -83,13 +106,9 @@ class MainController:
 
         # After we have initialzied all the proccesses we want to flash green to signifiy we are done
         if self.manager.allProcsInitialized and not self.isBootFromUpdate:
-            self.manager.setEvent("LEDDriver.DONE")
-            time.sleep(2)
-            self.manager.setEvent("LEDDriver.NONE")
+            self.ledQueue.put(LEDCommand(LEDMode.DONE, duration=2, priority=1, revertTo=LEDMode.NONE))
         elif not self.isBootFromUpdate:
-            self.manager.setEvent("LEDDriver.ERROR")
-            time.sleep(2)
-            self.manager.setEvent("LEDDriver.NONE")
+            self.ledQueue.put(LEDCommand(LEDMode.ERROR, duration=2, priority=1, revertTo=LEDMode.NONE))
 
         # First-time setup weight
         self.initialWeight = self.manager.getData()["NAU7802"]["data"]["weight"].value
@@ -160,7 +179,9 @@ class MainController:
         # Check the state of the LidSwitch
         if self.manager.getEvent("LidSwitch.LID_CLOSED") and self.is_initialized:
             print("Lid closed event")
-            time.sleep(0.25)
+            self.manager.tracer.start()
+            with self.manager.tracer.span("lid_debounce"):
+                time.sleep(0.25)
             self.collectData(triggeredByLid=True)
 
             # After the last sample is done being collected we want to get the current weight
@@ -200,11 +221,15 @@ class MainController:
     """
 
     def collectData(self, triggeredByLid=True) -> bool:
+        tracer = self.manager.tracer
+        traceId = tracer.currentTrace() or tracer.start()
+        collectStart = time.time()
         
         # When collect data is called we want to set the trigger type
         data = self.manager.getData()
         fileNames = {}
         data["DriverManager"]["data"]["userTrigger"] = triggeredByLid
+        data["DriverManager"]["data"]["traceId"] = traceId
 
         # Start recording the user annotation
         self.manager.setEvent("SoundController.RECORD")
@@ -212,16 +237,20 @@ class MainController:
         # We want to tell the "cameras" we would like to capture the latest frames
         # Delay the camera capture for a moment.
         self.manager.setEvent("LEDDriver.CAMERA")
-        time.sleep(0.4)
+        with tracer.span("camera_delay"):
+            time.sleep(0.4)
         self.manager.setEvent("Realsense.CAPTURE")
         self.manager.setEvent("MLX90640.CAPTURE")
 
         # While the capture events are still set we should just wait until they are cleared meaning they succeeded
-        while self.manager.getEvent("Realsense.CAPTURE") or self.manager.getEvent("MLX90640.CAPTURE") or self.manager.getEvent("SoundController.RECORD"):
-            time.sleep(0.2)
-
-        # Grab dictionaries of the file paths generated from the Realsense module and the MLX90640 module and microphone
-        fileNames.update(self.soundControllerConnection.recv())
+        with tracer.span("capture_wait"):
+            while self.manager.getEvent("Realsense.CAPTURE") or self.manager.getEvent("MLX90640.CAPTURE") or self.manager.getEvent("SoundController.RECORD"):
+                time.sleep(0.2)
+
+        # Grab dictionaries of the file paths generated from the Realsense module and the MLX90640 module and microphone, the sound controller may have already transcribed the recording
+        soundResult = self.soundControllerConnection.recv()
+        transcription = soundResult.pop("transcription", None)
+        fileNames.update(soundResult)
         fileNames.update(self.realsenseControllerConenction.recv())
         fileNames.update(self.mlxControllerConenction.recv())
 
@@ -236,19 +265,50 @@ class MainController:
         self.manager.setEvent("SoundController.STOP_RECORDING")
 
         # Wait for debounce time for load cell
-        time.sleep(6)
+        with tracer.span("weigh_debounce"):
+            time.sleep(6)
         data = self.manager.getData()
         data["NAU7802"]["data"]["weight_delta"].value = (
             data["NAU7802"]["data"]["weight"].value - self.startingWeight
         )
         uid = str(uuid.uuid4())
-        self.publisherQueue.put((uid, fileNames, self.manager.getJSON(), False))
+        packet = self.manager.getJSON()
+        if transcription is not None:
+            packet["SoundController"]["data"]["TranscribedText"] = transcription
+        packet["Metrics"] = self.manager.getMetricsSnapshot()
+        self.publisherQueue.put((uid, fileNames, packet, False))
+        if self.sessionRecorder is not None:
+            self.sessionRecorder.recordArtifacts(uid, fileNames)
+
+        # The publisher records the rest of the trace against the ID in the packet
+        tracer.record(traceId, "collect", collectStart, time.time())
+        tracer.end()
+
+    """
+    Read in current commit number from git file
+    NOTE: This for sure feels like some security vulnerablity like lfi or something but idc
+
+    :param gitDir: The git directory of the firmware
+    :return: The commit ID or "unknown" when not running from a firmware checkout, such as while simulating on a dev machine
+    """
+
+    def readCommitID(self, gitDir="/firmware/.git") -> str:
+        try:
+            with open(os.path.join(gitDir, "HEAD"), "r") as HEADFile:
+                refPath = HEADFile.read().split(" ")[1].strip()
+            with open(os.path.join(gitDir, refPath), "r") as commitIDFile:
+                return commitIDFile.read().strip()
+        except (OSError, IndexError) as e:
+            logging.warning(f"Unable to read the firmware commit: {e}")
+            return "unknown"
 
     """
     Shutdown device connected via the DriverManager
     """
 
     def kill(self):
+        if self.sessionRecorder is not None:
+            self.sessionRecorder.stop()
         self.manager.kill()
 
     def updateConfig(self):
@@ -261,5 +321,8 @@ class MainController:
             with open("../data/config.json", 'r') as inFile:
                 data = json.load(inFile)
                 self.isMuted = bool(data["muted"])
+
+                # Transcribe while the user is still speaking, this keeps the whisper server and its model loaded the whole time
+                self.streamingTranscription = bool(data.get("streamingTranscription", False))
       
 
@@ -25,6 +25,10 @@ from bluez_peripheral.util import Adapter, get_message_bus
 
 from drivers.DriverBase import DriverBase
 from helpers import RequestHandler
+from helpers.ConnectivityMonitor import ConnectivityMonitor, readConnectivity
+from helpers.EventLoopMonitor import BoundedExecutor, EventLoopMonitor, timedHandler
+from helpers.NetworkListEncoder import encodeLegacy, encodePages
+from helpers.NetworkManagerClient import NetworkManagerClient
 
 """
 Provides interaction between our device and the network we are connected or attempting to connect to
@@ -32,10 +36,17 @@ Provides interaction between our device and the network we are connected or atte
 
 
 class WiFiManager:
-    def __init__(self):
+    """
+    :param connectivityState: The shared values a ConnectivityMonitor publishes to, when given the connection state is read from them instead of running nmcli
+    :param executor: The BoundedExecutor the async methods run nmcli in, the loop's default executor is used when None
+    """
+    def __init__(self, connectivityState=None, executor=None):
+        self.connectivityState = connectivityState
+        self.executor = executor
+        self.networkManager = None
         self.requests = RequestHandler()
         self.lastConnectionResult = {"success": False, "message": "", "timestamp": 0}
-        self.lastWiFiScan = {}
+        self._setScanResults({})
         self.scanNetworks()
         self.isConnectedBool = False
 
@@ -44,7 +55,11 @@ class WiFiManager:
     """
 
     def _runCommand(self, cmd: list[str]):
-        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError as e:
+            # Treat a missing tool (no nmcli or iwlist off the device) the same as the command failing
+            process = subprocess.CompletedProcess(cmd, 127, b"", str(e).encode("utf-8"))
         return process.returncode, process
 
     """
@@ -64,24 +79,22 @@ class WiFiManager:
                 splitNetworkName = re.split(r'(?<!\\):', network)
                 splitNetworkName[0] = splitNetworkName[0].replace("\\:", ":")
 
+                # Keep the strongest access point when several share a name
+                strength = int(splitNetworkName[1])
                 if len(splitNetworkName[0]) > 0 and (
                     splitNetworkName[0] not in resultNetworks
+                    or resultNetworks[splitNetworkName[0]]["strength"] < strength
                 ):
                     resultNetworks[splitNetworkName[0]] = {
-                        "strength": int(splitNetworkName[1]),
+                        "strength": strength,
                         "security": (
                             splitNetworkName[2]
                             if len(splitNetworkName[2]) > 1
                             else "Open"
                         ),
                     }
-            except ValueError as e:
+            except (ValueError, IndexError) as e:
                 continue
-
-        # Prune network list down to less than 512 characters
-        while len(str(resultNetworks)) > 512:
-            networks = list(resultNetworks.keys())
-            del resultNetworks[networks[len(networks) - 1]]
         return resultNetworks
 
     """
@@ -96,12 +109,23 @@ class WiFiManager:
         if returnCode == 0:
             # Create a dict of network names to signals to avoid duplicate networks
             discoveredNetworks = self._parseNetworkList(process.stdout.decode("utf-8"))
-            self.lastWiFiScan = discoveredNetworks
+            self._setScanResults(discoveredNetworks)
             return True
         else:
             logging.error("Failed to scan WiFi networks!")
             return False
 
+    """
+    Store the results of a scan along with their encodings for bluetooth so reads never have to encode them
+
+    :param networks: Dictionary of SSID to {"strength", "security"}
+    """
+
+    def _setScanResults(self, networks):
+        self.lastWiFiScan = networks
+        self.legacyScan = encodeLegacy(networks)
+        self.scanPages = encodePages(networks)
+
     """
     Get the results from the last WiFi scan
     """
@@ -153,11 +177,101 @@ class WiFiManager:
             }
             return False
 
+    """
+    Scan, connect and disconnect through NetworkManager's D-Bus API from now on instead of running nmcli
+
+    :param networkManager: A NetworkManagerClient that has already connected
+    """
+
+    def useNetworkManager(self, networkManager):
+        self.networkManager = networkManager
+
+    """
+    Scan for available networks without blocking the event loop
+    """
+
+    async def scanNetworksAsync(self):
+        if self.networkManager is None:
+            return await self._runBlocking(self.scanNetworks)
+
+        try:
+            self._setScanResults(await self.networkManager.scan())
+            return True
+        except Exception as e:
+            logging.error(f"Failed to scan WiFi networks: {e}")
+            return False
+
+    """
+    Connect to a specified network without blocking the event loop, lastConnectionResult is updated once the attempt finishes
+
+    :param ssid: The network name to connect to
+    :param password: The password to connect to the network with
+    """
+
+    async def connectToNetworkAsync(self, ssid, password):
+        if self.networkManager is None:
+            return await self._runBlocking(self.connectToNetwork, ssid, password)
+
+        success, message = await self.networkManager.connectToNetwork(ssid, password)
+        if success:
+            logging.info(f"Successfully connected to network: {ssid}")
+            self.lastConnectionResult = {"message": message, "success": True, "timestamp": time()}
+        else:
+            logging.error(f"Failed to connect to network: {ssid}")
+            self.lastConnectionResult = {
+                "message": "Wi-Fi configuration failed",
+                "log": message,
+                "success": False,
+                "timestamp": time(),
+            }
+        return success
+
+    """
+    Disconnect from the given network by name without blocking the event loop
+    """
+
+    async def disconnectFromNetworkAsync(self, ssid):
+        if self.networkManager is None:
+            return await self._runBlocking(self.disconnectFromNetwork, ssid)
+
+        if await self.networkManager.deleteConnection(ssid):
+            self.isConnectedBool = False
+            return True
+        return False
+
+    """
+    Check our connection without blocking the event loop
+    """
+
+    async def checkConnectionAsync(self):
+        return await self._runBlocking(self.checkConnection)
+
+    """
+    Get our connection state from the values published by the ConnectivityMonitor, this never blocks
+
+    :return: The same dictionary as checkConnection() or None if the state isn't known yet
+    """
+
+    def cachedConnection(self):
+        cached = readConnectivity(self.connectivityState)
+        if cached["wifi_connected"] is None or cached["internet_access"] is None:
+            return None
+        self.isConnectedBool = cached["wifi_connected"]
+        return {
+            "message": "Connected to Wi-Fi" if cached["wifi_connected"] else "Not connected to Wi-Fi",
+            "success": cached["wifi_connected"],
+            "internet_access": cached["internet_access"],
+        }
+
     """
     Check if we are actually connected to the internet by sending a heartbeat request to our API
     """
 
     def checkConnection(self):
+        cached = self.cachedConnection()
+        if cached is not None:
+            return cached
+
         returnCode, process = self._runCommand(
             ["nmcli", "-t", "-f", "NAME", "c", "show", "--active"]
         )
@@ -179,7 +293,7 @@ class WiFiManager:
             }
         else:
             self.isConnectedBool = False
-            return {"message": "Not connected to Wi-Fi", "success": False}
+            return {"message": "Not connected to Wi-Fi", "success": False, "internet_access": False}
         
 
     """
@@ -196,6 +310,11 @@ class WiFiManager:
     def isConnected(self):
         return self.isConnectedBool
 
+    async def _runBlocking(self, func, *args):
+        if self.executor is not None:
+            return await self.executor.run(func, *args)
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
 
 """
 Provides interfaces for communicating with bluetooth devices such as phones or laptops
@@ -212,17 +331,31 @@ class BluetoothDriver(DriverBase):
         Start the bluetooth service with the unique indentifier
         """
 
-        def __init__(self):
+        def __init__(self, connectivityState=None, executor=None):
             super().__init__(str(31415924535897932384626433832790), True)
-            self.wifi = WiFiManager()
+            self.wifi = WiFiManager(connectivityState, executor)
+            self.loopMonitor = None
+            self.scanPage = None
+            self.connectionStatus = {"message": "Checking connection", "success": False, "internet_access": False}
+
+        """
+        Refresh the connection status served when the ConnectivityMonitor doesn't know our state yet
+        """
+
+        async def refreshConnectionStatus(self):
+            status = await self.wifi.checkConnectionAsync()
+            if status is not None:
+                self.connectionStatus = status
 
         """
         Return the current status of our connection, are we connected to a network and if so are we also connected to the internet
         """
 
         @characteristic(str(31415924535897932384626433832790 + 1), CharFlags.READ)
+        @timedHandler
         def getConnectionStatus(self, options):
-            return json.dumps(self.wifi.checkConnection()).encode("utf-8")
+            status = self.wifi.cachedConnection()
+            return json.dumps(status if status is not None else self.connectionStatus).encode("utf-8")
 
         """
         Returns the result of the last Wi-Fi connection attempt
@@ -232,6 +365,7 @@ class BluetoothDriver(DriverBase):
             str(31415924535897932384626433832790 + 2),
             CharFlags.WRITE | CharFlags.READ | CharFlags.WRITE_WITHOUT_RESPONSE,
         )
+        @timedHandler
         def setWIFiArgs(self, options):
             return json.dumps(self.wifi.lastConnectionResult).encode("utf-8")
 
@@ -240,6 +374,7 @@ class BluetoothDriver(DriverBase):
         """
 
         @setWIFiArgs.setter
+        @timedHandler
         def setWIFIArgs(self, value, options):
             ssid = ""
             password = ""
@@ -252,13 +387,16 @@ class BluetoothDriver(DriverBase):
 
             except Exception as e:
                 logging.error(f"An error occurred when setting WiFi credentials: {e}")
-                self.lastConnectionResult = {
+                self.wifi.lastConnectionResult = {
                     "success": False,
-                    "message": e,
+                    "message": str(e),
                     "timestamp": time(),
                 }
+                return json.dumps(self.wifi.lastConnectionResult).encode("utf-8")
 
-            self.wifi.connectToNetwork(ssid, password)
+            # Connecting takes up to tens of seconds, the result is read back from this characteristic once it finishes
+            self.wifi.lastConnectionResult = {"success": False, "message": "Connecting", "timestamp": time()}
+            asyncio.ensure_future(self.wifi.connectToNetworkAsync(ssid, password))
             return json.dumps(self.wifi.lastConnectionResult).encode("utf-8")
 
         """
@@ -266,10 +404,41 @@ class BluetoothDriver(DriverBase):
         """
 
         @characteristic(
-            str(31415924535897932384626433832790 + 3), CharFlags.NOTIFY | CharFlags.READ
+            str(31415924535897932384626433832790 + 3),
+            CharFlags.NOTIFY | CharFlags.READ | CharFlags.WRITE | CharFlags.WRITE_WITHOUT_RESPONSE,
         )
+        @timedHandler
         def getScannedNetworks(self, options):
-            return json.dumps(self.wifi.lastWiFiScan).encode("utf-8")
+            if self.scanPage is None:
+                return self.wifi.legacyScan
+            pages = self.wifi.scanPages
+            return pages[min(self.scanPage, len(pages) - 1)]
+
+        """
+        Selects the page of scan results returned by reads, writing {"page": n} switches to the compact paginated format and turns on notifications of every page after each scan, {"page": null} switches back to the original format
+        """
+
+        @getScannedNetworks.setter
+        @timedHandler
+        def getScannedNetworks(self, value, options):
+            try:
+                data = json.loads(str(value.decode("utf-8")))
+                self.scanPage = None if data["page"] is None else max(0, int(data["page"]))
+            except Exception as e:
+                logging.error(f"An error occurred when selecting a scan page: {e}")
+
+        """
+        Send every page of the latest scan to subscribed devices, strongest networks first
+
+        Nothing is sent until a device has asked for paging, apps written before it was added can't parse the compact pages
+        """
+
+        async def notifyScan(self):
+            if self.scanPage is None:
+                return
+            for page in self.wifi.scanPages:
+                self.getScannedNetworks.changed(page)
+                await asyncio.sleep(0)
 
 
         """
@@ -279,22 +448,25 @@ class BluetoothDriver(DriverBase):
             str(31415924535897932384626433832790 + 4),
             CharFlags.WRITE | CharFlags.WRITE_WITHOUT_RESPONSE
         ).setter
+        @timedHandler
         def disconnectFromNetwork(self,value, options):
             decodedValue = str(value.decode('utf-8'))
             try:
                 data = json.loads(decodedValue)
             except Exception as e:
                 logging.error(f"An error occurred when disconnecting from WiFi network: {e}")
+                return
     
             if "ssid" in data:
-                if self.wifi.disconnectFromNetwork(data["ssid"]):
-                   logging.info("Succsessfully disconnected from WiFi network!")
-                else:
-                    logging.error(f"Failed to disconnect from WiFi netowrk: {data['ssid']}")
+                asyncio.ensure_future(self._disconnect(data["ssid"]))
             else:
                 logging.error("SSID not supplied in request!")
-                
-            
+
+        async def _disconnect(self, ssid):
+            if await self.wifi.disconnectFromNetworkAsync(ssid):
+                logging.info("Succsessfully disconnected from WiFi network!")
+            else:
+                logging.error(f"Failed to disconnect from WiFi netowrk: {ssid}")
             
 
     """
@@ -302,49 +474,83 @@ class BluetoothDriver(DriverBase):
     """
 
     class APISetupService(Service):
-        def __init__(self):
+        """
+        :param executor: The BoundedExecutor heartbeats and credential writes are run in
+        :param checkInterval: Seconds the result of the last heartbeat is served for before another is sent
+        """
+        def __init__(self, executor, checkInterval=30):
             super().__init__("ABC0", True)
             self.requests = RequestHandler()
-            
+            self.executor = executor
+            self.checkInterval = checkInterval
+            self.loopMonitor = None
+            self.apiConnected = False
+            self.apiCheckedAt = 0
+            self.apiCheck = None
+            self.credentialsVersion = 0
 
         def checkAPIConnection(self):
             return self.requests.sendSecureHeartbeat()
 
+        """
+        Send a heartbeat in the background if one isn't already in flight, the result is served by the next read
+        """
+
+        def refreshAPIConnection(self):
+            if self.apiCheck is None or self.apiCheck.done():
+                self.apiCheck = asyncio.ensure_future(self._refreshAPIConnection())
+
+        async def _refreshAPIConnection(self):
+            version = self.credentialsVersion
+            result = await self.executor.run(self.checkAPIConnection)
+
+            # A heartbeat sent with the credentials we just replaced says nothing about the new ones
+            if result is not None and version == self.credentialsVersion:
+                self.apiConnected = result
+                self.apiCheckedAt = time()
+
+        async def _storeCredentials(self, apiKey, endpoint, port):
+            # Nothing is known about the new key until its own heartbeat comes back
+            self.credentialsVersion += 1
+            self.apiConnected = False
+            self.apiCheckedAt = 0
+
+            # Write the new credentials to the config.secret file, every proccess picks them up the next time they are used
+            try:
+                await self.executor.run(self.requests.credentials.setAPICredentials, apiKey, endpoint, port, force=True)
+            except Exception as e:
+                logging.error(f"Failed to store API credentials: {e}")
+                return
+
+            print("Written to file and updated credentials!")
+            self.apiCheck = None
+            self.refreshAPIConnection()
+
         @characteristic(
             "ABC1", CharFlags.WRITE | CharFlags.READ | CharFlags.WRITE_WITHOUT_RESPONSE
         )
+        @timedHandler
         def setAPIKey(self, options):
-            return str(self.checkAPIConnection()).encode("utf-8")
+            if time() - self.apiCheckedAt > self.checkInterval:
+                self.refreshAPIConnection()
+            return str(self.apiConnected).encode("utf-8")
 
         @setAPIKey.setter
+        @timedHandler
         def setAPIKey(self, value, options):
             try:
                 decodedValue = str(value.decode("utf-8")).strip()
                 data = json.loads(decodedValue)
+                apiKey, endpoint, port = data["apiKey"], data["endpoint"], data["port"]
                 print("Decoded JSON!")
             except Exception as e:
                 print(f"An error occurred: {e}")
                 return False
            
-            # Formulate new FastAPI credentials based on the incoming data
-            creds = {
-                "FASTAPI_CREDS": {
-                    "apiKey": data["apiKey"],
-                    "endpoint": data["endpoint"],
-                    "port": int(data["port"]),
-                }
-            }
-
-            jsonString = json.dumps(creds)
-            # Write the new credentials to the config.secret file
-            with open("config.secret", "w") as file:
-                file.write(jsonString)
-
-            # Then have the requests library update the credentials currently loaded into the system
-            self.requests.updateAPICreds()
-            print("Written to file and updated credentials!")
+            asyncio.ensure_future(self._storeCredentials(apiKey, endpoint, port))
 
         @characteristic("ABC2", CharFlags.READ)
+        @timedHandler
         def getAPIKey(self, options):
             response = {"apiKey": self.requests.getAPIKey(), "deviceID": self.requests.serial}
 
@@ -355,9 +561,11 @@ class BluetoothDriver(DriverBase):
     """
 
     class DebugService(Service):
-        def __init__(self, muted):
+        def __init__(self, muted, executor):
             super().__init__("BEEF", True)
             self.isMuted = muted
+            self.executor = executor
+            self.loopMonitor = None
         
         def _clearCache(self):
             try:
@@ -375,10 +583,12 @@ class BluetoothDriver(DriverBase):
         @characteristic(
             "BEF0", CharFlags.WRITE | CharFlags.READ | CharFlags.WRITE_WITHOUT_RESPONSE
         )
+        @timedHandler
         def setMuted(self, options):
             return str(self.isMuted).encode("utf-8")
 
         @setMuted.setter
+        @timedHandler
         def setMuted(self, value, options):
             try:
                 decodedValue = str(value.decode('utf-8'))
@@ -394,11 +604,12 @@ class BluetoothDriver(DriverBase):
             "BEF1",
             CharFlags.WRITE | CharFlags.WRITE_WITHOUT_RESPONSE
         ).setter
+        @timedHandler
         def clearCache(self, value, options):
             try:
                 decodedValue = str(value.decode('utf-8'))
                 if decodedValue == "True":
-                    self._clearCache()
+                    self.executor.submit(self._clearCache)
             except Exception as e:
                 logging.error(f"An error occurred: {e}")
                 return False
@@ -422,27 +633,37 @@ class BluetoothDriver(DriverBase):
     """
     def startServer(self):
         loop = asyncio.get_event_loop()
+        loop.create_task(self.loopMonitor.run())
         loop.run_until_complete(self.setupBus())
         loop.run_until_complete(self.controlLoop())
 
     def initialize(self):
-        self.wifiService = self.WiFiSetupSerivce()
-        self.apiService = self.APISetupService()
-        self.debugService = self.DebugService(self.muted)
+        # Everything that blocks runs here so GATT requests are always answered straight from the event loop
+        self.executor = BoundedExecutor()
+        self.loopMonitor = EventLoopMonitor(self.data)
+
+        self.wifiService = self.WiFiSetupSerivce(self.data, self.executor)
+        self.apiService = self.APISetupService(self.executor)
+        self.debugService = self.DebugService(self.muted, self.executor)
+        for service in (self.wifiService, self.apiService, self.debugService):
+            service.loopMonitor = self.loopMonitor
         self.isServerRunning = False
         self.wifi = self.wifiService.wifi
-        self.lastConnectionStatus = bool(self.wifi.checkConnection()["internet_access"])
+
+        # The monitor publishes our connection state for every other proccess and tells us when it changes
+        # The first probe always reports a change from unknown, which sets our starting state without raising either event
+        self.lastConnectionStatus = None
+        self.connectivity = ConnectivityMonitor(self.data, onChange=self.updateConnectionState, executor=self.executor)
+        self.connectivity.probe()
         self.data["muted"].value = self.muted
         self.loopTime = 20
         self.startServer()
         
 
     """
-    Check once every 20 seconds to see if our connection is still alive and if not we want to inform the controller that we have lost connection
+    Called by the connectivity monitor whenever our internet access changes so we can inform the controller that we have lost connection
     """
-    def updateConnectionState(self):
-        connectionStatus =  bool(self.wifi.checkConnection()["internet_access"])
-
+    def updateConnectionState(self, connectionStatus):
         # Check if in between the current sample and now we have lost the connection
         if connectionStatus == False and self.lastConnectionStatus == True:
             self.getEvent("LOST_WIFI_CONNECTION").set()
@@ -451,29 +672,29 @@ class BluetoothDriver(DriverBase):
             self.getEvent("GOT_WIFI_CONNECTION").set()
 
         self.lastConnectionStatus = connectionStatus
-   
-    """
-    Handle updating our connection state
-    """
-    def measure(self):
-       self.updateConnectionState()
 
     def createDataDict(self):
         self.data = {
             "initialized": Value('i', 0),
-            "muted": Value('i', 0)
+            "muted": Value('i', 0),
+            "wifi_connected": Value('i', -1),
+            "internet_access": Value('i', -1),
+            "loop_lag_ms": Value('d', 0),
+            "slow_responses": Value('i', 0)
         }
         return self.data
     
     # While the server is running we want to refersh the list of WiFi networks every 10 seconds
     async def controlLoop(self):
         while True:
-            self.updateConnectionState()
+            # Only probes when NetworkManager can't tell us itself and we haven't probed recently
+            await self.connectivity.poll()
             self.data["muted"].value = int(self.debugService.isMuted)
+            await self.wifiService.refreshConnectionStatus()
 
-            if not self.wifi.isConnected():
-                self.wifi.scanNetworks()
-                self.lastConnectionStatus = False
+            if not readConnectivity(self.data)["wifi_connected"]:
+                if await self.wifi.scanNetworksAsync():
+                    await self.wifiService.notifyScan()
                 
             await asyncio.sleep(10)
 
@@ -489,6 +710,13 @@ class BluetoothDriver(DriverBase):
         await serviceCollection.register(bus)
         logging.info("Registered services.")
 
+        await self.connectivity.start(bus)
+
+        # Fall back to nmcli in an executor if NetworkManager isn't reachable over D-Bus
+        networkManager = NetworkManagerClient(bus)
+        if await networkManager.connect():
+            self.wifi.useNetworkManager(networkManager)
+
         agent = NoIoAgent()
         await agent.register(bus)
 
@@ -0,0 +1,893 @@
+"""
+Oregon State University, 2024
+
+Stand ins for every piece of hardware on the bin so the DriverManager and MainController can run end to end on any linux machine
+
+Each simulated driver is the real driver with its device swapped for one that is fed by recordings or synthetic data, so everything above the device (measure loops, image encoding, point clouds, VAD, uploads) runs exactly as it does on the bin
+"""
+
+import csv
+import glob
+import logging
+import os
+import threading
+import wave
+import zlib
+from bisect import bisect_right
+from time import sleep, time
+
+import cv2
+import numpy as np
+
+from drivers.NetworkDriver import BluetoothDriver
+from drivers.sensors.BME688 import BME688
+from drivers.sensors.LEDDriver import LEDDriver
+from drivers.sensors.LidSwitch import LidSwitch
+from drivers.sensors.Microphone import CALLBACK_COMPLETE
+from drivers.sensors.MLX90640 import MLX90640, ThermalCam
+from drivers.sensors.NAU7802 import NAU7802
+from drivers.sensors.RealsenseCamera import RealsenseCam
+from drivers.sensors.SoundController import SoundController
+from helpers.SessionLog import SessionLog
+
+
+"""
+A value that changes over time read from a CSV of "seconds,value" rows, the value of a row is held until the next one
+
+:param path: The CSV file to read, a header row is skipped
+:param times: Seconds of each value when they come from somewhere other than a CSV
+:param values: The values at each of those times
+"""
+class RecordedTrace():
+
+    def __init__(self, path=None, times=(), values=()):
+        self.times = [float(seconds) for seconds in times]
+        self.values = [float(value) for value in values]
+        if path is None:
+            return
+        with open(path, "r") as traceFile:
+            for row in csv.reader(traceFile):
+                try:
+                    seconds, value = float(row[0]), float(row[1])
+                except (ValueError, IndexError):
+                    continue
+                self.times.append(seconds)
+                self.values.append(value)
+
+    """
+    Get the value of the trace a given number of seconds after it started, the first value is used before it starts and the last after it ends
+    """
+    def valueAt(self, seconds) -> float:
+        if len(self.values) == 0:
+            return 0.0
+        return self.values[max(0, bisect_right(self.times, seconds) - 1)]
+
+
+class Simulation():
+
+    """
+    Create a new simulation, it must be created before the DriverManager starts any proccesses
+
+    Every proccess works out the state of the bin from how long ago the simulation started so nothing has to be shared between them. The lid opens once every scanInterval seconds and an item is dropped in while it is open.
+
+    Recordings are replayed from dataDir when they are found there, anything missing is synthesized:
+        lid.csv - "seconds,open" rows replacing the lid schedule
+        loadcell.csv - "seconds,grams" rows replacing the synthetic weight of the bin
+        realsense/*_depth.npy and realsense/*_color.png - depth frames in millimeters and the color frames taken with them, one pair is used per scan
+        thermal/*.npy - 24x32 temperature matrices in celsius, one is used per scan
+        audio/*.wav - voice recordings played into the microphone one after the other
+
+    :param dataDir: Directory of recordings to replay, None synthesizes everything
+    :param scanInterval: Seconds from one lid opening to the next
+    :param lidOpenTime: Seconds the lid is held open for
+    :param firstOpen: Seconds after the simulation starts that the lid first opens, long enough for MainController to finish its setup
+    :param itemGrams: The range of weights of the items dropped into the bin
+    :param timeScale: Multiplies how long simulated hardware takes to respond, 0 makes every device respond instantly
+    :param seed: Seed for everything random so runs can be repeated
+    """
+    def __init__(self, dataDir=None, scanInterval=60, lidOpenTime=3, firstOpen=45, itemGrams=(20, 400), timeScale=1.0, seed=0):
+        self.dataDir = os.path.abspath(dataDir) if dataDir is not None else None
+        self.scanInterval = scanInterval
+        self.lidOpenTime = lidOpenTime
+        self.firstOpen = firstOpen
+        self.itemGrams = itemGrams
+        self.timeScale = timeScale
+        self.seed = seed
+        self.startTime = time()
+        self.itemWeights = []
+
+        lidPath = self.dataPath("lid.csv")
+        weightPath = self.dataPath("loadcell.csv")
+        self.lidTrace = RecordedTrace(lidPath) if lidPath is not None else None
+        self.weightTrace = RecordedTrace(weightPath) if weightPath is not None else None
+
+    """
+    Get the path to a recording in the data directory
+
+    :return: The full path or None if it wasn't recorded
+    """
+    def dataPath(self, *parts):
+        if self.dataDir is None:
+            return None
+        path = os.path.join(self.dataDir, *parts)
+        return path if os.path.exists(path) else None
+
+    """
+    Get every recording in the data directory matching a glob pattern in sorted order
+    """
+    def dataFiles(self, pattern) -> list:
+        if self.dataDir is None:
+            return []
+        return sorted(glob.glob(os.path.join(self.dataDir, pattern)))
+
+    """
+    Seconds since the simulation started
+    """
+    def elapsed(self, at=None) -> float:
+        return (time() if at is None else at) - self.startTime
+
+    """
+    Check if the lid is open
+
+    :param at: The unix time to check, now when None
+    """
+    def lidOpen(self, at=None) -> bool:
+        elapsed = self.elapsed(at)
+        if self.lidTrace is not None:
+            return self.lidTrace.valueAt(elapsed) > 0.5
+        if elapsed < self.firstOpen:
+            return False
+        return (elapsed - self.firstOpen) % self.scanInterval < self.lidOpenTime
+
+    """
+    The number of times the lid has been closed, each close starts a scan
+    """
+    def scanCount(self, at=None) -> int:
+        elapsed = self.elapsed(at)
+        if self.lidTrace is not None:
+            closes = 0
+            for i in range(1, len(self.lidTrace.times)):
+                if self.lidTrace.times[i] > elapsed:
+                    break
+                closes += int(self.lidTrace.values[i - 1] > 0.5 and self.lidTrace.values[i] <= 0.5)
+            return closes
+
+        elapsed -= self.firstOpen + self.lidOpenTime
+        return 0 if elapsed < 0 else int(elapsed // self.scanInterval) + 1
+
+    """
+    The weight in grams of the item dropped in during a given scan
+    """
+    def itemWeight(self, scan) -> float:
+        while len(self.itemWeights) <= scan:
+            self.itemWeights.append(float(self.rng("item", len(self.itemWeights)).uniform(*self.itemGrams)))
+        return self.itemWeights[scan]
+
+    """
+    The total weight of everything in the bin in grams, items land halfway through the lid being open or when it closes if the lid was recorded
+    """
+    def weight(self, at=None) -> float:
+        elapsed = self.elapsed(at)
+        if self.weightTrace is not None:
+            return self.weightTrace.valueAt(elapsed)
+
+        if self.lidTrace is not None:
+            dropped = self.scanCount(at)
+        else:
+            landed = elapsed - self.firstOpen - self.lidOpenTime / 2
+            dropped = 0 if landed < 0 else int(landed // self.scanInterval) + 1
+        return sum(self.itemWeight(scan) for scan in range(dropped))
+
+    """
+    Wait as long as a piece of hardware would, scaled by the time scale
+
+    :param seconds: How long the real hardware takes
+    """
+    def delay(self, seconds):
+        if self.timeScale > 0 and seconds > 0:
+            sleep(seconds * self.timeScale)
+
+    """
+    The recorded values of a driver's data at a point in time, only a Replay has any
+
+    :param module: The name of the driver
+    :return: Dictionary of field to value
+    """
+    def recordedData(self, module, at=None) -> dict:
+        return {}
+
+    """
+    The recorded events of a driver that were set between two points in the simulation, only a Replay has any
+
+    :param start: Seconds since the simulation started, exclusive
+    :param end: Seconds since the simulation started, inclusive
+    :return: List of event names
+    """
+    def recordedEvents(self, module, start, end) -> list:
+        return []
+
+    """
+    A random generator that produces the same values for the same scan in every proccess
+
+    :param name: What the values are used for so different data doesn't share a sequence
+    :param index: Usually the scan the values are for
+    """
+    def rng(self, name, index=0):
+        return np.random.default_rng((self.seed, zlib.crc32(name.encode("utf-8")), index))
+
+
+class Replay(Simulation):
+
+    """
+    Create a replay of a session recorded on a bin by helpers.SessionLog.SessionRecorder, it must be created before the DriverManager starts any proccesses
+
+    The lid, the weight of the bin, the environment and the network state follow the recording and voice recordings kept with the session are played into the microphone in order.
+    Camera frames can't be rebuilt from the images a scan saved so they come from dataDir or are synthesized like any other simulation.
+
+    :param sessionPath: The session log to replay
+    :param speed: How many times faster than real time the quiet stretches between scans are played, scans always play in real time since the MainController waits on the clock between each step
+    :param scanSeconds: How long after the lid closes a scan keeps playing in real time, the start of the session plays in real time for as long so the setup isn't rushed either
+    :param dataDir: Directory of recordings for everything the session log doesn't have, the same as for a Simulation
+    :param timeScale: Multiplies how long simulated hardware takes to respond
+    :param seed: Seed for everything that is synthesized
+    """
+    def __init__(self, sessionPath, speed=1.0, scanSeconds=20, dataDir=None, timeScale=1.0, seed=0):
+        self.session = SessionLog(sessionPath)
+        self.speed = speed
+        super().__init__(dataDir, timeScale=timeScale, seed=seed)
+
+        lidTimes, lidStates = self.session.timeline("LidSwitch", "Lid_State")
+        self.lidTrace = RecordedTrace(times=lidTimes, values=lidStates)
+        self.weightTrace = self._totalWeight()
+        self.voiceRecordings = []
+        for _, _, files in self.session.artifacts:
+            if "voiceRecording" in files:
+                fileName = self.session.resolveArtifact(files["voiceRecording"][0])
+                if fileName is not None:
+                    self.voiceRecordings.append(fileName)
+        self.clock = self._buildClock(scanSeconds)
+        logging.info(f"Replaying {self.session.duration:.0f}s session with {self.scanCount(self.startTime + self.session.duration)} scans at {speed}x")
+
+    """
+    Seconds into the recorded session, which runs ahead of the wall clock between scans when the replay is sped up
+    """
+    def elapsed(self, at=None) -> float:
+        wall = (time() if at is None else at) - self.startTime
+        wallTimes, sessionTimes, rates = self.clock
+        index = max(0, bisect_right(wallTimes, wall) - 1)
+        return sessionTimes[index] + (wall - wallTimes[index]) * rates[index]
+
+    def recordedData(self, module, at=None) -> dict:
+        return self.session.valuesAt(module, self.elapsed(at))
+
+    def recordedEvents(self, module, start, end) -> list:
+        return self.session.eventsSet(module, start, end)
+
+    """
+    Voice recordings kept with the session are used before any in the data directory
+    """
+    def dataFiles(self, pattern) -> list:
+        if pattern == os.path.join("audio", "*.wav") and len(self.voiceRecordings) > 0:
+            return self.voiceRecordings
+        return super().dataFiles(pattern)
+
+    """
+    The total weight on the load cell over the session, the recorded weight starts again from zero every time the scale is tared so the weight from before each tare is added back
+    """
+    def _totalWeight(self) -> RecordedTrace:
+        times, weights = self.session.timeline("NAU7802", "weight")
+        recorded = RecordedTrace(times=times, values=weights)
+
+        tareTimes, offsets = [0.0], [0.0]
+        taredAt = None
+        for seconds, module, name, isSet in self.session.events:
+            if module != "NAU7802" or name != "TARE":
+                continue
+            if isSet:
+                taredAt = seconds
+            elif taredAt is not None:
+                tareTimes.append(seconds)
+                offsets.append(offsets[-1] + recorded.valueAt(taredAt))
+                taredAt = None
+
+        offset = RecordedTrace(times=tareTimes, values=offsets)
+        return RecordedTrace(times=times, values=[weight + offset.valueAt(seconds) for seconds, weight in zip(times, weights)])
+
+    """
+    Work out where in the session each point in wall time is, from a second before the lid opens until scanSeconds after it closes plays in real time and everything else at the replay speed
+
+    :return: Tuple of lists of (wall seconds, session seconds, rate) at the start of each stretch
+    """
+    def _buildClock(self, scanSeconds):
+        windows = [(0.0, scanSeconds)]
+        openedAt = None
+        for seconds, value in zip(self.lidTrace.times, self.lidTrace.values):
+            if value > 0.5 and openedAt is None:
+                openedAt = seconds
+            elif value <= 0.5 and openedAt is not None:
+                windows.append((max(0.0, openedAt - 1), seconds + scanSeconds))
+                openedAt = None
+        if openedAt is not None:
+            windows.append((max(0.0, openedAt - 1), self.session.duration))
+
+        wallTimes, sessionTimes, rates = [], [], []
+        wall = session = 0.0
+        for start, end in sorted(windows):
+            if end <= session:
+                continue
+            if start > session:
+                wallTimes.append(wall)
+                sessionTimes.append(session)
+                rates.append(self.speed)
+                wall += (start - session) / self.speed
+                session = start
+            wallTimes.append(wall)
+            sessionTimes.append(session)
+            rates.append(1.0)
+            wall += end - session
+            session = end
+
+        wallTimes.append(wall)
+        sessionTimes.append(session)
+        rates.append(self.speed)
+        return wallTimes, sessionTimes, rates
+
+
+"""
+Stand in for the strip of neopixels, frames are kept in memory instead of being sent over SPI
+"""
+class SimulatedPixelStrip():
+
+    def __init__(self, pixel_count):
+        self.pixels = [(0, 0, 0, 0)] * pixel_count
+        self.shown = list(self.pixels)
+        self.writes = 0
+
+    def __setitem__(self, index, value):
+        self.pixels[index] = value
+
+    def __getitem__(self, index):
+        return self.pixels[index]
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def fill(self, color):
+        self.pixels = [color] * len(self.pixels)
+
+    def show(self):
+        self.shown = list(self.pixels)
+        self.writes += 1
+
+
+"""
+Stand in for PyNAU7802.NAU7802 that reads the weight of the bin from the simulation
+"""
+class SimulatedLoadCell():
+
+    # The NAU7802 is configured for 40 samples per second
+    SAMPLE_RATE = 40
+
+    """
+    :param noise: Standard deviation of the noise in grams added to each reading
+    """
+    def __init__(self, simulation: Simulation, noise=0.3):
+        self.simulation = simulation
+        self.noise = noise
+        self.zeroOffset = 0.0
+        self.calibrationFactor = 1.0
+        self.random = np.random.default_rng(simulation.seed)
+
+    def begin(self, wire=None, initialize=True) -> bool:
+        return True
+
+    def setCalibrationFactor(self, factor):
+        self.calibrationFactor = factor
+
+    def getCalibrationFactor(self):
+        return self.calibrationFactor
+
+    def calculateCalibrationFactor(self, weightOnScale, averageAmount=8):
+        self.simulation.delay(averageAmount / self.SAMPLE_RATE)
+
+    def calculateZeroOffset(self, averageAmount=8):
+        self.simulation.delay(averageAmount / self.SAMPLE_RATE)
+        self.zeroOffset = self.simulation.weight()
+
+    def getWeight(self, allowNegativeWeights=False, samplesToTake=8) -> float:
+        self.simulation.delay(samplesToTake / self.SAMPLE_RATE)
+        weight = self.simulation.weight() - self.zeroOffset + self.random.normal(0, self.noise / np.sqrt(samplesToTake))
+        return weight if allowNegativeWeights else max(0.0, weight)
+
+
+"""
+Stand in for bme680.BME680, the temperature and humidity drift slowly and the gas resistance drops as food is added to the bin
+"""
+class SimulatedEnvironmentSensor():
+
+    class Reading():
+        temperature = 0.0
+        pressure = 0.0
+        humidity = 0.0
+        gas_resistance = 0.0
+        heat_stable = True
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+        self.data = self.Reading()
+        self.random = np.random.default_rng(simulation.seed)
+
+    def get_sensor_data(self) -> bool:
+        # A forced measurement with the heater on takes around 200ms
+        self.simulation.delay(0.2)
+        recorded = self.simulation.recordedData("BME688")
+        if "temperature(c)" in recorded:
+            self.data.temperature = recorded["temperature(c)"]
+            self.data.pressure = recorded.get("pressure(kpa)", 101.325) * 10
+            self.data.humidity = recorded.get("humidity(%rh)", 45)
+            self.data.gas_resistance = recorded.get("gas_resistance(ohms)", 120000)
+            return True
+
+        hours = self.simulation.elapsed() / 3600
+        self.data.temperature = 22 + 0.5 * np.sin(2 * np.pi * hours) + self.random.normal(0, 0.02)
+        self.data.pressure = 1013.25 + self.random.normal(0, 0.05)
+        self.data.humidity = 45 + 5 * np.sin(2 * np.pi * hours / 6) + self.random.normal(0, 0.1)
+        self.data.gas_resistance = 120000 / (1 + 0.001 * self.simulation.weight()) + self.random.normal(0, 200)
+        return True
+
+
+"""
+Stand in for the Bosch BSEC library, derives rough air quality estimates from the gas resistance the same way the outputs are laid out by bsec_python.so
+"""
+class SimulatedBSEC():
+
+    def proccess_bme_data(self, timestamp, temperature, pressure, humidity, gasResistance, outputs):
+        iaq = float(np.clip(500 * (1 - gasResistance.value / 150000), 0, 500))
+        outputs[0] = iaq
+        outputs[4] = iaq
+        outputs[5] = 400 + iaq * 4
+        outputs[6] = 0.5 + iaq / 100
+        return 0
+
+
+"""
+Stand in for the mlx90640 library, temperatures come from recorded matrices or a synthesized warm patch of food on a cool background
+"""
+class SimulatedThermalSensor():
+
+    """
+    :param frameTime: Seconds it takes the sensor to produce a frame, a quarter second at the 4Hz refresh rate the camera is configured for
+    """
+    def __init__(self, simulation: Simulation, frameTime=0.25):
+        self.simulation = simulation
+        self.frameTime = frameTime
+        self.recordings = simulation.dataFiles(os.path.join("thermal", "*.npy"))
+        self.frame = None
+
+    def i2c_init(self, device):
+        pass
+
+    def set_refresh_rate(self, rate):
+        pass
+
+    def dump_eeprom(self):
+        pass
+
+    def extract_parameters(self):
+        pass
+
+    def i2c_tear_down(self):
+        pass
+
+    def get_frame_data(self):
+        self.simulation.delay(self.frameTime)
+        scan = self.simulation.scanCount()
+        if len(self.recordings) > 0:
+            self.frame = np.load(self.recordings[scan % len(self.recordings)]).astype(np.float64).reshape(24, 32)
+        else:
+            self.frame = self._synthesize(scan)
+
+    """
+    The ambient temperature, the driver subtracts 8 degrees from what the sensor reports
+    """
+    def get_ta(self) -> float:
+        return float(np.median(self.frame)) + 8.0
+
+    def calculate_to(self, emissivity, ta) -> list:
+        return self.frame.flatten().tolist()
+
+    def _synthesize(self, scan):
+        random = self.simulation.rng("thermal", scan)
+        rows, cols = np.mgrid[0:24, 0:32]
+        frame = 21 + random.normal(0, 0.2, (24, 32))
+        for _ in range(1 + scan % 3):
+            row, col = random.uniform(4, 20), random.uniform(4, 28)
+            size = random.uniform(2, 5)
+            frame += random.uniform(5, 15) * np.exp(-((rows - row) ** 2 + (cols - col) ** 2) / (2 * size ** 2))
+        return frame
+
+
+"""
+A single frame returned by the simulated depth camera, mimics the parts of a librealsense frame the driver uses
+"""
+class SimulatedFrame():
+
+    def __init__(self, data):
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+    def __bool__(self):
+        return True
+
+
+"""
+Stand in for the realsense pipeline, frames come from recordings or a synthesized bin floor with food piled on it
+"""
+class SimulatedDepthCamera():
+
+    # Horizontal field of view of the D405 used to project depth frames into point clouds
+    HORIZONTAL_FOV = np.radians(87)
+
+    def __init__(self, simulation: Simulation, width=640, height=480, fps=30):
+        self.simulation = simulation
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.focalLength = width / (2 * np.tan(self.HORIZONTAL_FOV / 2))
+        self.recordings = list(zip(
+            simulation.dataFiles(os.path.join("realsense", "*_depth.npy")),
+            simulation.dataFiles(os.path.join("realsense", "*_color.png")),
+        ))
+
+    """
+    Wait for the next frame and return it
+
+    :return: Tuple of (depth_frame, color_frame)
+    """
+    def grab(self):
+        self.simulation.delay(1 / self.fps)
+        scan = self.simulation.scanCount()
+        if len(self.recordings) > 0:
+            depthPath, colorPath = self.recordings[scan % len(self.recordings)]
+            depth, color = np.load(depthPath).astype(np.uint16), cv2.imread(colorPath)
+        else:
+            depth, color = self._synthesize(scan)
+        return SimulatedFrame(depth), SimulatedFrame(color)
+
+    """
+    Project a depth frame through a pinhole camera model and write the points with their colors as a binary .ply file
+
+    :param fileName: The .ply file to write
+    """
+    def exportPointCloud(self, fileName, depth, color):
+        rows, cols = np.nonzero(depth)
+        z = depth[rows, cols].astype(np.float32) / 1000
+        vertices = np.empty(len(z), dtype=[("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("red", "u1"), ("green", "u1"), ("blue", "u1")])
+        vertices["x"] = (cols - self.width / 2) * z / self.focalLength
+        vertices["y"] = (rows - self.height / 2) * z / self.focalLength
+        vertices["z"] = z
+
+        # Color frames are BGR like the ones opencv writes
+        vertices["red"] = color[rows, cols, 2]
+        vertices["green"] = color[rows, cols, 1]
+        vertices["blue"] = color[rows, cols, 0]
+
+        header = (
+            "ply\nformat binary_little_endian 1.0\n"
+            f"element vertex {len(vertices)}\n"
+            "property float x\nproperty float y\nproperty float z\n"
+            "property uchar red\nproperty uchar green\nproperty uchar blue\n"
+            "end_header\n"
+        )
+        with open(fileName, "wb") as plyFile:
+            plyFile.write(header.encode("ascii"))
+            plyFile.write(vertices.tobytes())
+
+    """
+    A tilted bin floor 45cm from the camera with a mound of food for every scan so far, depth in millimeters and color in BGR
+    """
+    def _synthesize(self, scan):
+        random = self.simulation.rng("realsense", scan)
+        rows, cols = np.mgrid[0:self.height, 0:self.width].astype(np.float32)
+        depth = 450 + 0.02 * rows
+        color = np.empty((self.height, self.width, 3), dtype=np.float32)
+        color[:] = (40, 60, 80)
+
+        for _ in range(min(scan + 1, 8)):
+            row, col = random.uniform(0.2, 0.8) * self.height, random.uniform(0.2, 0.8) * self.width
+            radius = random.uniform(0.05, 0.15) * self.width
+            mound = np.clip(1 - ((rows - row) ** 2 + (cols - col) ** 2) / radius ** 2, 0, None)
+            depth -= random.uniform(20, 80) * mound
+            color += (mound > 0)[..., None] * (random.uniform(-40, 120, 3) - color) * 0.8
+
+        depth += random.normal(0, 1.5, depth.shape)
+        color += random.normal(0, 4, color.shape)
+        return depth.astype(np.uint16), np.clip(color, 0, 255).astype(np.uint8)
+
+
+"""
+Stand in for pyaudio.PyAudio, recordings are fed to the microphone in real time (scaled by the simulation) and playback takes as long as the clip is
+"""
+class SimulatedAudio():
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+        self.recordings = simulation.dataFiles(os.path.join("audio", "*.wav"))
+        self.recordingsPlayed = 0
+
+    def get_format_from_width(self, width):
+        return width
+
+    def get_sample_size(self, format):
+        return format
+
+    def open(self, format, channels, rate, input=False, output=False, stream_callback=None, frames_per_buffer=1024, start=True, **kwargs):
+        stream = SimulatedAudioStream(self, format, channels, rate, input, stream_callback, frames_per_buffer)
+        if start:
+            stream.start_stream()
+        return stream
+
+    def terminate(self):
+        pass
+
+    """
+    Get the next clip the user "says" into the microphone as mono 16 bit samples
+    """
+    def nextRecording(self, rate):
+        index = self.recordingsPlayed
+        self.recordingsPlayed += 1
+        if len(self.recordings) > 0:
+            return readWave(self.recordings[index % len(self.recordings)], rate)
+        return synthesizeSpeech(rate, self.simulation.rng("audio", index))
+
+
+"""
+An input or output stream opened on the SimulatedAudio
+"""
+class SimulatedAudioStream():
+
+    def __init__(self, audio: SimulatedAudio, format, channels, rate, isInput, callback, framesPerBuffer):
+        self.audio = audio
+        self.sampleWidth = format
+        self.channels = channels
+        self.rate = rate
+        self.isInput = isInput
+        self.callback = callback
+        self.framesPerBuffer = framesPerBuffer
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start_stream(self):
+        if self.isInput and (self.thread is None or not self.thread.is_alive()):
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._feed, daemon=True)
+            self.thread.start()
+
+    def stop_stream(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def is_active(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def close(self):
+        self.stop_stream()
+
+    """
+    Playback blocks for as long as the clip would take to play
+    """
+    def write(self, frames):
+        self.audio.simulation.delay(len(frames) / (self.sampleWidth * self.channels * self.rate))
+
+    """
+    Call the stream callback with a period of the next recording at a time until it says it is done, silence follows the recording
+    """
+    def _feed(self):
+        mono = self.audio.nextRecording(self.rate)
+        position = 0
+        while not self.stopped.is_set():
+            period = np.zeros(self.framesPerBuffer, dtype=np.int16)
+            chunk = mono[position:position + self.framesPerBuffer]
+            period[:len(chunk)] = chunk
+            position += self.framesPerBuffer
+
+            self.audio.simulation.delay(self.framesPerBuffer / self.rate)
+            samples = np.repeat(period, self.channels)
+            _, status = self.callback(samples.tobytes(), self.framesPerBuffer, None, 0)
+            if status == CALLBACK_COMPLETE:
+                break
+
+
+"""
+Read a .wav file as mono 16 bit samples at the given rate
+
+:param path: The .wav file to read, it must be 16 bit
+:param rate: The sample rate to resample to
+"""
+def readWave(path, rate) -> np.ndarray:
+    with wave.open(path, "rb") as wf:
+        channels = wf.getnchannels()
+        fileRate = wf.getframerate()
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+
+    mono = samples.reshape(-1, channels).mean(axis=1)
+    if fileRate != rate:
+        positions = np.arange(0, len(mono), fileRate / rate)
+        mono = np.interp(positions, np.arange(len(mono)), mono)
+    return mono.astype(np.int16)
+
+
+"""
+Synthesize something that looks like a short phrase to voice activity detection, a pause, a couple of seconds of voiced sound and then silence
+
+:param rate: The sample rate to generate at
+:param random: The numpy generator used to vary the phrase
+"""
+def synthesizeSpeech(rate, random) -> np.ndarray:
+    pause = np.zeros(int(rate * random.uniform(0.3, 1.0)))
+    duration = random.uniform(1.0, 2.5)
+    t = np.arange(int(rate * duration)) / rate
+
+    # A voiced fundamental with harmonics, amplitude modulated at roughly the rate syllables are spoken
+    pitch = random.uniform(100, 220)
+    voice = sum(np.sin(2 * np.pi * pitch * harmonic * t) / harmonic for harmonic in range(1, 5))
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * 4 * t - np.pi / 2))
+    phrase = 3000 * voice * envelope + random.normal(0, 50, len(t))
+    return np.concatenate((pause, phrase)).astype(np.int16)
+
+
+class SimulatedLidSwitch(LidSwitch):
+    """
+    Lid switch that follows the simulation's lid schedule
+    """
+    def __init__(self, simulation: Simulation, pin=17):
+        self.simulation = simulation
+        super().__init__(pin)
+
+    def initialize(self):
+        logging.info("Simulating hall effect sensor")
+        self.data["initialized"].value = 1
+
+    def readPin(self) -> bool:
+        return self.simulation.lidOpen()
+
+
+class SimulatedLEDDriver(LEDDriver):
+    """
+    LED driver that renders its frames to memory
+    """
+    def __init__(self, simulation: Simulation, isBootFromUpdate, pixel_count=16, frame_rate=10, commandQueue=None):
+        self.simulation = simulation
+        super().__init__(isBootFromUpdate, pixel_count, frame_rate, commandQueue)
+
+    def _openStrip(self, pixel_count):
+        return SimulatedPixelStrip(pixel_count)
+
+
+class SimulatedNAU7802(NAU7802):
+    """
+    Load cell driver that weighs the simulated bin
+    """
+    def __init__(self, simulation: Simulation, calibration_factor=0):
+        self.simulation = simulation
+        super().__init__(calibration_factor)
+
+    def _openLoadCell(self):
+        return SimulatedLoadCell(self.simulation)
+
+    def initialize(self):
+        self.nau.begin()
+        self.nau.setCalibrationFactor(self.calFactor)
+        logging.info("Simulating NAU7802")
+        self.initialized = True
+        self.data["initialized"].value = 1
+
+
+class SimulatedBME688(BME688):
+    """
+    Gas sensor driver that reads the simulated environment and air quality
+    """
+    def __init__(self, simulation: Simulation, historyMinutes=10, historyCapacity=1800):
+        self.simulation = simulation
+        super().__init__(historyMinutes=historyMinutes, historyCapacity=historyCapacity)
+
+    def _openSensor(self, i2c_address):
+        return SimulatedEnvironmentSensor(self.simulation)
+
+    def _loadBSEC(self):
+        return SimulatedBSEC()
+
+    def initialize(self):
+        logging.info("Simulating BME688")
+        self.initialized = True
+        self.data["initialized"].value = 1
+
+    def kill(self):
+        pass
+
+
+class SimulatedMLX90640(MLX90640):
+    """
+    Thermal camera driver that creates heatmaps from simulated temperature matrices
+    """
+    def __init__(self, simulation: Simulation, controllerPipe):
+        self.simulation = simulation
+        super().__init__(controllerPipe)
+
+    def _openCamera(self) -> ThermalCam:
+        return ThermalCam(sensor=SimulatedThermalSensor(self.simulation))
+
+
+class SimulatedRealsenseCam(RealsenseCam):
+    """
+    Depth camera driver that captures simulated depth and color frames
+    """
+    def __init__(self, simulation: Simulation, controllerPipe, width=640, height=480, fps=30):
+        self.simulation = simulation
+        super().__init__(controllerPipe, width, height, fps)
+
+    def _createPipeline(self):
+        self.camera = SimulatedDepthCamera(self.simulation, self.camera_width, self.camera_height, self.framerate)
+
+    def initialize(self):
+        logging.info("Simulating realsense camera")
+        self.initialized = True
+        self.data["initialized"].value = 1
+
+    def grabFrames(self):
+        return self.camera.grab()
+
+    def exportPointCloud(self, fileName, depth_frame, color_frame):
+        self.camera.exportPointCloud(fileName, depth_frame.get_data(), color_frame.get_data())
+
+    def kill(self):
+        pass
+
+
+class SimulatedSoundController(SoundController):
+    """
+    Sound controller whose microphone hears simulated speech and whose speaker plays into the void
+    """
+    def __init__(self, simulation: Simulation, soundControllerConnection, muted, record_duration=4, streamingTranscription=False):
+        self.simulation = simulation
+        super().__init__(
+            soundControllerConnection, muted, record_duration, mixerBackend="fake",
+            streamingTranscription=streamingTranscription, audio=SimulatedAudio(simulation)
+        )
+
+
+class SimulatedBluetoothDriver(BluetoothDriver):
+    """
+    Bluetooth driver that doesn't advertise anything and reports a working internet connection, unless a Replay recorded otherwise
+    """
+
+    # Only the state the rest of the bin reacts to is replayed, the loop lag of the recorded bin means nothing here
+    REPLAYED_FIELDS = ("muted", "wifi_connected", "internet_access")
+
+    def __init__(self, simulation: Simulation, muted):
+        self.simulation = simulation
+        self.lastReplayed = 0.0
+        super().__init__(muted)
+
+    def initialize(self):
+        self.data["muted"].value = self.muted
+        self.data["wifi_connected"].value = 1
+        self.data["internet_access"].value = 1
+        self.loopTime = 1
+        logging.info("Simulating bluetooth driver")
+        self.initialized = True
+        self.data["initialized"].value = 1
+
+    def measure(self):
+        for field, value in self.simulation.recordedData(self.moduleName).items():
+            if field in self.REPLAYED_FIELDS:
+                self.data[field].value = int(value)
+
+        now = self.simulation.elapsed()
+        for event in self.simulation.recordedEvents(self.moduleName, self.lastReplayed, now):
+            if event in self.events:
+                self.getEvent(event).set()
+        self.lastReplayed = now
@@ -5,7 +5,7 @@ Provides a genric wrapper for converting generic drivers into its own driver pro
 """
 
 from multiprocessing import Process
-from time import sleep
+from time import perf_counter, sleep
 
 from drivers.DriverBase import DriverBase
 
@@ -30,7 +30,13 @@ class ThreadedDriver(Process):
         try:
             self.driver.initialize()
             while(self.isRunning):
+                start = perf_counter()
                 self.driver.measure()
+                duration = perf_counter() - start
+
+                self.driver.measureTime.observe(duration)
+                if duration > max(self.driver.overrunThreshold, self.driver.loopTime):
+                    self.driver.loopOverruns.inc()
                 sleep(self.driver.loopTime)
                 
         except KeyboardInterrupt:
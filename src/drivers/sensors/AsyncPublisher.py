@@ -8,13 +8,20 @@ import json
 import logging
 import os
 import uuid
-from multiprocessing import Queue
-from time import sleep
+import zipfile
+from collections import deque
+from multiprocessing import Queue, Value
+from time import time
 from urllib import response
 
 from drivers.DriverBase import DriverBase
-from drivers.sensors.AudioTranscriber import AudioTranscriber
+from drivers.sensors.AudioTranscriber import AudioTranscriber, TranscriptionCache
+from drivers.sensors.LEDDriver import LEDCommand, LEDMode
 from helpers import RequestHandler
+from helpers.AlertNotifier import AlertNotifier, HTTPTransport, SMTPTransport
+from helpers.RetryScheduler import CircuitBreaker, RetryScheduler
+from helpers.ScanBundle import ScanBundle
+from helpers.StorageManager import StorageManager
 
 
 class AsyncPublisher(DriverBase):
@@ -22,20 +29,54 @@ class AsyncPublisher(DriverBase):
     Create a new instance of the async publisher
 
     :param dataQueue: A queue of tuples of (fileNameDict, dataPacketDict)
+    :param commitID: The commit the firmware is currently running
+    :param ledQueue: The LEDDriver command queue used to flash the result of an upload
+    :param storageQuota: The most bytes scans waiting to be uploaded can take up in ../data
+    :param batchBytes: The most bytes of scans sent in a single request when draining a backlog, 0 disables batching
+    :param maxBatchSize: The most scans sent in a single request
+    :param alertTransport: How upload errors are sent to the support team, either "smtp" or "http" to post them to our API
     """
 
-    def __init__(self, dataQueue: Queue, commitID: str):
+    def __init__(self, dataQueue: Queue, commitID: str, ledQueue: Queue = None, storageQuota=1024**3, batchBytes=16 * 1024**2, maxBatchSize=20, alertTransport="smtp"):
         super().__init__("AsyncPublisher")
         self.commitID = commitID
-        self.requests = RequestHandler()
-        self.transcriber = AudioTranscriber()
+        self.ledQueue = ledQueue
+        self.requests = RequestHandler(metrics=self.metrics)
+        self.transcriber = AudioTranscriber(cache=TranscriptionCache())
         self.dataQueue = dataQueue
         self.lastTranscription = ""
-        self.isConnected = True
+
+        # Failed uploads wait here until their backoff is up, nothing is attempted while the breaker is open
+        self.retries = RetryScheduler()
+        self.breaker = CircuitBreaker()
         self.cachedQueue = {}
+        self.storage = StorageManager("../data", storageQuota)
+
+        # Scans deleted to stay within the storage quota that may still be sitting in the data queue
+        self.evictedUids = set()
+
+        # Packets taken off the queue that didn't fit in the last batch
+        self.batchBytes = batchBytes
+        self.maxBatchSize = maxBatchSize
+        self.pendingPackets = deque()
+
+        # Nothing here needs millisecond response times so don't spin while waiting on the queue
+        self.setLoopTime(0.05)
 
-        # Initialize to impossible response code
-        self.lastResponseCode = -255
+        self.queueDepth = self.metrics.gauge("upload_queue_depth", "Scans waiting to be uploaded")
+        self.bytesUploaded = self.metrics.counter("uploaded_bytes_total", "Bytes of scans the server has acknowledged")
+        self.uploadResults = {
+            result: self.metrics.counter("uploads_total", "Upload requests by result", result=result)
+            for result in ("success", "failure")
+        }
+        self.transcriptionTime = self.metrics.histogram("transcription_seconds", "Time taken to transcribe a voice recording before upload")
+
+        # Upload errors are collected and sent as a digest from a background thread
+        if alertTransport == "http":
+            transport = HTTPTransport(lambda: self.requests.apiURL("/api/alerts"), headers=lambda: {"token": self.requests.apiKey})
+        else:
+            transport = SMTPTransport(self.requests.getEmailCredentials)
+        self.alerts = AlertNotifier(transport, serial=self.requests.serial)
 
     """
     Initialize the asynchoronous transcription and request handler
@@ -43,6 +84,7 @@ class AsyncPublisher(DriverBase):
 
     def initialize(self):
         self.data[self.moduleName]["data"]["initialized"].value = 1
+        self.alerts.start()
 
         # Load data that was still waiting to be transmitted last round
         if os.path.exists("../data/cachedData.dat"):
@@ -58,6 +100,11 @@ class AsyncPublisher(DriverBase):
                     loadedData = {}
 
                 self.cachedQueue = loadedData
+
+                # Scans cached before bundles were introduced are packed now so everything after this only has to deal with bundles
+                for uid, entry in self.cachedQueue.items():
+                    entry["fileNames"] = self.bundleFiles(uid, entry["fileNames"])
+                self.enforceStorageQuota()
                 for uid in self.cachedQueue:
                     self.dataQueue.put(
                         (
@@ -69,87 +116,318 @@ class AsyncPublisher(DriverBase):
                     )
 
     def measure(self) -> None:
-        if not self.dataQueue.empty():
-            # Get the uid for this packet, the file names associated with it and the data itself
-            uid, fileNames, data, failedOnce = self.dataQueue.get_nowait()
+        self.breaker.setConnectivity(self.hasInternetAccess())
+        self.queueDepth.set(len(self.cachedQueue) + self.dataQueue.qsize())
 
-            # Update our runtime dictionary of all the data packets that need to be sent
-            self.cachedQueue[uid] = {"fileNames": fileNames, "data": data}
+        if self.hasQueuedPackets():
+            # Get the uid for this packet, the file names associated with it and the data itself
+            uid, fileNames, data, failedOnce = self.nextPacket()
+            fileNames = self.cachePacket(uid, fileNames, data)
+            if fileNames is None:
+                return
 
             # Write them out to our cached data
             with open("../data/cachedData.dat", "w") as file:
                 json.dump(self.cachedQueue, file)
 
-            # If we think we have internet access attempt to transmit the data
-            if self.isConnected:
+            # If we know we are offline hold onto the packet until the breaker lets us try again
+            if self.breaker.isOpen():
+                self.retries.defer(uid, (uid, fileNames, data, failedOnce))
+                return
 
-                # Check if the data collection was triggered by the user or the 2 hour
-                if bool(data["DriverManager"]["data"]["userTrigger"]) == True:
-                    self.lastTranscription = self.transcriber.transcribe(
-                        fileNames["voiceRecording"]
-                    )
+            # The first attempt after the breaker opened is preceded by a cheap heartbeat so a dead link doesn't cost a full upload
+            if self.breaker.isProbing() and not self.requests.sendHeartbeat():
+                self.breaker.recordFailure()
+                self.retries.defer(uid, (uid, fileNames, data, failedOnce))
+                return
 
-                data["SoundController"]["data"][
-                    "TranscribedText"
-                ] = self.lastTranscription
-
-                # If our request succeeded  we don't need the files on device anymore
-                requestSuccess, responseCode, responseStr = (
-                    self.requests.sendAPIRequest(fileNames, data, self.commitID)
-                )
-                if requestSuccess:
-                    # Delete the transmitted files
-                    for key in fileNames.keys():
-                        os.remove(fileNames[key])
-
-                    # Once we transmit the packet with the given unique identifier then we want to delete it from our local list and update the list on the disk
-                    del self.cachedQueue[uid]
-                    with open("../data/cachedData.dat", "w") as file:
-                        json.dump(self.cachedQueue, file)
-
-                    # If our LEDDriver exists in the entry and it has been initialized then we want to flash green, but not if it is in camera mode
-                    if (
-                        "LEDDriver" in self.data
-                        and self.data["LEDDriver"]["data"]["initialized"].value == 1
-                        and not self.data["LEDDriver"]["events"]["CAMERA"][0].is_set()
-                    ):
-                        # If we succsessffully published we want to flash green and then off again
-                        self.data["LEDDriver"]["events"]["DONE"][0].set()
-                        sleep(2)
-                        self.data["LEDDriver"]["events"]["NONE"][0].set()
-                else:
-
-                    # Determine what part of the upload failed and then if so send and email to alert the support team, we only want to send one email per error
-                    if not requestSuccess and responseCode != self.lastResponseCode:
-                        self.requests.sendErrorEmail(responseCode, responseStr)
-                        logging.warn(
-                            "Unsuccessful upload request and email has been sent to the support server"
-                        )
+            self.fillTranscription(fileNames, data)
+
+            # When there is a backlog behind this packet send as much of it as we can in one request
+            if self.batchBytes > 0 and self.hasQueuedPackets() and self.publishBatch(uid, fileNames, data):
+                return
+
+            # If our request succeeded  we don't need the files on device anymore
+            uploadStart = time()
+            requestSuccess, responseCode, responseStr = (
+                self.requests.sendAPIRequest(fileNames, data, self.commitID)
+            )
+            if requestSuccess:
+                self.tracer.record(self.traceId(data), "upload", uploadStart, time())
+                self.uploadResults["success"].inc()
+                self.bytesUploaded.inc(self.storage.scanBytes(fileNames))
+
+                # Delete the transmitted files
+                self.storage.deleteFiles(fileNames)
+
+                # Once we transmit the packet with the given unique identifier then we want to delete it from our local list and update the list on the disk
+                del self.cachedQueue[uid]
+                with open("../data/cachedData.dat", "w") as file:
+                    json.dump(self.cachedQueue, file)
+                self.updateStorageMetrics()
+                self.retries.success(uid)
+                self.breaker.recordSuccess()
+
+                # If we succsessffully published we want to flash green and then off again
+                self.flashLEDs(LEDMode.DONE)
+            else:
+                self.handleUploadFailure(responseCode, responseStr)
+
+                # Since our connection failed we want to schedule the packet to be retransmitted once its backoff is up
+                self.retries.retry(uid, (uid, fileNames, data, True))
+
+    """
+    Check if there are any packets waiting to be published
+    """
+
+    def hasQueuedPackets(self) -> bool:
+        if not self.dataQueue.empty():
+            return True
+        return not self.breaker.isOpen() and (len(self.pendingPackets) > 0 or self.retries.hasDue())
+
+    """
+    Get the next packet to publish, packets that didn't fit in the last batch go first followed by retries that are due and finally new packets
+    """
+
+    def nextPacket(self):
+        if not self.breaker.isOpen():
+            if len(self.pendingPackets) > 0:
+                return self.pendingPackets.popleft()
+            if self.retries.hasDue():
+                return self.retries.popDue()
+        return self.dataQueue.get_nowait()
+
+    """
+    Get whether the BluetoothDriver thinks we have internet access, None if it hasn't checked yet
+    """
+
+    def hasInternetAccess(self):
+        if "BluetoothDriver" not in self.data or "internet_access" not in self.data["BluetoothDriver"]["data"]:
+            return None
+        state = self.data["BluetoothDriver"]["data"]["internet_access"].value
+        return None if state < 0 else bool(state)
+
+    """
+    Add a packet to our cache of packets waiting to be sent bundling its files if it is new
+
+    :param protectedUids: Other scans that are about to be uploaded and must not be deleted to make room
+    :return: The file names to use for the packet or None if it was deleted to free up space while it was waiting in the queue
+    """
+
+    def cachePacket(self, uid, fileNames, data, protectedUids=()):
+        if uid in self.evictedUids:
+            self.evictedUids.discard(uid)
+            return None
+
+        # Update our runtime dictionary of all the data packets that need to be sent, keeping any changes the storage manager made to existing ones
+        isNewPacket = uid not in self.cachedQueue
+        if isNewPacket:
+            fileNames = self.bundleFiles(uid, fileNames)
+        entry = self.cachedQueue.setdefault(uid, {"fileNames": fileNames})
+        entry["data"] = data
+        if isNewPacket:
+            self.enforceStorageQuota(protectedUids=(uid, *protectedUids))
+        return entry["fileNames"]
+
+    """
+    Fill in the transcription of a packet before it is uploaded
+    """
+
+    def fillTranscription(self, fileNames, data):
+        # Check if the data collection was triggered by the user or the 2 hour, if it was already transcribed while recording we can skip it
+        if bool(data["DriverManager"]["data"]["userTrigger"]) == True:
+            if len(data["SoundController"]["data"]["TranscribedText"]) > 0:
+                self.lastTranscription = data["SoundController"]["data"]["TranscribedText"]
+            else:
+                with self.transcriptionTime.time(), self.tracer.span("transcribe", self.traceId(data)):
+                    self.lastTranscription = self.transcribeRecording(fileNames)
+
+        data["SoundController"]["data"][
+            "TranscribedText"
+        ] = self.lastTranscription
+
+    """
+    Get the trace a packet was collected under, packets cached before tracing was added don't have one
+    """
+
+    def traceId(self, data) -> str:
+        return data["DriverManager"]["data"].get("traceId", "")
+
+    """
+    Upload the given packet along with as many queued packets as fit within our batch size in a single request,
+    any scans the server doesn't acknowledge are queued up to be sent again
+
+    :param uid: The unique identifier of the packet that was already taken off the queue
+    :param fileNames: The file names of that packet
+    :param data: The data of that packet
+    :return: False if no other packets fit in the batch and the given packet should be sent on its own
+    """
 
-                    # We failed to upload so we want to flash red on and offf
-                    if (
-                        "LEDDriver" in self.data
-                        and self.data["LEDDriver"]["data"]["initialized"] == 1
-                        and not self.data["LEDDriver"]["events"]["CAMERA"][0].is_set()
-                    ):
-                        # If we succsessffully published we want to flash green and then off again
-                        self.data["LEDDriver"]["events"]["ERROR"][0].set()
-                        sleep(2)
-                        self.data["LEDDriver"]["events"]["NONE"][0].set()
-
-                    # Since we failed to upload our data we want to check if we can access the API at all if not then we know we have disconnected and as such
-                    self.isConnected = self.requests.sendHeartbeat()
-
-                    # Since our connection failed we want to put the data we popped from the queue back in so that it will be retransmitted at some point
-                    self.dataQueue.put((uid, fileNames, data, True))
-
-                # Set the response code that came through last
-                self.lastResponseCode = responseCode
-
-            # If we aren't connected we want to push the data back into the queue that we popped off last and then attempt to ping the server for a connection
-            elif not self.isConnected:
-                # Since our connection failed we want to put the data we popped from the queue back in so that it will be retransmitted at some point
-                self.dataQueue.put((uid, fileNames, data, True))
-                self.isConnected = self.requests.sendHeartbeat()
-                sleep(1)
+    def publishBatch(self, uid, fileNames, data):
+        batch = [(uid, fileNames, data)]
+        totalBytes = self.storage.scanBytes(fileNames)
+
+        while self.hasQueuedPackets() and len(batch) < self.maxBatchSize:
+            nextUid, nextFileNames, nextData, failedOnce = self.nextPacket()
+            nextFileNames = self.cachePacket(nextUid, nextFileNames, nextData, protectedUids=[packet[0] for packet in batch])
+            if nextFileNames is None:
+                continue
+
+            # Save the packet that doesn't fit for the start of the next batch so the order of the backlog is kept
+            scanBytes = self.storage.scanBytes(nextFileNames)
+            if totalBytes + scanBytes > self.batchBytes:
+                self.pendingPackets.appendleft((nextUid, nextFileNames, nextData, failedOnce))
+                break
+
+            self.fillTranscription(nextFileNames, nextData)
+            batch.append((nextUid, nextFileNames, nextData))
+            totalBytes += scanBytes
+
+        with open("../data/cachedData.dat", "w") as file:
+            json.dump(self.cachedQueue, file)
+
+        # Nothing else fit so just send this packet on its own
+        if len(batch) == 1:
+            return False
+
+        logging.info(f"Uploading a batch of {len(batch)} scans totalling {totalBytes} bytes")
+        uploadStart = time()
+        ackedUids, responseCode, responseStr = self.requests.sendBatchRequest(batch, self.commitID)
+        uploadEnd = time()
+
+        # Servers that don't support batches get the scans one at a time from now on
+        if responseCode in (404, 405):
+            logging.warning("Server does not support batch uploads, falling back to single uploads")
+            self.batchBytes = 0
+
+        acked = set(ackedUids)
+        if len(acked) > 0:
+            self.uploadResults["success"].inc()
+        for batchUid, batchFileNames, batchData in batch:
+            if batchUid in acked:
+                self.tracer.record(self.traceId(batchData), "upload", uploadStart, uploadEnd)
+                self.bytesUploaded.inc(self.storage.scanBytes(batchFileNames))
+                self.storage.deleteFiles(batchFileNames)
+                self.cachedQueue.pop(batchUid, None)
+                self.retries.success(batchUid)
+            elif self.batchBytes == 0:
+                self.retries.defer(batchUid, (batchUid, batchFileNames, batchData, True))
+            else:
+                self.retries.retry(batchUid, (batchUid, batchFileNames, batchData, True))
+
+        with open("../data/cachedData.dat", "w") as file:
+            json.dump(self.cachedQueue, file)
+        self.updateStorageMetrics()
+
+        if len(acked) > 0:
+            self.breaker.recordSuccess()
+            self.flashLEDs(LEDMode.DONE)
+        elif self.batchBytes > 0:
+            self.handleUploadFailure(responseCode, responseStr)
+        return True
+
+    """
+    Alert the support team about a failed upload and let the circuit breaker know
+
+    :param responseCode: The code that was returned from the request
+    :param responseStr: The response or error that was returned by the request
+    """
+
+    def handleUploadFailure(self, responseCode, responseStr):
+        self.uploadResults["failure"].inc()
+
+        # Queue the error for the support team, repeats are grouped together and sent in the next digest
+        self.alerts.report(responseCode, responseStr)
+        logging.warning(f"Unsuccessful upload request with response code {responseCode}")
+
+        # We failed to upload so we want to flash red on and offf
+        self.flashLEDs(LEDMode.ERROR)
+
+        # Enough failures in a row open the breaker so we stop trying until the connection comes back
+        self.breaker.recordFailure()
+
+    """
+    Send any alerts that are still waiting before we exit
+    """
+
+    def kill(self):
+        self.alerts.stop()
+
+    """
+    Flash the LEDs for a couple seconds and then turn them off, the LEDDriver won't let this interrupt the camera
+
+    :param mode: The pattern to flash
+    """
+
+    def flashLEDs(self, mode):
+        if (
+            self.ledQueue is not None
+            and "LEDDriver" in self.data
+            and self.data["LEDDriver"]["data"]["initialized"].value == 1
+        ):
+            self.ledQueue.put(LEDCommand(mode, duration=2, priority=1, revertTo=LEDMode.NONE))
+
+    """
+    Pack the loose files of a scan into a single bundle, if packing fails the loose files are kept and uploaded as they are
+
+    :param uid: The unique identifier of the scan
+    :param fileNames: Dictionary of artifact name to file path
+    :return: The dictionary of file names that should be used for this scan from now on
+    """
+
+    def bundleFiles(self, uid, fileNames: dict) -> dict:
+        if ScanBundle.isBundle(fileNames):
+            return fileNames
+        try:
+            return {"bundle": ScanBundle.create(uid, fileNames).path}
+        except (OSError, zipfile.BadZipFile) as e:
+            logging.error(f"Failed to bundle scan {uid}: {e}")
+            return fileNames
+
+    """
+    Transcribe the voice recording of a scan whether it is a loose file or packed in a bundle
+    """
+
+    def transcribeRecording(self, fileNames: dict) -> str:
+        if not ScanBundle.isBundle(fileNames):
+            return self.transcriber.transcribe(fileNames["voiceRecording"])
+
+        bundle = ScanBundle(fileNames["bundle"])
+        try:
+            with bundle.extracted("voiceRecording") as recording:
+                return self.transcriber.transcribe(recording)
+        except (KeyError, OSError, zipfile.BadZipFile) as e:
+            logging.error(f"Failed to read voice recording from bundle: {e}")
+            return ""
+
+    """
+    Degrade or delete the oldest scans if we are using more than our storage quota
+
+    :param protectedUids: Scans that should never be deleted outright
+    """
+
+    def enforceStorageQuota(self, protectedUids=()):
+        evicted = self.storage.enforce(self.cachedQueue, protectedUids)
+        self.evictedUids.update(evicted)
+        self.updateStorageMetrics()
+
+    """
+    Publish how much space the scans waiting to be uploaded are using
+    """
+
+    def updateStorageMetrics(self):
+        usage = self.storage.usage(self.cachedQueue)
+        self.data[self.moduleName]["data"]["storage_bytes"].value = usage["totalBytes"]
+        self.data[self.moduleName]["data"]["stored_scans"].value = usage["scanCount"]
+
+    """
+    Add storage usage metrics to our data dictionary
+    """
 
+    def createDataDict(self):
+        self.data = {
+            "storage_bytes": Value("d", 0.0),
+            "stored_scans": Value("i", 0),
+            "initialized": Value("i", 0),
+        }
+        return self.data
@@ -0,0 +1,268 @@
+"""
+Oregon State University, 2024
+
+Provides a resident handle to the ALSA mixer so mute and capture controls can be toggled without spawning amixer every time
+"""
+
+import logging
+import os
+import subprocess
+import threading
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+
+"""
+Toggles mixer controls through pyalsaaudio, one Mixer object is kept open per control
+"""
+class AlsaMixerBackend():
+
+    """
+    :param card: The ALSA card number the controls belong to
+    """
+    def __init__(self, card):
+        self.card = card
+        self.handles = {}
+
+    def _getHandle(self, control):
+        if control not in self.handles:
+            self.handles[control] = alsaaudio.Mixer(control, cardindex=self.card)
+        return self.handles[control]
+
+    def setMuted(self, control, muted):
+        self._getHandle(control).setmute(int(muted))
+
+    def setCapture(self, control, enabled):
+        self._getHandle(control).setrec(int(enabled))
+
+    # Every call is applied before it returns and raises if it failed
+    def flush(self):
+        return True
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+
+
+"""
+Toggles mixer controls by writing commands to a single long lived `amixer -s` proccess, commands are applied in the background so call flush() to know they succeeded
+"""
+class AmixerSessionBackend():
+
+    """
+    :param card: The ALSA card number the controls belong to
+    """
+    def __init__(self, card):
+        self.card = card
+        self.process = None
+        self.errorReader = None
+        self.errors = []
+
+    def _send(self, command):
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(
+                ["/usr/bin/amixer", "-q", "-c", str(self.card), "-s"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            self.errorReader = threading.Thread(target=self._readErrors, args=(self.process,), daemon=True)
+            self.errorReader.start()
+        self.process.stdin.write(command + "\n")
+        self.process.stdin.flush()
+
+    # amixer carries on after a command fails so its errors are only seen by reading them as they come
+    def _readErrors(self, process):
+        for line in process.stderr:
+            if len(line.strip()) > 0:
+                logging.error(f"Mixer command failed: {line.strip()}")
+                self.errors.append(line.strip())
+
+    def setMuted(self, control, muted):
+        self._send(f"sset {control} {'mute' if muted else 'unmute'}")
+
+    def setCapture(self, control, enabled):
+        self._send(f"sset {control} {'cap' if enabled else 'nocap'}")
+
+    """
+    Wait for amixer to apply every command sent so far by ending the session, the next toggle starts a new one
+
+    :return: True if every command was applied without an error
+    """
+    def flush(self):
+        returnCode = 0
+        if self.process is not None:
+            self.process.stdin.close()
+            returnCode = self.process.wait()
+            self.errorReader.join()
+            self.process = None
+
+        succeeded = returnCode == 0 and len(self.errors) == 0
+        self.errors = []
+        return succeeded
+
+    def close(self):
+        self.flush()
+
+
+"""
+In memory stand in for a mixer so sound code can run without any audio hardware
+"""
+class FakeMixerBackend():
+
+    def __init__(self, card=0):
+        self.card = card
+        self.muted = {}
+        self.capture = {}
+        self.toggles = 0
+
+    def setMuted(self, control, muted):
+        self.muted[control] = bool(muted)
+        self.toggles += 1
+
+    def setCapture(self, control, enabled):
+        self.capture[control] = bool(enabled)
+        self.toggles += 1
+
+    def flush(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class AudioMixer():
+
+    """
+    Create a new mixer, nothing is opened until open() is called so this can be constructed before the sound proccess is spawned
+
+    :param backend: One of "alsa", "amixer" or "fake", None picks alsa if pyalsaaudio is installed and amixer otherwise
+    :param control: The control used to find the sound card the waveshare adapter is on
+    :param maxCards: How many card numbers to probe before giving up
+    """
+    def __init__(self, backend=None, control="Mic", maxCards=8):
+        if backend is None:
+            backend = "alsa" if alsaaudio is not None else "amixer"
+        self.backendName = backend
+        self.control = control
+        self.maxCards = maxCards
+        self.card = None
+        self.backend = None
+
+    """
+    Find the sound card once and open the backend that will be used for every toggle afterwards
+    """
+    def open(self):
+        if self.backendName == "fake":
+            self.card = 0
+            self.backend = FakeMixerBackend(self.card)
+            return True
+
+        # Without pyalsaaudio findCard falls back to amixer and every toggle would fail later on
+        if self.backendName == "alsa" and alsaaudio is None:
+            logging.error("pyalsaaudio is not installed, unable to open the alsa mixer")
+            return False
+
+        self.card = self.findCard()
+        if self.card is None:
+            logging.error(f"Failed to find a sound card with a {self.control} control")
+            return False
+
+        if self.backendName == "alsa":
+            self.backend = AlsaMixerBackend(self.card)
+        else:
+            self.backend = AmixerSessionBackend(self.card)
+        logging.info(f"Using {self.backendName} mixer on sound card {self.card}")
+        return True
+
+    """
+    Determine which sound card has our control on it
+    """
+    def findCard(self):
+        if alsaaudio is not None:
+            for card in alsaaudio.card_indexes():
+                if self.control in alsaaudio.mixers(cardindex=card):
+                    return card
+            return None
+
+        with open(os.devnull, "wb") as devnull:
+            for card in range(self.maxCards):
+                try:
+                    returnCode = subprocess.call(
+                        ["/usr/bin/amixer", "-c", str(card), "sget", self.control],
+                        stdout=devnull,
+                        stderr=subprocess.STDOUT,
+                    )
+                except OSError as e:
+                    logging.error(f"Unable to run amixer: {e}")
+                    return None
+                if returnCode == 0:
+                    return card
+        return None
+
+    """
+    Mute or unmute a given control, failures are logged rather than raised so audio problems don't take down the proccess
+
+    :param control: The name of the mixer control such as Mic or Speaker
+    :param muted: Whether or not the control should be muted
+    """
+    def setMuted(self, control, muted):
+        if self.backend is None:
+            logging.warning(f"Mixer not open, unable to set {control} mute state")
+            return False
+        try:
+            self.backend.setMuted(control, muted)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to set {control} mute state: {e}")
+            return False
+
+    """
+    Enable or disable capture on a given control
+
+    :param control: The name of the mixer control
+    :param enabled: Whether or not capture should be enabled
+    """
+    def setCapture(self, control, enabled):
+        if self.backend is None:
+            logging.warning(f"Mixer not open, unable to set {control} capture state")
+            return False
+        try:
+            self.backend.setCapture(control, enabled)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to set {control} capture state: {e}")
+            return False
+
+    """
+    Wait until every toggle so far has been applied, the amixer backend only reports a failed toggle once amixer has processed it
+
+    :return: True if every toggle was applied
+    """
+    def flush(self):
+        if self.backend is None:
+            return False
+        try:
+            return self.backend.flush()
+        except Exception as e:
+            logging.error(f"Failed to apply mixer changes: {e}")
+            return False
+
+    def mute(self, control):
+        return self.setMuted(control, True)
+
+    def unmute(self, control):
+        return self.setMuted(control, False)
+
+    """
+    Release the mixer handles
+    """
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
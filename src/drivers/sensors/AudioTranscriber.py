@@ -3,17 +3,150 @@ Will Richards, Oregon State University, 2024
 
 Abstraction layer for automated speech recognition (ASR) of recorded audio
 """
-import subprocess
+import hashlib
+import io
+import json
 import logging
-from time import time
+import os
+import queue
+import subprocess
+import threading
+import wave
+from collections import OrderedDict
+from time import sleep, time
+
+import httpx
+import numpy as np
+
+# Where the model chosen by tests.whisperBenchmark is stored
+TRANSCRIBER_CONFIG_FILE = "../data/transcriber.json"
+TRANSCRIPTION_CACHE_FILE = "../data/transcriptionCache.json"
+DEFAULT_MODEL = "small.en"
+
+"""
+Load the whisper model and thread count to use, falling back to the default model and every core when no benchmark has been run
+
+:param file: The JSON file the selection was written to
+"""
+def loadTranscriberConfig(file=TRANSCRIBER_CONFIG_FILE) -> dict:
+    config = {"model": DEFAULT_MODEL, "threads": os.cpu_count() or 4}
+    if os.path.exists(file):
+        try:
+            with open(file, "r") as inFile:
+                config.update(json.load(inFile))
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Failed to load transcriber config: {e}")
+    return config
+
+"""
+Persistent least recently used cache of transcriptions keyed by the hash of the audio and the model that transcribed it
+"""
+class TranscriptionCache():
+
+    """
+    :param file: The JSON file the cache is persisted to
+    :param maxEntries: The most transcriptions that will be kept
+    :param maxBytes: The most bytes of transcribed text that will be kept
+    """
+    def __init__(self, file=TRANSCRIPTION_CACHE_FILE, maxEntries=256, maxBytes=256 * 1024):
+        self.file = file
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.totalBytes = 0
+        self._load()
+
+    """
+    Build the cache key for an audio file transcribed with a given model
+
+    :param inputFile: The .wav file that will be transcribed
+    :param model: The model used to transcribe it
+    """
+    def key(self, inputFile, model) -> str:
+        digest = hashlib.sha256()
+        with open(inputFile, "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                digest.update(block)
+        return f"{digest.hexdigest()}:{model}"
+
+    """
+    Get a cached transcription marking it as recently used, None if it isn't cached
+    """
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    """
+    Store a transcription evicting the least recently used ones until we are back within our bounds
+    """
+    def put(self, key, text):
+        if key in self.entries:
+            self.totalBytes -= len(self.entries.pop(key).encode("utf-8"))
+        self.entries[key] = text
+        self.totalBytes += len(text.encode("utf-8"))
+
+        while len(self.entries) > self.maxEntries or (self.totalBytes > self.maxBytes and len(self.entries) > 1):
+            _, evicted = self.entries.popitem(last=False)
+            self.totalBytes -= len(evicted.encode("utf-8"))
+        self._save()
+
+    """
+    Load the cache from the disk, a missing or corrupt file just starts an empty cache
+    """
+    def _load(self):
+        if not os.path.exists(self.file):
+            return
+        try:
+            with open(self.file, "r") as inFile:
+                self.entries = OrderedDict(json.load(inFile))
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Failed to load transcription cache: {e}")
+            self.entries = OrderedDict()
+        self.totalBytes = sum(len(text.encode("utf-8")) for text in self.entries.values())
+
+    """
+    Write the cache to a temporary file and move it into place so a power loss can't leave it half written
+    """
+    def _save(self):
+        tempFile = self.file + ".tmp"
+        try:
+            with open(tempFile, "w") as outFile:
+                json.dump(list(self.entries.items()), outFile)
+            os.replace(tempFile, self.file)
+        except OSError as e:
+            logging.error(f"Failed to save transcription cache: {e}")
 
 class AudioTranscriber():
-    def __init__(self, model="small.en"):
-        self.modelPath = f"../whisper.cpp/models/ggml-{model}.bin"
+
+    """
+    :param model: The ggml model to use such as small.en or base.en-q5_0, None uses the benchmarked selection
+    :param threads: How many threads whisper should use, None uses the benchmarked selection
+    :param cache: The TranscriptionCache to reuse results from, None disables caching
+    """
+    def __init__(self, model=None, threads=None, cache=None):
+        config = loadTranscriberConfig()
+        self.model = model if model is not None else config["model"]
+        self.threads = threads if threads is not None else config["threads"]
+        self.modelPath = f"../whisper.cpp/models/ggml-{self.model}.bin"
+        self.cache = cache
 
     def transcribe(self, inputFile: str):
+        # Packets that failed to upload come back through here on every retry so reuse the result if we have already transcribed this audio
+        cacheKey = None
+        if self.cache is not None:
+            try:
+                cacheKey = self.cache.key(inputFile, self.model)
+            except OSError as e:
+                logging.error(f"Failed to hash audio file: {e}")
+            cached = self.cache.get(cacheKey) if cacheKey is not None else None
+            if cached is not None:
+                logging.info("Using cached transcription")
+                return cached
+
         start_time = time()
-        full_command = f"../whisper.cpp/main -m {self.modelPath} -f {inputFile} -np -nt"
+        full_command = f"../whisper.cpp/main -m {self.modelPath} -t {self.threads} -f {inputFile} -np -nt"
         process = subprocess.Popen(full_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # Get the output and error (if any)
         output, error = process.communicate()
@@ -27,5 +160,182 @@ class AudioTranscriber():
         end_time = time()
         logging.info(f"Transcription took: {end_time - start_time} seconds")
 
+        if cacheKey is not None and process.returncode == 0:
+            self.cache.put(cacheKey, processed_str)
+
         return processed_str
-        
\ No newline at end of file
+
+
+"""
+Transcribes audio while it is still being recorded by sending each phrase to a resident whisper.cpp server as soon as the speaker pauses
+"""
+class StreamingTranscriber():
+
+    """
+    Create a new streaming transcriber, the server isn't started until start() is called
+
+    :param model: The ggml model the server should load, None uses the benchmarked selection
+    :param host: The address the whisper.cpp server listens on
+    :param port: The port the whisper.cpp server listens on
+    :param chunkSeconds: The minimum amount of audio collected before a chunk is transcribed at the next pause
+    :param sampleRate: The sample rate of the audio being fed in
+    """
+    def __init__(self, model=None, host="127.0.0.1", port=8178, chunkSeconds=2.0, sampleRate=16000):
+        config = loadTranscriberConfig()
+        self.model = model if model is not None else config["model"]
+        self.threads = config["threads"]
+        self.modelPath = f"../whisper.cpp/models/ggml-{self.model}.bin"
+        self.host = host
+        self.port = port
+        self.chunkSamples = int(chunkSeconds * sampleRate)
+        self.sampleRate = sampleRate
+        self.serverProcess = None
+        self.frameQueue = queue.Queue()
+        self.worker = None
+        self.segments = []
+
+    """
+    Launch the whisper.cpp server so the model stays loaded between recordings
+    """
+    def start(self, timeout=60):
+        if self._isServerUp():
+            return True
+
+        self.serverProcess = subprocess.Popen(
+            ["../whisper.cpp/server", "-m", self.modelPath, "-t", str(self.threads), "--host", self.host, "--port", str(self.port), "-nt"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        # Wait for the model to load before we report that we are ready
+        deadline = time() + timeout
+        while time() < deadline:
+            if self._isServerUp():
+                logging.info("Whisper server started")
+                return True
+            if self.serverProcess.poll() is not None:
+                break
+            sleep(0.5)
+
+        # Don't leave a server still loading the model behind to fight the next attempt for memory and the port
+        logging.error("Failed to start whisper server")
+        if self.serverProcess.poll() is None:
+            self.serverProcess.terminate()
+            try:
+                self.serverProcess.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.serverProcess.kill()
+                self.serverProcess.wait()
+        self.serverProcess = None
+        return False
+
+    """
+    Start collecting audio for a new recording
+    """
+    def begin(self):
+        self.segments = []
+        self.frameQueue = queue.Queue()
+        self.worker = threading.Thread(target=self._transcribeLoop, daemon=True)
+        self.worker.start()
+
+    """
+    Hand a period of audio to the transcriber, this is called from the capture callback so it must never block
+
+    :param samples: Mono 16 bit samples
+    :param isSpeech: Whether the voice activity detection thought this period contained speech
+    """
+    def feed(self, samples, isSpeech):
+        self.frameQueue.put((samples.copy(), isSpeech))
+
+    """
+    Wait for the remaining audio to be transcribed and return the full transcription
+
+    :param timeout: How long in seconds to wait for the last chunk
+    """
+    def finish(self, timeout=30) -> str:
+        if self.worker is None:
+            return ""
+
+        self.frameQueue.put(None)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            logging.error("Timed out waiting for streaming transcription")
+        self.worker = None
+        return " ".join(self.segments).strip()
+
+    """
+    Shut the whisper server down
+    """
+    def stop(self):
+        if self.serverProcess is not None:
+            self.serverProcess.terminate()
+            self.serverProcess.wait()
+            self.serverProcess = None
+
+    """
+    Collect fed audio and transcribe it a chunk at a time, chunks are cut at pauses so words aren't split in half
+    """
+    def _transcribeLoop(self):
+        pending = []
+        pendingSamples = 0
+        pendingHasSpeech = False
+
+        while True:
+            item = self.frameQueue.get()
+            if item is None:
+                break
+
+            samples, isSpeech = item
+            pending.append(samples)
+            pendingSamples += len(samples)
+            pendingHasSpeech = pendingHasSpeech or isSpeech
+
+            if pendingSamples >= self.chunkSamples and not isSpeech:
+                if pendingHasSpeech:
+                    self._transcribeChunk(np.concatenate(pending))
+                pending = []
+                pendingSamples = 0
+                pendingHasSpeech = False
+
+        if pendingHasSpeech:
+            self._transcribeChunk(np.concatenate(pending))
+
+    """
+    Send a chunk of audio to the whisper server and store the text that comes back
+
+    :param samples: Mono 16 bit samples to transcribe
+    """
+    def _transcribeChunk(self, samples):
+        startTime = time()
+        wavFile = io.BytesIO()
+        with wave.open(wavFile, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(self.sampleRate)
+            wf.writeframes(samples.astype(np.int16).tobytes())
+
+        try:
+            response = httpx.post(
+                f"http://{self.host}:{self.port}/inference",
+                files={"file": ("chunk.wav", wavFile.getvalue(), "audio/wav")},
+                data={"response_format": "json", "temperature": "0.0"},
+                timeout=30,
+            )
+            text = response.json()["text"].replace("[BLANK_AUDIO]", "").strip()
+        except Exception as e:
+            logging.error(f"Failed to transcribe audio chunk: {e}")
+            return
+
+        if len(text) > 0:
+            self.segments.append(text)
+        logging.info(f"Transcribed {len(samples) / self.sampleRate:.1f}s chunk in {time() - startTime:.2f} seconds")
+
+    """
+    Check if the whisper server is accepting requests
+    """
+    def _isServerUp(self) -> bool:
+        try:
+            httpx.get(f"http://{self.host}:{self.port}/", timeout=1)
+            return True
+        except httpx.HTTPError:
+            return False
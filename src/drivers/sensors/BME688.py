@@ -4,16 +4,120 @@ Will Richards, Oregon State University, 2023
 Abstraction layer for the BME688 gas sensor
 """
 
-import bme680
-
 import logging
 from time import  time
 import os
 from ctypes import *
 
+import numpy as np
 
 from drivers.DriverBase import DriverBase
-from multiprocessing import Event, Value
+from multiprocessing import Array, Event, Value
+
+try:
+    import bme680
+except ImportError:
+    bme680 = None
+
+"""
+Fixed size ring buffer of timestamped environmental readings kept in shared memory so any proccess can compute windowed aggregates
+"""
+class EnvironmentHistory():
+
+    # Readings that are stored in every row of the buffer after the timestamp
+    FIELDS = ("temperature(c)", "humidity(%rh)", "pressure(kpa)", "gas_resistance(ohms)", "iaq", "CO2-eq", "bVOC-eq")
+
+    """
+    Create a new history buffer, this must be created before the driver proccess is spawned so the memory is shared
+
+    :param capacity: The maximum number of readings that will be held before the oldest are overwritten
+    :param windowSeconds: The default length of time in seconds that aggregates are computed over
+    """
+    def __init__(self, capacity=1800, windowSeconds=600):
+        self.capacity = capacity
+        self.windowSeconds = windowSeconds
+        self.rowSize = len(self.FIELDS) + 1
+
+        # Flat array of rows formatted as [timestamp, *FIELDS], head is the next row that will be written
+        self._buffer = Array('d', capacity * self.rowSize)
+        self._head = Value('i', 0, lock=False)
+        self._count = Value('i', 0, lock=False)
+
+    """
+    Add a new reading to the buffer overwriting the oldest if we are full
+
+    :param timestamp: The time the reading was taken at
+    :param readings: Dictionary containing a value for each of the FIELDS
+    """
+    def append(self, timestamp, readings: dict):
+        row = [timestamp] + [float(readings[field]) for field in self.FIELDS]
+        with self._buffer.get_lock():
+            start = self._head.value * self.rowSize
+            self._buffer[start:start + self.rowSize] = row
+            self._head.value = (self._head.value + 1) % self.capacity
+            self._count.value = min(self._count.value + 1, self.capacity)
+
+    """
+    Copy the stored readings out of shared memory in chronological order
+
+    :return: A (count, rowSize) array where the first column is the timestamp
+    """
+    def snapshot(self) -> np.ndarray:
+        with self._buffer.get_lock():
+            rows = np.frombuffer(self._buffer.get_obj(), dtype=np.float64).reshape(self.capacity, self.rowSize)
+            count = self._count.value
+            head = self._head.value
+            if count < self.capacity:
+                return rows[:count].copy()
+            return np.roll(rows, -head, axis=0)
+
+    """
+    Compute the min, max, mean and slope (per minute) of every field over the most recent window
+
+    :param windowSeconds: How far back from the most recent reading to aggregate, defaults to the buffer's window
+    :return: Dictionary of field names to their aggregates along with the number of samples used
+    """
+    def aggregate(self, windowSeconds=None) -> dict:
+        if windowSeconds is None:
+            windowSeconds = self.windowSeconds
+
+        rows = self.snapshot()
+        if len(rows) > 0:
+            rows = rows[rows[:, 0] >= rows[-1, 0] - windowSeconds]
+
+        result = {"window(s)": windowSeconds, "samples": len(rows)}
+        if len(rows) == 0:
+            for field in self.FIELDS:
+                result[field] = {"min": None, "max": None, "mean": None, "slope": None}
+            return result
+
+        # Least squares slope of every column at once against time in minutes
+        minutes = (rows[:, 0] - rows[0, 0]) / 60.0
+        values = rows[:, 1:]
+        centered = minutes - minutes.mean()
+        denominator = np.sum(centered ** 2)
+        if denominator > 0:
+            slopes = (centered @ (values - values.mean(axis=0))) / denominator
+        else:
+            slopes = np.zeros(len(self.FIELDS))
+
+        mins = values.min(axis=0)
+        maxs = values.max(axis=0)
+        means = values.mean(axis=0)
+        for i, field in enumerate(self.FIELDS):
+            result[field] = {
+                "min": float(mins[i]),
+                "max": float(maxs[i]),
+                "mean": float(means[i]),
+                "slope": float(slopes[i])
+            }
+        return result
+
+    """
+    Called when the driver data is converted to JSON so each scan carries the aggregates
+    """
+    def toJSON(self) -> dict:
+        return self.aggregate()
 
 class BME688(DriverBase):
 
@@ -21,30 +125,47 @@ class BME688(DriverBase):
     Basic constructor for the BME688
 
     :param i2c_address: The given I2C address this device is registered with
+    :param historyMinutes: The length of the window in minutes that aggregates are reported over in each scan
+    :param historyCapacity: The number of readings held in the history ring buffer
     """
-    def __init__(self, i2c_address = 0x77):
+    def __init__(self, i2c_address = 0x77, historyMinutes = 10, historyCapacity = 1800):
         super().__init__("BME688")
+        self.history = EnvironmentHistory(historyCapacity, historyMinutes * 60)
 
         self.failedToInit = False
         try:
-            self.sensor = bme680.BME680(i2c_address)
+            self.sensor = self._openSensor(i2c_address)
         except RuntimeError as e:
             logging.error(f"An error occured intializing BME680: {e}")
             self.failedToInit = True
 
-        script_dir = os.path.abspath(os.path.dirname(__file__))
-        lib_path = os.path.join(script_dir, "bsec_python.so")
-        self.functions = cdll.LoadLibrary(lib_path)
+        self.functions = self._loadBSEC()
 
         # Set this proccess to loop once a second
         self.setLoopTime(1)
 
+        self.startTime = time()
+
+
+    """
+    Connect to the BME688 over I2C
+
+    :param i2c_address: The given I2C address this device is registered with
+    """
+    def _openSensor(self, i2c_address):
+        return bme680.BME680(i2c_address)
+
+    """
+    Load the Bosch BSEC library that turns raw readings into air quality estimates
+    """
+    def _loadBSEC(self):
         # When the device is restarted we want to clear the last savedState
         if(os.path.exists("savedState.dat")):
             os.remove("savedState.dat")
 
-        self.startTime = time()
-
+        script_dir = os.path.abspath(os.path.dirname(__file__))
+        lib_path = os.path.join(script_dir, "bsec_python.so")
+        return cdll.LoadLibrary(lib_path)
 
     """
     Initialize the BME688 to begin taking sensor readings
@@ -98,7 +219,10 @@ class BME688(DriverBase):
                 self.data["sIAQ"].value = arr_c[4]
                 self.data["CO2-eq"].value = arr_c[5]
                 self.data["bVOC-eq"].value = arr_c[6]
-                
+
+                # Keep a record of this reading so scans can report trends rather than just the instantaneous values
+                self.history.append(time(), {field: self.data[field].value for field in EnvironmentHistory.FIELDS})
+
         except Exception as e:
             logging.error(f"The following error occured while attempting to read data: {e}")
         
@@ -116,6 +240,7 @@ class BME688(DriverBase):
             "sIAQ": Value('d', 0.0),
             "CO2-eq": Value('d', 0.0),
             "bVOC-eq": Value('d', 0.0),
+            "history": self.history,
             "initialized": Value('i', 0)
         }
         return self.data
@@ -7,9 +7,16 @@ Provides a wrapper for the Neopixel LED Driver
 import enum
 from drivers.DriverBase import DriverBase
 from multiprocessing import Event
+from queue import Empty
+from time import time
 import logging
-import neopixel_spi as neopixel
-import board
+
+try:
+    import neopixel_spi as neopixel
+    import board
+except (ImportError, NotImplementedError):
+    # Blinka refuses to import board on anything that isn't a supported single board computer
+    neopixel = None
 
 """
 Device modes that the LED's are used to represent
@@ -27,6 +34,26 @@ class LEDMode(enum.Enum):
     ERROR = 4
 
 
+"""
+A request to display a pattern on the LEDs sent over the LEDDriver command queue
+"""
+class LEDCommand():
+
+    """
+    Create a new LED command
+
+    :param mode: The pattern that should be displayed
+    :param duration: How long in seconds the pattern should be shown for, None holds the pattern until another one replaces it
+    :param priority: Patterns are only shown while no higher priority pattern is active
+    :param revertTo: The pattern that should be held once a timed pattern expires, None returns to whatever was held before
+    """
+    def __init__(self, mode: LEDMode, duration=None, priority=0, revertTo: LEDMode = None):
+        self.mode = mode
+        self.duration = duration
+        self.priority = priority
+        self.revertTo = revertTo
+
+
 class LEDDriver(DriverBase):
 
     """
@@ -34,16 +61,27 @@ class LEDDriver(DriverBase):
 
     :param isBootFromUpdaate: If the current initialization loop is caused by an update
     :param pixel_count: The number of LED "pixels" that are connected to the controller
+    :param frame_rate: How many times a second the LEDs are updated while animating
+    :param commandQueue: multiprocessing.Queue of LEDCommands other proccesses use to request timed patterns
     """
-    def __init__(self, isBootFromUpdate, pixel_count = 16):
+
+    # Priority the CAMERA event holds its pattern at so flashes from other proccesses can't interrupt a capture
+    CAMERA_PRIORITY = 2
+
+    def __init__(self, isBootFromUpdate, pixel_count = 16, frame_rate = 10, commandQueue = None):
         super().__init__("LEDDriver")
 
-        spi = board.SPI()
-        self.pixels = neopixel.NeoPixel_SPI(
-            spi, pixel_count, brightness=1, auto_write=True, pixel_order=neopixel.GRBW, bit0=0b10000000
-        )   
+        # Writes are buffered and only pushed over SPI when the frame actually changes
+        self.pixels = self._openStrip(pixel_count)
 
-        self.mode = LEDMode.PROCESSING if not isBootFromUpdate else LEDMode.NONE
+        self.pixelCount = pixel_count
+        self.commandQueue = commandQueue
+
+        # The held pattern is shown whenever no timed pattern of equal or higher priority is active
+        self.heldMode = LEDMode.PROCESSING if not isBootFromUpdate else LEDMode.NONE
+        self.heldPriority = 0
+        self.timedPatterns = []
+        self.mode = self.heldMode
         self.initialized = False
         self.events = {
             "CAMERA": Event(),
@@ -52,8 +90,12 @@ class LEDDriver(DriverBase):
             "NONE": Event(),
             "ERROR": Event()
         }
-        self.currentLed = 0
-        self.loopTime = 0.1
+
+        # Precompute every frame each mode can display so measure only has to index into a table
+        self.frames = self._buildFrames()
+        self.frameIndex = 0
+        self.lastFrame = None
+        self.setFrameRate(frame_rate)
     
     """
     This doesn't do anything other than tell us the driver has been initialized succsessfully
@@ -64,89 +106,158 @@ class LEDDriver(DriverBase):
         self.data["initialized"].value = 1
     
     """
-    Updates the LED's based on the given device mode
+    Updates the LED's based on the given device mode, only writing to the strip when the frame differs from what is already displayed
     """
     def measure(self):
         self.handleEvents()
+        self.handleCommands()
+        self.mode = self._currentMode()
 
-        if(self.mode == LEDMode.CAMERA):
-           self.cameraMode()
-        elif(self.mode == LEDMode.PROCESSING):
-            self.proccessingMode()
-        elif(self.mode == LEDMode.DONE):
-            self.doneMode()
-        elif(self.mode == LEDMode.ERROR):
-            self.errorMode()
-        else:
-            self.noneMode()
-        
-        self.pixels.show()
+        modeFrames = self.frames[self.mode]
+        frame = modeFrames[self.frameIndex % len(modeFrames)]
+        self.frameIndex += 1
+
+        if frame is not self.lastFrame:
+            self.pixels[:] = frame
+            self.pixels.show()
+            self.lastFrame = frame
 
     """
-    Handles mode switching depending on if an event was set or not
+    Open the LED strip over SPI
+
+    :param pixel_count: The number of LEDs on the strip
+    """
+    def _openStrip(self, pixel_count):
+        spi = board.SPI()
+        return neopixel.NeoPixel_SPI(
+            spi, pixel_count, brightness=1, auto_write=False, pixel_order=neopixel.GRBW, bit0=0b10000000
+        )
+
+    """
+    Set how many frames a second the LEDs are updated at
+
+    :param frame_rate: Frames per second
+    """
+    def setFrameRate(self, frame_rate):
+        self.frameRate = frame_rate
+        self.setLoopTime(1 / frame_rate)
+
+    """
+    Handles mode switching depending on if an event was set or not, events hold their pattern until replaced
     """
     def handleEvents(self):
         if self.getEvent("CAMERA").is_set():
-            self.mode = LEDMode.CAMERA
+            self.hold(LEDMode.CAMERA, self.CAMERA_PRIORITY)
             self.getEvent("CAMERA").clear()
         
         elif self.getEvent("PROCESSING").is_set():
-            self.noneMode()
-            self.mode = LEDMode.PROCESSING
+            self.hold(LEDMode.PROCESSING)
             self.getEvent("PROCESSING").clear()
 
         elif self.getEvent("DONE").is_set():
-            self.mode = LEDMode.DONE
+            self.hold(LEDMode.DONE)
             self.getEvent("DONE").clear()
 
         elif self.getEvent("ERROR").is_set():
-            self.mode = LEDMode.ERROR
+            self.hold(LEDMode.ERROR)
             self.getEvent("ERROR").clear()
             
         elif self.getEvent("NONE").is_set():
-            self.mode = LEDMode.NONE
+            self.hold(LEDMode.NONE)
             self.getEvent("NONE").clear()
-        
-    
+
     """
-    Drives the LEDs to white for the camera to take a picture
+    Drain any pending commands from the command queue without blocking
     """
-    def cameraMode(self):
-        self.pixels.fill((0, 0, 0, 255))
+    def handleCommands(self):
+        if self.commandQueue is None:
+            return
+
+        while True:
+            try:
+                command = self.commandQueue.get_nowait()
+            except Empty:
+                break
+            self.applyCommand(command)
 
     """
-    Drives the LEDs to spin yellow while we are proccessing the data
+    Apply a single LED command, held patterns replace the current held pattern while timed ones are pushed onto the stack
+
+    :param command: The LEDCommand to apply
     """
-    def proccessingMode(self):
-        self.pixels[self.currentLed] = (252,186,3,0)
-        self.pixels[self.currentLed-1] = (252//2,186//2,3//2,0)
-        self.pixels[self.currentLed-2] = (252//3,186//3,3//3,0)
-        self.pixels[self.currentLed-3] = (0,0,0,0)
-        self.currentLed += 1
-        if(self.currentLed == 16):
-            self.currentLed = 0
-        
+    def applyCommand(self, command: LEDCommand):
+        if command.duration is None:
+            self.hold(command.mode, command.priority)
+        else:
+            self.timedPatterns.append((command.priority, time() + command.duration, command))
 
     """
-    Drives the LEDs to solid green to signify we are done with the sample
+    Replace the held pattern
+
+    :param mode: The pattern to hold
+    :param priority: The priority the pattern is held at
     """
-    def doneMode(self):
-        self.pixels.fill((0,255,0,0))
+    def hold(self, mode: LEDMode, priority=0):
+        self.heldMode = mode
+        self.heldPriority = priority
 
     """
-    Drives the LEDs to off to signify we are not doing anything
+    Expire any finished timed patterns and determine which pattern should currently be displayed
     """
-    def noneMode(self):
-        self.pixels.fill((0,0,0,0))
+    def _currentMode(self) -> LEDMode:
+        currentTime = time()
+        active = []
+        for priority, expires, command in self.timedPatterns:
+            if expires > currentTime:
+                active.append((priority, expires, command))
+
+            # Once a timed pattern finishes it can replace the held pattern as long as nothing more important is being held
+            elif command.revertTo is not None and command.priority >= self.heldPriority:
+                self.hold(command.revertTo)
+        self.timedPatterns = active
+
+        # The highest priority pattern wins, ties go to the most recently requested
+        mode = self.heldMode
+        topPriority = self.heldPriority
+        for priority, _, command in self.timedPatterns:
+            if priority >= topPriority:
+                mode = command.mode
+                topPriority = priority
+        return mode
+
+    """
+    Build the table of frames for every mode, static modes only have a single frame
+    """
+    def _buildFrames(self) -> dict:
+        return {
+            LEDMode.CAMERA: [self._solidFrame((0, 0, 0, 255))],
+            LEDMode.PROCESSING: self._processingFrames(),
+            LEDMode.DONE: [self._solidFrame((0, 255, 0, 0))],
+            LEDMode.NONE: [self._solidFrame((0, 0, 0, 0))],
+            LEDMode.ERROR: [self._solidFrame((255, 0, 0, 0))]
+        }
     
     """
-    Informs the user something went wrong by turning all pixels to red
+    Create a frame where every pixel is the same color
+
+    :param color: The GRBW color tuple to fill the strip with
     """
-    def errorMode(self):
-        self.pixels.fill((255,0,0,0))
+    def _solidFrame(self, color) -> list:
+        return [color] * self.pixelCount
+
+    """
+    Create the frames for a yellow light with a fading tail spinning around the ring while we are proccessing the data
+    """
+    def _processingFrames(self) -> list:
+        frames = []
+        for currentLed in range(self.pixelCount):
+            frame = [(0, 0, 0, 0)] * self.pixelCount
+            frame[currentLed] = (252, 186, 3, 0)
+            frame[currentLed - 1] = (252//2, 186//2, 3//2, 0)
+            frame[currentLed - 2] = (252//3, 186//3, 3//3, 0)
+            frames.append(frame)
+        return frames
 
     def kill(self):
         self.pixels.fill((0,0,0,0))
         self.pixels.show()
-
-   
\ No newline at end of file
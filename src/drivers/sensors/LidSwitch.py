@@ -5,12 +5,16 @@ Provides a basic wrapper for reading values and triggering events upon the chang
 """
 
 from multiprocessing import Event, Value
-import gpiod
-from gpiod.line import Direction
-from gpiod.line import Value as GPIOValue
 
 import logging
 
+try:
+    import gpiod
+    from gpiod.line import Direction
+    from gpiod.line import Value as GPIOValue
+except ImportError:
+    gpiod = None
+
 from drivers.DriverBase import DriverBase
 
 class LidSwitch(DriverBase):
@@ -26,7 +30,7 @@ class LidSwitch(DriverBase):
         self.lidOpen = False
         
         # Set default lid state to be closed
-        self.lastState = 0
+        self.lastState = False
         self.selectedPin = pin
         
         # List of events that the sensor can raise
@@ -61,22 +65,30 @@ class LidSwitch(DriverBase):
     Handle the open and close events of the lid
     """
     def handleEvents(self):
-        currentReading = self.request.get_value(self.selectedPin)
+        currentReading = self.readPin()
 
         # Set the value of lidOpen equal to whether or not the pin is pulled HIGH
-        self.lidOpen = (currentReading == GPIOValue.ACTIVE)
+        self.lidOpen = currentReading
 
         # If between the current reading and the last reading the state of the hall-effect sensor transitioned from LOW to HIGH we opened the lid and should trigger the event
-        if (currentReading == GPIOValue.ACTIVE and self.lastState == GPIOValue.INACTIVE):
+        if (currentReading and not self.lastState):
             self.getEvent("LID_OPENED").set()
 
         # Tranistion from a HIGH state to a LOW state we know the lid was closed and should trigger the event
-        elif(currentReading == GPIOValue.INACTIVE and self.lastState == GPIOValue.ACTIVE):
+        elif(not currentReading and self.lastState):
             self.getEvent("LID_CLOSED").set()
 
         # Update the last state
         self.lastState = currentReading
         
+    """
+    Read the hall-effect sensor
+
+    :return: True if the pin is pulled HIGH meaning the lid is open
+    """
+    def readPin(self) -> bool:
+        return self.request.get_value(self.selectedPin) == GPIOValue.ACTIVE
+
     """
     Create a specified dictionary of values to create keys for the values we will update
     """
@@ -4,17 +4,22 @@ Will Richards, Oregon State University, 2023
 Abstraction layer for the MLX90640 
 """
 
-from mlx90640 import MLX90640 as mlx90640
 from multiprocessing import Event
 import logging
 import cv2
 import numpy as np
 from scipy import ndimage
-from time import time, strftime, gmtime
+from time import time
 from enum import Enum
 import cmapy
 
 from drivers.DriverBase import DriverBase
+from helpers.ScanBundle import formatFileName
+
+try:
+    from mlx90640 import MLX90640 as mlx90640
+except ImportError:
+    mlx90640 = None
 
 """
 Enum to map readable camera refresh rates to there integer values
@@ -46,16 +51,20 @@ class ThermalCam():
     :param width: The width of the resulting image
     :param height: The height of the resulting image
     :param refreshRate: The refresh rate of the MLX90640
+    :param sensor: An already configured object with the same interface as the mlx90640 library, the MLX90640 on the I2C bus is used when None
     """
-    def __init__(self, width=1200, height=900, refreshRate=CameraRefreshRate.RATE_4):
+    def __init__(self, width=1200, height=900, refreshRate=CameraRefreshRate.RATE_4, sensor=None):
         self.imageHeight = height
         self.imageWidth = width
         self._colormap_index = 0
 
         # Setup the camera
-        self.mlx = mlx90640()
-        self.mlx.i2c_init("/dev/i2c-1")
-        self.mlx.set_refresh_rate(refreshRate.value[0])
+        if sensor is not None:
+            self.mlx = sensor
+        else:
+            self.mlx = mlx90640()
+            self.mlx.i2c_init("/dev/i2c-1")
+            self.mlx.set_refresh_rate(refreshRate.value[0])
 
     """
     Scale temperature values to create an accurate heatmap
@@ -125,7 +134,7 @@ class ThermalCam():
         heats = self._captureRaw()
         heatmap = self._createHeatmap(heats)
         currentTime = time()
-        name = self._formatFileName("heatmap.jpg", currentTime)
+        name = formatFileName("heatmap.jpg", currentTime)
         cv2.imwrite(name, heatmap)
         logging.info("Succsessfully captured heatmap")
         return name
@@ -137,14 +146,6 @@ class ThermalCam():
     def close(self):
         self.mlx.i2c_tear_down()
     
-    """
-    Given a generic file name like colorImage.jpg format it to be saved in ../data/colorImage_2024-04-16--19--00-12.jpg
-    """
-    def _formatFileName(self, fileName: str, currentTime):
-        fileNameSplit = fileName.split(".")
-        outputFile = strftime(f"../data/{fileNameSplit[0]}_%Y-%m-%d--%H-%M-%S.{fileNameSplit[1]}",gmtime(currentTime))
-        return outputFile
-        
 class MLX90640(DriverBase):
 
     """
@@ -153,11 +154,17 @@ class MLX90640(DriverBase):
     def __init__(self, controllerPipe):
         super().__init__("MLX90640")
         self.controllerConnection = controllerPipe
-        self.mlx = ThermalCam()
+        self.mlx = self._openCamera()
         self.events = {
             "CAPTURE": Event()
         }
 
+    """
+    Create the "thermal camera" the heatmaps are captured from
+    """
+    def _openCamera(self) -> ThermalCam:
+        return ThermalCam()
+
     """
     Initialzize a new instance of our "thermal camera"
     """
@@ -170,7 +177,8 @@ class MLX90640(DriverBase):
     """
     def measure(self) -> None:
         if(self.getEvent("CAPTURE").is_set()):
-            fileName = self.mlx.capture()
+            with self.tracer.span("capture_thermal"):
+                fileName = self.mlx.capture()
             self.controllerConnection.send({'heatmapImage': fileName})
             self.getEvent("CAPTURE").clear()
 
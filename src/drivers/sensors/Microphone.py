@@ -5,129 +5,232 @@ Provides a functionality to interface with a standard USB microphone using a USB
 """
 
 import logging
-import os
-import subprocess
 import wave
-from time import gmtime, strftime, time
+from time import sleep, time
 
 import numpy as np
-import pyaudio
+
+from helpers.ScanBundle import formatFileName
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+# PortAudio's callback return codes, these are fixed so simulated audio can use them without pyaudio installed
+CALLBACK_CONTINUE = pyaudio.paContinue if pyaudio is not None else 0
+CALLBACK_COMPLETE = pyaudio.paComplete if pyaudio is not None else 1
 
 
 class Microphone:
     """
     Create a new instance of the microhpone which will be used to collect item descriptions
 
-    :param record_duration: The lenght of time in seconds that the microphone will record for
+    :param record_duration: The lenght of time in seconds that the microphone will record for, in vad mode this is how long we wait for the user to start speaking
+    :param mixer: The AudioMixer used to enable capture on the microphone
+    :param recordMode: "vad" to record until the user stops speaking or "fixed" to always record for record_duration
+    :param vadThreshold: RMS level of a 16 bit period above which we consider it speech
+    :param trailingSilence: Seconds of silence after speech that ends a vad recording
+    :param maxDuration: The longest a vad recording can run for in seconds
+    :param audio: Object with the same interface as pyaudio.PyAudio to record through, a new PyAudio instance when None
     """
 
-    def __init__(self, record_duration=10, model="base.en-q5_0"):
+    def __init__(self, record_duration=10, mixer=None, recordMode="vad", vadThreshold=500, trailingSilence=1.0, maxDuration=10, audio=None):
 
-        # Audio recording parameters
+        # Audio recording parameters, the device captures in stereo but everything we keep is downmixed to mono since that is all whisper needs
         self.sampling_rate = 16000
         self.device_index = 0
         self.channels = 2
-        self.frames_per_buffer = 128
-        self.format = pyaudio.paInt16
+        self.outputChannels = 1
+        self.frames_per_buffer = 1024
         self.record_duration = record_duration
-        self.alsaSoundCardNum = 0
+        self.mixer = mixer
 
-        self.pAudio = pyaudio.PyAudio()
+        # Voice activity detection parameters, speech is judged per period and we keep a little padding around it when trimming
+        self.recordMode = recordMode
+        self.vadThreshold = vadThreshold
+        self.vadPadding = 0.2
+        self.trailingSilence = trailingSilence
+        self.maxDuration = maxDuration
+        self.speechDetected = False
 
-        # Enable the microphone capture
-        with open(os.devnull, "wb") as devnull:
-            while True:
-                try:
-                    subprocess.check_call(
-                        [
-                            "/usr/bin/amixer",
-                            "-c",
-                            str(self.alsaSoundCardNum),
-                            "set",
-                            "Mic",
-                            "cap",
-                        ],
-                        stdout=devnull,
-                        stderr=subprocess.STDOUT,
-                    )
-                    break
-                except subprocess.CalledProcessError as e:
-                    self.alsaSoundCardNum += 1
-                    logging.info(e)
-                except KeyboardInterrupt:
-                    break
+        # Optional function called with every captured period of mono audio and whether it contained speech
+        self.frameListener = None
+
+        # Preallocated mono ring buffer the capture callback writes into, along with scratch space for downmixing
+        self.bufferSize = int(self.sampling_rate * max(self.maxDuration, self.record_duration))
+        self.buffer = np.zeros(self.bufferSize, dtype=np.int16)
+        self._mixScratch = np.zeros(self.frames_per_buffer, dtype=np.int32)
+        self._resetCapture()
+
+        self.pAudio = audio if audio is not None else pyaudio.PyAudio()
+        self.format = self.pAudio.get_format_from_width(2)
 
     """
     Initialize the whisper model and warm it up by feeding 0s into it
     """
 
     def initialize(self):
+        # Enable the microphone capture
+        if self.mixer is not None:
+            self.mixer.setCapture("Mic", True)
+
         logging.info("Microphone initialized!")
         self.initialized = True
 
     """
     Write some audio data out to a .wav file
 
-    :param data: Data to be written to the wav file
+    :param data: Mono 16 bit samples to be written to the wav file
     :param outputFile: The name of the file the data should be written to
     """
 
     def writeWave(self, data, outputFile):
-        # Write the pre downsampled audio to .wav file
         wf = wave.open(outputFile, "wb")
-        wf.setnchannels(self.channels)
+        wf.setnchannels(self.outputChannels)
         wf.setsampwidth(self.pAudio.get_sample_size(self.format))
         wf.setframerate(self.sampling_rate)
-        wf.writeframes(b"".join(data))
+        wf.writeframes(data.tobytes())
         wf.close()
 
     """
-    Record audio from the microphone and write it to a file
+    Clear the state of the last capture so the buffer can be reused
+    """
 
-    :param outputFile: File to write the recorded audio to
+    def _resetCapture(self):
+        self._written = 0
+        self._firstSpeech = None
+        self._lastSpeech = None
+        self.speechDetected = False
+
+    """
+    PyAudio callback run for every period captured, downmixes to mono, stores it in the ring buffer and decides when the recording is over
     """
 
-    def _record(self, outputFile):
-        frames = []
+    def _captureCallback(self, in_data, frame_count, time_info, status):
+        samples = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.channels)
+        count = len(samples)
+        if count > len(self._mixScratch):
+            self._mixScratch = np.zeros(count, dtype=np.int32)
 
-        # Attempt to open the microphone stream
+        # Average the channels together without allocating a new array
+        mono = self._mixScratch[:count]
+        np.sum(samples, axis=1, dtype=np.int32, out=mono)
+        np.floor_divide(mono, self.channels, out=mono)
+
+        # Copy into the ring buffer wrapping around at the end
+        start = self._written % self.bufferSize
+        firstPart = min(count, self.bufferSize - start)
+        self.buffer[start : start + firstPart] = mono[:firstPart]
+        self.buffer[: count - firstPart] = mono[firstPart:]
+        self._written += count
+
+        isSpeech = np.sqrt(np.mean(np.square(mono, dtype=np.float64))) > self.vadThreshold
+        if isSpeech:
+            if self._firstSpeech is None:
+                self._firstSpeech = self._written - count
+            self._lastSpeech = self._written
+
+        if self.frameListener is not None:
+            self.frameListener(mono, isSpeech)
+
+        return (None, CALLBACK_COMPLETE if self._isCaptureDone() else CALLBACK_CONTINUE)
+
+    """
+    Check if we have recorded enough audio for the current record mode
+    """
+
+    def _isCaptureDone(self) -> bool:
+        if self.recordMode != "vad":
+            return self._written >= self.sampling_rate * self.record_duration
+
+        # Give up if the user never started talking, or stop once they have been quiet long enough or we run out of room
+        if self._firstSpeech is None:
+            return self._written >= self.sampling_rate * self.record_duration
+        if self._written - self._lastSpeech >= self.sampling_rate * self.trailingSilence:
+            return True
+        return self._written - max(0, self._firstSpeech - self._paddingSamples()) >= self.bufferSize
+
+    """
+    Number of samples of padding kept on either side of the detected speech
+    """
+
+    def _paddingSamples(self) -> int:
+        return int(self.sampling_rate * self.vadPadding)
+
+    """
+    Get the samples of the last capture in chronological order, trimming silence from either end if speech was detected
+    """
+
+    def _capturedSamples(self):
+        start = max(0, self._written - self.bufferSize)
+        end = self._written
+        if self.recordMode == "vad" and self._firstSpeech is not None:
+            start = max(start, self._firstSpeech - self._paddingSamples())
+            end = min(end, self._lastSpeech + self._paddingSamples())
+
+        startIndex = start % self.bufferSize
+        if startIndex + (end - start) <= self.bufferSize:
+            return self.buffer[startIndex : startIndex + (end - start)]
+        return np.concatenate((self.buffer[startIndex:], self.buffer[: end - start - (self.bufferSize - startIndex)]))
+
+    """
+    Open the microphone input stream in callback mode
+    """
+
+    def _openStream(self):
         try:
             self.stream = self.pAudio.open(
-                format=pyaudio.paInt16,
+                format=self.format,
                 rate=self.sampling_rate,
                 input=True,
-                channels=2,
+                channels=self.channels,
                 input_device_index=self.device_index,
                 frames_per_buffer=self.frames_per_buffer,
+                stream_callback=self._captureCallback,
+                start=False,
             )
+            return True
         except Exception as e:
-            logging.error("Failed to open audio input device: {e}")
+            logging.error(f"Failed to open audio input device: {e}")
             self.initialized = False
+            return False
+
+    """
+    Record audio from the microphone and write it to a file
+
+    :param outputFile: File to write the recorded audio to
+    """
+
+    def _record(self, outputFile):
+        self._resetCapture()
+
+        # Attempt to open the microphone stream
+        if not self._openStream():
+            return ""
 
         logging.info("RECORDING....")
         self.stream.start_stream()
 
-        for _ in range(
-            0, int(self.sampling_rate / self.frames_per_buffer * self.record_duration)
-        ):
-            data = self.stream.read(self.frames_per_buffer, exception_on_overflow=False)
-            frames.append(data)
+        # The callback stops the stream itself, this is just a safety net in case the device stops delivering audio
+        deadline = time() + self.record_duration + self.maxDuration + 2
+        while self.stream.is_active() and time() < deadline:
+            sleep(0.05)
 
         self.stream.stop_stream()
-
-        fileName = outputFile.split(".")
-        currentTime = time()
-        outputFile = strftime(
-            f"../data/{fileName[0]}_%Y-%m-%d--%H-%M-%S.{fileName[1]}",
-            gmtime(currentTime),
-        )
-        self.writeWave(frames, outputFile)
         self.stream.close()
+
+        self.speechDetected = self.recordMode != "vad" or self._firstSpeech is not None
+        if not self.speechDetected:
+            logging.info("No speech detected in recording")
+
+        outputFile = formatFileName(outputFile)
+        self.writeWave(self._capturedSamples(), outputFile)
         logging.info("STOPPED RECORDING")
         return outputFile
 
     """
-    Record a clip from the microphone
+    Record a clip from the microphone, speechDetected will be set if the user actually said something
     """
 
     def record(self):
@@ -144,4 +247,3 @@ class Microphone:
 
     def kill(self):
         self.pAudio.terminate()
-
@@ -4,11 +4,15 @@ Will Richards, Oregon State University, 2023
 Abstraction layer for the NAU7802 to allow us to add stablitiy improvements if needed
 """
 
-import PyNAU7802
-import smbus2
 import logging
 import time
 
+try:
+    import PyNAU7802
+    import smbus2
+except ImportError:
+    PyNAU7802 = None
+
 from drivers.DriverBase import DriverBase
 from multiprocessing import Event, Value
 
@@ -22,7 +26,7 @@ class NAU7802(DriverBase):
     def __init__(self, calibration_factor = 0):
         super().__init__("NAU7802")
 
-        self.nau = PyNAU7802.NAU7802()
+        self.nau = self._openLoadCell()
         self.collectedData = 0
         
         if(calibration_factor == 0):
@@ -35,6 +39,9 @@ class NAU7802(DriverBase):
         self.WEIGHT_THRESHOLD = 1.5
         self.weightDetectedLastTime = 0
 
+        # Only the first reading taken during each scan is traced
+        self.lastTraceId = ""
+
         # List of events that the sensor can raise
         self.events = {
             "WEIGHT_CHANGE": Event(),
@@ -65,6 +72,12 @@ class NAU7802(DriverBase):
         self.initialized = True
         self.data["initialized"].value = 1
 
+    """
+    Create the interface to the NAU7802, it isn't connected to until initialize is called
+    """
+    def _openLoadCell(self):
+        return PyNAU7802.NAU7802()
+
     """
     Measure and return the weight read from the load cell
     """
@@ -80,9 +93,15 @@ class NAU7802(DriverBase):
             self.lastWeight = self.collectedData
 
             #Average 100 samples to get a fairly accurate reading
+            traceId = self.tracer.currentTrace()
+            readingStart = time.time()
             data = []
             for i in range(4):
                 data.append(self.nau.getWeight(True, 25))
+
+            if traceId != self.lastTraceId:
+                self.tracer.record(traceId, "weigh", readingStart, time.time())
+                self.lastTraceId = traceId
             
             self.collectedData = sum(data)/len(data)
             data.clear()
@@ -6,13 +6,18 @@ Abstraction layer for the D405/D401 Intel Realsense depth camera
 
 import logging
 from multiprocessing import Event
-from time import gmtime, strftime, time
+from time import time
 
 import cv2
 import numpy as np
-import pyrealsense2 as rs
+
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    rs = None
 
 from drivers.DriverBase import DriverBase
+from helpers.ScanBundle import formatFileName
 
 
 class RealsenseCam(DriverBase):
@@ -30,11 +35,7 @@ class RealsenseCam(DriverBase):
         self.camera_height = height
 
         # Realsense paramters
-        self.realsense_pipeline = rs.pipeline()
-        self.realsense_config = rs.config()
-        self.realsense_colorizer = rs.colorizer()
-        self.realsense_pointcloud = rs.pointcloud()
-        self.realsense_align = rs.align(rs.stream.color)
+        self._createPipeline()
         self.controllerConnection = controllerPipe
 
         # for dev in rs.context().query_devices():
@@ -43,6 +44,16 @@ class RealsenseCam(DriverBase):
         # List of events to hold
         self.events = {"CAPTURE": Event()}
 
+    """
+    Create the librealsense objects used to stream, align and export frames
+    """
+
+    def _createPipeline(self):
+        self.realsense_pipeline = rs.pipeline()
+        self.realsense_config = rs.config()
+        self.realsense_pointcloud = rs.pointcloud()
+        self.realsense_align = rs.align(rs.stream.color)
+
     """
     Initialize our realsense camera streams for both color and depth
     """
@@ -110,58 +121,74 @@ class RealsenseCam(DriverBase):
                 return
 
             # Attempt to retrive the most recent frame from the realsense camera
-            capSuccsess, frames = self.realsense_pipeline.try_wait_for_frames()
-
-            if capSuccsess:
-
-                # Actually pull the frames out of our wait attempt and verify they are valid
-
-                aligned_frames = self.realsense_align.process(frames)
-
-                depth_frame = aligned_frames.get_depth_frame()
-                color_frame = aligned_frames.get_color_frame()
-
-                if depth_frame and color_frame:
-                    # Create the names for each of the files that will be saved
-                    currentTime = time()
-                    fileNames = {
-                        "topologyMap": self._formatFileName("depth.ply", currentTime),
-                        "depthImage": self._formatFileName(
-                            "depthImage.jpg", currentTime
-                        ),
-                        "colorImage": self._formatFileName(
-                            "colorImage.jpg", currentTime
-                        ),
-                    }
-
-                    # Convert our images into array's and colorize the depth map
-                    colorized = self.realsense_colorizer.process(frames)
-                    depth_image = np.asanyarray(depth_frame.get_data())
-                    color_image = np.asanyarray(color_frame.get_data())
-                    depth_colormap = cv2.applyColorMap(
-                        cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET
-                    )
+            captureStart = time()
+            frames = self.grabFrames()
+
+            if frames is not None:
+                depth_frame, color_frame = frames
+
+                # Create the names for each of the files that will be saved
+                currentTime = time()
+                fileNames = {
+                    "topologyMap": formatFileName("depth.ply", currentTime),
+                    "depthImage": formatFileName(
+                        "depthImage.jpg", currentTime
+                    ),
+                    "colorImage": formatFileName(
+                        "colorImage.jpg", currentTime
+                    ),
+                }
+
+                # Convert our images into array's and colorize the depth map
+                depth_image = np.asanyarray(depth_frame.get_data())
+                color_image = np.asanyarray(color_frame.get_data())
+                depth_colormap = cv2.applyColorMap(
+                    cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET
+                )
+
+                # Generate our .ply file and save our images to the disk
+                self.exportPointCloud(fileNames["topologyMap"], depth_frame, color_frame)
+
+                cv2.imwrite(fileNames["depthImage"], depth_colormap)
+                cv2.imwrite(fileNames["colorImage"], color_image)
+                self.controllerConnection.send(fileNames)
+                self.tracer.record(self.tracer.currentTrace(), "capture_depth", captureStart, time())
+                logging.info("Captured frames successfully!")
+
+                # Only clear capture event on successful retrieval
+                self.getEvent("CAPTURE").clear()
 
-                    # Generate our .ply file and save our images to the disk
-                    self.realsense_pointcloud.map_to(color_frame)
-                    points = self.realsense_pointcloud.calculate(depth_frame)
+    """
+    Wait for the next set of frames from the camera and align the depth frame to the color frame
 
-                    # Export .ply file
-                    points.export_to_ply(fileNames["topologyMap"], color_frame)
+    :return: Tuple of (depth_frame, color_frame) or None if either couldn't be retrieved
+    """
 
-                    cv2.imwrite(fileNames["depthImage"], depth_colormap)
-                    cv2.imwrite(fileNames["colorImage"], color_image)
-                    self.controllerConnection.send(fileNames)
-                    logging.info("Captured frames successfully!")
+    def grabFrames(self):
+        capSuccsess, frames = self.realsense_pipeline.try_wait_for_frames()
+        if not capSuccsess:
+            logging.error("Failed to retrieve last frame")
+            return None
+
+        # Actually pull the frames out of our wait attempt and verify they are valid
+        aligned_frames = self.realsense_align.process(frames)
+        depth_frame = aligned_frames.get_depth_frame()
+        color_frame = aligned_frames.get_color_frame()
+        if not depth_frame or not color_frame:
+            logging.warn("Unable to retrieve frame(s)")
+            return None
+        return depth_frame, color_frame
 
-                    # Only clear capture event on successful retrieval
-                    self.getEvent("CAPTURE").clear()
+    """
+    Write the depth frame out as a .ply point cloud textured with the color frame
 
-                else:
-                    logging.warn("Unable to retrieve frame(s)")
+    :param fileName: The .ply file to write
+    """
 
-            else:
-                logging.error("Failed to retrieve last frame")
+    def exportPointCloud(self, fileName, depth_frame, color_frame):
+        self.realsense_pointcloud.map_to(color_frame)
+        points = self.realsense_pointcloud.calculate(depth_frame)
+        points.export_to_ply(fileName, color_frame)
 
     """
     Release RealSense pipeline on shutdown
@@ -173,18 +200,6 @@ class RealsenseCam(DriverBase):
         except RuntimeError as e:
             logging.error(f"An error occurred: {e}")
 
-    """
-    Given a generic file name like colorImage.jpg format it to be saved in ../data/colorImage_2024-04-16--19--00-12.jpg
-    """
-
-    def _formatFileName(self, fileName: str, currentTime):
-        fileNameSplit = fileName.split(".")
-        outputFile = strftime(
-            f"../data/{fileNameSplit[0]}_%Y-%m-%d--%H-%M-%S.{fileNameSplit[1]}",
-            gmtime(currentTime),
-        )
-        return outputFile
-
     def _exportRGBD(self, points, color_image, fileNames):
         vtx = np.asanyarray(points.get_vertices())
         rgbd_tensor = np.zeros((self.camera_height, self.camera_width, 4), np.int32)
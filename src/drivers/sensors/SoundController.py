@@ -6,11 +6,12 @@ Wrapper for Microphone and Audio output to be threadified to avoid truly blockin
 
 import logging
 import os
-import subprocess
 import time
 from multiprocessing import Event, Value
 
 from drivers.DriverBase import DriverBase
+from drivers.sensors.AudioMixer import AudioMixer
+from drivers.sensors.AudioTranscriber import StreamingTranscriber
 from drivers.sensors.Microphone import Microphone
 from drivers.sensors.Speaker import Speaker
 
@@ -21,17 +22,21 @@ class SoundController(DriverBase):
 
     :param soundControllerConnection: This is a reference to a multiproccessing.Pipe to send our transcription back to the main thread
     :param record_duration: The lenght of time the microphone should be recording for
+    :param mixerBackend: Which AudioMixer backend to use, None picks the best one available
+    :param streamingTranscription: Transcribe the recording while the user is still speaking and send the text along with the file name
+    :param audio: Object with the same interface as pyaudio.PyAudio shared by the microphone and speaker, each creates its own PyAudio instance when None
     """
 
-    def __init__(self, soundControllerConnection, muted, record_duration=4):
+    def __init__(self, soundControllerConnection, muted, record_duration=4, mixerBackend=None, streamingTranscription=False, audio=None):
         super().__init__("SoundController")
 
-        # Create our new mic and speaker instances
-        self.microphone = Microphone(record_duration)
-        self.speaker = Speaker()
+        # Create our new mic and speaker instances sharing a single mixer
+        self.mixer = AudioMixer(mixerBackend)
+        self.microphone = Microphone(record_duration, self.mixer, audio=audio)
+        self.speaker = Speaker(self.mixer, audio=audio)
         self.soundControllerConnection = soundControllerConnection
-        self.alsaSoundCardNum = 0
         self.isMuted = muted
+        self.transcriber = StreamingTranscriber() if streamingTranscription else None
 
         # Set our loop time to 0.05 cause we dont need super fast looping
         self.loopTime = 0.001
@@ -55,9 +60,18 @@ class SoundController(DriverBase):
     """
 
     def initialize(self):
+        self.mixer.open()
         self.muteMic()
         self.muteSpeaker()
+        self.speaker.initialize()
         self.microphone.initialize()
+
+        # Fall back to transcribing after upload if the whisper server won't start
+        if self.transcriber is not None:
+            if self.transcriber.start():
+                self.microphone.frameListener = self.transcriber.feed
+            else:
+                self.transcriber = None
         self.initialized = True
         self.data["initialized"].value = 1
 
@@ -66,60 +80,28 @@ class SoundController(DriverBase):
     """
 
     def muteSpeaker(self):
-        self.speaker.muteSpeaker(self.alsaSoundCardNum)
+        self.speaker.muteSpeaker()
 
     """
     Unmute the speaker attatched to the waveshare adapter
     """
 
     def unmuteSpeaker(self):
-        self.speaker.unmuteSpeaker(self.alsaSoundCardNum)
+        self.speaker.unmuteSpeaker()
 
     """
     Mute the mic attatched to the waveshare adapter
     """
 
     def muteMic(self):
-        with open(os.devnull, "wb") as devnull:
-            while True:
-                try:
-                    subprocess.check_call(
-                        [
-                            "/usr/bin/amixer",
-                            "-c",
-                            str(self.alsaSoundCardNum),
-                            "sset",
-                            "Mic",
-                            "mute",
-                        ],
-                        stdout=devnull,
-                        stderr=subprocess.STDOUT,
-                    )
-                    break
-                except subprocess.CalledProcessError as e:
-                    self.alsaSoundCardNum += 1
-                    logging.info(e)
-                except KeyboardInterrupt:
-                    break
+        self.mixer.mute("Mic")
 
     """
     Unmute the mic attatched to the waveshare adapter
     """
 
     def unmuteMic(self):
-        with open(os.devnull, "wb") as devnull:
-            subprocess.check_call(
-                [
-                    "/usr/bin/amixer",
-                    "-c",
-                    str(self.alsaSoundCardNum),
-                    "sset",
-                    "Mic",
-                    "unmute",
-                ],
-                stdout=devnull,
-                stderr=subprocess.STDOUT,
-            )
+        self.mixer.unmute("Mic")
 
     """ 
     Unmutes the speaker plays a sound and then mutes it again
@@ -130,6 +112,9 @@ class SoundController(DriverBase):
 
     def playClip(self, clip):
         self.unmuteSpeaker()
+
+        # The amixer session applies toggles in the background, wait for the mic to be muted and the speaker unmuted before anything plays
+        self.mixer.flush()
         self.speaker.playClip(clip)
         self.muteSpeaker()
 
@@ -173,11 +158,15 @@ class SoundController(DriverBase):
         elif self.events["RECORD"][0].is_set():
 
             if not self.isMuted:
-                self.playClip("../media/itemRequest.wav")
+                with self.tracer.span("prompt"):
+                    self.playClip("../media/itemRequest.wav")
+            recordStart = time.time()
 
-            # Check if we actually saved the audio to the file or not if not we want to ask the user for another transcription
+            # Check if we actually recorded the user saying something or not if not we want to ask the user for another transcription
             gotRecording = False
             retries = 0
+            fileName = ""
+            transcription = None
 
             while not gotRecording and retries < 3:
 
@@ -185,16 +174,31 @@ class SoundController(DriverBase):
 
                 # Record the microphone and return the file name that it was saved at
                 self.unmuteMic()
+                self.mixer.flush()
+                if self.transcriber is not None:
+                    self.transcriber.begin()
                 fileName = self.microphone.record()
                 self.muteMic()
+                transcription = self.transcriber.finish() if self.transcriber is not None else None
 
-                # If the file was saved succsessfully send it and move on but if not TELL the user that we are re-recording
-                if len(fileName) != 0:
+                # If the file was saved and had speech in it move on but if not TELL the user that we are re-recording
+                if len(fileName) != 0 and self.microphone.speechDetected:
                     gotRecording = True
-                    self.soundControllerConnection.send({"voiceRecording": fileName})
                 else:
-                    self.playClip("../media/itemRequest.wav")
                     retries += 1
+                    if retries < 3:
+                        if len(fileName) != 0:
+                            os.remove(fileName)
+                        self.playClip("../media/didntCatch.wav")
+
+            self.tracer.record(self.tracer.currentTrace(), "record", recordStart, time.time())
+
+            # Send the last take even if it was silent so the scan can still be uploaded
+            if len(fileName) != 0:
+                result = {"voiceRecording": fileName}
+                if transcription is not None:
+                    result["transcription"] = transcription
+                self.soundControllerConnection.send(result)
 
             self.events["RECORD"][0].clear()
 
@@ -205,6 +209,9 @@ class SoundController(DriverBase):
     def kill(self):
         self.microphone.kill()
         self.speaker.kill()
+        self.mixer.close()
+        if self.transcriber is not None:
+            self.transcriber.stop()
 
     """
     Add TranscribedText to our data dictionary that will be populated by the main thread
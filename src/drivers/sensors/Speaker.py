@@ -4,72 +4,147 @@ Will Richards, Oregon State University, 2024
 Provides a functionality to interface with a standard USB speaker using PyAudio and play sound over it
 """
 
+import glob
 import logging
-import pyaudio
 import wave
-import subprocess
 import os
 
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+
+"""
+A prompt that has been decoded from its .wav file and is held in memory ready to be played
+"""
+class AudioClip():
+
+    """
+    Decode the given .wav file into memory
+
+    :param fileName: The path to the .wav file
+    """
+    def __init__(self, fileName):
+        with wave.open(fileName, 'r') as wf:
+            self.sampleWidth = wf.getsampwidth()
+            self.channels = wf.getnchannels()
+            self.rate = wf.getframerate()
+            self.frames = wf.readframes(wf.getnframes())
+
+    """
+    The parameters a stream needs to be opened with to play this clip
+    """
+    def getFormat(self):
+        return (self.sampleWidth, self.channels, self.rate)
+
 
 class Speaker():
 
     """
     Create a new instance of a speaker
+
+    :param mixer: The AudioMixer used to mute and unmute the speaker
+    :param mediaDir: Directory containing the .wav prompts that will be decoded and cached when initialized
+    :param audio: Object with the same interface as pyaudio.PyAudio to play through, a new PyAudio instance when None
     """
-    def __init__(self):
+    def __init__(self, mixer, mediaDir="../media", audio=None):
 
         # Audio playback parameters
         self.device_index = 0
         self.channels = 2
         self.frames_per_buffer = 1024
-        self.pAudio = pyaudio.PyAudio()
+        self.pAudio = audio if audio is not None else pyaudio.PyAudio()
         self.initialized = True
+        self.mediaDir = mediaDir
+
+        # Decoded prompts keyed by their file path, and the output stream that stays open between prompts
+        self.clips = {}
+        self.stream = None
+        self.streamFormat = None
+        self.mixer = mixer
+
+    """
+    Decode every prompt up front and open the output stream, this should be called from the proccess that will be doing the playback
+    """
+    def initialize(self):
+        for fileName in sorted(glob.glob(os.path.join(self.mediaDir, "*.wav"))):
+            self._loadClip(fileName)
+        logging.info(f"Cached {len(self.clips)} audio prompts")
+
+        if len(self.clips) > 0:
+            self._openStream(next(iter(self.clips.values())).getFormat())
 
-    
     """
     Play a given audio file out of the waveshare connected speaker
 
     :pram clipName: The name of the .wav file to paly
     """
     def playClip(self, clipName):
-        wf = wave.open(clipName, 'r')
+        clip = self.clips.get(clipName)
+        if clip is None:
+            clip = self._loadClip(clipName)
 
-        # Attempt to open the speaker stream
+        # Only reopen the stream if this clip needs a different format than the one that is already open
+        if self.stream is None or clip.getFormat() != self.streamFormat:
+            self._openStream(clip.getFormat())
+
+        # Only if the device succsessfully initialized should we actually attempt to write to it
+        if(self.initialized):
+            self.stream.start_stream()
+            self.stream.write(clip.frames)
+
+            # Stopping waits for the buffered audio to finish so the caller can safely mute afterwards
+            self.stream.stop_stream()
+
+    """
+    Decode a clip and add it to the cache
+
+    :param fileName: The path of the .wav file to load
+    """
+    def _loadClip(self, fileName):
+        clip = AudioClip(fileName)
+        self.clips[fileName] = clip
+        return clip
+
+    """
+    Open the output stream that is reused for every prompt
+
+    :param streamFormat: Tuple of (sample width, channels, rate) to open the stream with
+    """
+    def _openStream(self, streamFormat):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+        sampleWidth, channels, rate = streamFormat
         try:
-            self.stream = self.pAudio.open(format = self.pAudio.get_format_from_width(wf.getsampwidth()),
-                channels = self.channels,
-                rate = wf.getframerate(),
+            self.stream = self.pAudio.open(format = self.pAudio.get_format_from_width(sampleWidth),
+                channels = channels,
+                rate = rate,
                 output = True,
-                output_device_index=self.device_index)
+                output_device_index=self.device_index,
+                frames_per_buffer=self.frames_per_buffer,
+                start=False)
+            self.streamFormat = streamFormat
+            self.initialized = True
         except Exception as e:
-            logging.error("Failed to open audio input device: {e}")
+            logging.error(f"Failed to open audio output device: {e}")
             self.initialized = False
 
-        # Only if the device succsessfully initialized should we actually attempt to write to it
-        if(self.initialized):
-            data = wf.readframes(self.frames_per_buffer)
-            while data:
-                self.stream.write(data)
-                data = wf.readframes(self.frames_per_buffer)
-        
-        self.stream.close()
-
     def kill(self):
+        if self.stream is not None:
+            self.stream.close()
         self.pAudio.terminate()
 
     """
     Mute the speaker attatched to the waveshare adapter
     """
-    def muteSpeaker(self, alsaSoundCardNum):
-        with open(os.devnull, 'wb') as devnull:
-            subprocess.check_call(['/usr/bin/amixer', '-c', str(alsaSoundCardNum), 'sset', 'Speaker', 'mute'], stdout=devnull, stderr=subprocess.STDOUT)
+    def muteSpeaker(self):
+        self.mixer.mute("Speaker")
 
     """
     Unmute the speaker attatched to the waveshare adapter
     """
-    def unmuteSpeaker(self, alsaSoundCardNum):
-        with open(os.devnull, 'wb') as devnull:
-            subprocess.check_call(['/usr/bin/amixer', '-c', str(alsaSoundCardNum), 'sset', 'Speaker', 'unmute'], stdout=devnull, stderr=subprocess.STDOUT)
-
-
-        
\ No newline at end of file
+    def unmuteSpeaker(self):
+        self.mixer.unmute("Speaker")
@@ -0,0 +1,222 @@
+"""
+Oregon State University, 2024
+
+Collects errors in the background and sends them to the support team as a periodic digest so alerting never blocks uploads
+"""
+
+import hashlib
+import logging
+import queue
+import re
+import smtplib
+import threading
+from email.mime.text import MIMEText
+from time import time
+
+import httpx
+
+
+class SMTPTransport:
+    """
+    Send alerts as emails
+
+    :param credentials: Function returning (emailAddress, password) or None if we don't have credentials yet, the address is used as both sender and recipient
+    :param host: The SMTP server to connect to
+    :param port: The port of the SMTP server
+    :param useSSL: Connect with SMTP_SSL, disable for a local plaintext stub
+    """
+
+    def __init__(self, credentials, host="smtp.gmail.com", port=465, useSSL=True, timeout=20):
+        self.credentials = credentials
+        self.host = host
+        self.port = port
+        self.useSSL = useSSL
+        self.timeout = timeout
+
+    def send(self, subject, body, alerts) -> bool:
+        credentials = self.credentials()
+        if credentials is None:
+            logging.warning("No email credentials available, holding alerts")
+            return False
+        emailAddress, password = credentials
+
+        msg = MIMEText(body)
+        msg["Subject"] = subject
+        msg["From"] = emailAddress
+        msg["To"] = emailAddress
+
+        try:
+            smtpClass = smtplib.SMTP_SSL if self.useSSL else smtplib.SMTP
+            with smtpClass(self.host, self.port, timeout=self.timeout) as smtp_server:
+                if password:
+                    smtp_server.login(emailAddress, password)
+                smtp_server.sendmail(emailAddress, emailAddress, msg.as_string())
+            return True
+        except Exception as e:
+            logging.error(f"Error occurred sending email: {e}")
+            return False
+
+
+class HTTPTransport:
+    """
+    Send alerts as JSON to an endpoint on our API
+
+    :param endpoint: The full URL alerts are posted to, or a function returning it (None when it isn't known yet) so credential changes are picked up
+    :param headers: Function returning the headers to send, called for every request so key changes are picked up
+    """
+
+    def __init__(self, endpoint, headers=None, timeout=20):
+        self.endpoint = endpoint
+        self.headers = headers if headers is not None else (lambda: {})
+        self.timeout = timeout
+
+    def send(self, subject, body, alerts) -> bool:
+        endpoint = self.endpoint() if callable(self.endpoint) else self.endpoint
+        if endpoint is None:
+            logging.warning("No API endpoint available, holding alerts")
+            return False
+
+        try:
+            response = httpx.post(
+                endpoint,
+                json={"subject": subject, "body": body, "alerts": alerts},
+                headers=self.headers(),
+                timeout=self.timeout,
+                verify=False,
+            )
+            return response.status_code < 300
+        except Exception as e:
+            logging.error(f"Error occurred sending alerts: {e}")
+            return False
+
+
+class AlertNotifier:
+    """
+    Create a new notifier, alerts are only sent once start() has been called from the proccess that will be reporting them
+
+    :param transport: The SMTPTransport or HTTPTransport digests are sent with
+    :param serial: The serial number of the device included in every digest
+    :param window: Seconds errors are collected for before a digest is sent
+    :param repeatInterval: Seconds before an error that was already sent is included in a digest again
+    :param maxAlerts: The most distinct errors held at once, the oldest are dropped beyond this
+    """
+
+    def __init__(self, transport, serial="", window=300, repeatInterval=3600, maxAlerts=50):
+        self.transport = transport
+        self.serial = serial
+        self.window = window
+        self.repeatInterval = repeatInterval
+        self.maxAlerts = maxAlerts
+        self.reports = queue.Queue()
+        self.pending = {}
+        self.lastSent = {}
+        self.worker = None
+
+    """
+    Start the background thread that aggregates and sends alerts
+    """
+
+    def start(self):
+        if self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    """
+    Report an error, this never blocks
+
+    :param code: The response code or other short identifier of the error
+    :param message: The error or response that was returned
+    """
+
+    def report(self, code, message):
+        self.reports.put((code, str(message), time()))
+
+    """
+    Send anything that is still pending and stop the background thread
+    """
+
+    def stop(self, timeout=30):
+        if self.worker is None:
+            return
+        self.reports.put(None)
+        self.worker.join(timeout)
+        self.worker = None
+
+    """
+    Errors that only differ by numbers, ids or timestamps are grouped together
+    """
+
+    def fingerprint(self, code, message) -> str:
+        normalized = re.sub(r"[0-9a-f]{8}-[0-9a-f-]{27}|\d+", "#", message.lower())[:500]
+        return hashlib.sha1(f"{code}:{normalized}".encode("utf-8")).hexdigest()
+
+    """
+    Add a report to the pending digest
+    """
+
+    def _collect(self, code, message, reportedAt):
+        key = self.fingerprint(code, message)
+        alert = self.pending.get(key)
+        if alert is None:
+            if len(self.pending) >= self.maxAlerts:
+                self.pending.pop(next(iter(self.pending)))
+            alert = {"code": code, "message": message, "count": 0, "first": reportedAt, "last": reportedAt}
+            self.pending[key] = alert
+        alert["count"] += 1
+        alert["last"] = reportedAt
+
+    """
+    Send everything that was collected during the last window as a single digest
+    """
+
+    def flush(self):
+        now = time()
+
+        # Anything sent longer ago than the repeat interval would be sent again anyway, so forget it instead of remembering every error ever seen
+        self.lastSent = {key: sentAt for key, sentAt in self.lastSent.items() if now - sentAt < self.repeatInterval}
+        due = {key: alert for key, alert in self.pending.items() if now - self.lastSent.get(key, 0) >= self.repeatInterval}
+
+        # Errors we have already told the support team about recently are dropped until the repeat interval is up
+        for key in list(self.pending):
+            if key not in due:
+                del self.pending[key]
+        if len(due) == 0:
+            return
+
+        alerts = list(due.values())
+        total = sum(alert["count"] for alert in alerts)
+        subject = f"[Bucket Upload Error] Device: {self.serial} encountered {total} errors ({len(alerts)} distinct)"
+        body = "\n\n".join(
+            f"Code {alert['code']} occurred {alert['count']} times, the following was returned as the error in question:\t{alert['message']}"
+            for alert in alerts
+        )
+
+        # If the transport fails the alerts stay pending and go out with the next digest
+        if self.transport.send(subject, body, alerts):
+            for key in due:
+                self.lastSent[key] = now
+                del self.pending[key]
+            logging.info(f"Sent digest of {len(alerts)} alerts")
+
+    def _run(self):
+        nextFlush = time() + self.window
+        while True:
+            try:
+                item = self.reports.get(timeout=max(0, nextFlush - time()))
+                if item is None:
+                    break
+                self._collect(*item)
+            except queue.Empty:
+                pass
+
+            if time() >= nextFlush:
+                self.flush()
+                nextFlush = time() + self.window
+
+        # Don't lose anything that was reported right before we were stopped
+        while not self.reports.empty():
+            item = self.reports.get_nowait()
+            if item is not None:
+                self._collect(*item)
+        self.flush()
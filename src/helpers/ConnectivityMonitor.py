@@ -0,0 +1,165 @@
+"""
+Oregon State University, 2024
+
+Tracks whether we are connected to a network and the internet from NetworkManager's D-Bus signals, falling back to a rate limited probe,
+and publishes the result into shared state so other proccesses can read it without forking nmcli or opening sockets
+"""
+
+import asyncio
+import logging
+import socket
+from time import time
+
+NM_BUS_NAME = "org.freedesktop.NetworkManager"
+NM_OBJECT_PATH = "/org/freedesktop/NetworkManager"
+
+# NMState values at or above this mean we have a network connection of some kind
+NM_STATE_CONNECTED_LOCAL = 50
+
+# NMConnectivityState values
+NM_CONNECTIVITY_UNKNOWN = 0
+NM_CONNECTIVITY_FULL = 4
+
+"""
+Read the connection state published by a ConnectivityMonitor
+
+:param state: Dictionary containing the shared wifi_connected and internet_access values
+:return: Dictionary of wifi_connected and internet_access each True, False or None if it isn't known yet
+"""
+def readConnectivity(state) -> dict:
+    result = {}
+    for key in ("wifi_connected", "internet_access"):
+        value = state[key].value if state is not None and key in state else -1
+        result[key] = None if value < 0 else bool(value)
+    return result
+
+
+class ConnectivityMonitor:
+    """
+    Create a new connectivity monitor
+
+    :param state: Dictionary of shared values to publish to, wifi_connected and internet_access are set to 1, 0 or -1 when unknown
+    :param probeHost: The host the fallback probe connects to
+    :param probePort: The port the fallback probe connects to
+    :param probeTimeout: Seconds before the probe gives up
+    :param minProbeInterval: Seconds that must pass between probes unless one is forced
+    :param onChange: Function called with the new internet access state whenever it changes
+    :param executor: BoundedExecutor the probe runs on, the event loop's default executor is used when None
+    """
+
+    def __init__(self, state, probeHost="8.8.8.8", probePort=53, probeTimeout=3, minProbeInterval=30, onChange=None, executor=None):
+        self.state = state
+        self.probeHost = probeHost
+        self.probePort = probePort
+        self.probeTimeout = probeTimeout
+        self.minProbeInterval = minProbeInterval
+        self.onChange = onChange
+        self.executor = executor
+        self.lastProbe = 0
+        self.networkManager = None
+        self.connectivityKnown = False
+
+    """
+    Subscribe to NetworkManager's property changes, if NetworkManager isn't reachable we fall back to probing
+
+    :param bus: A connected dbus-next system MessageBus
+    """
+
+    async def start(self, bus):
+        try:
+            introspection = await bus.introspect(NM_BUS_NAME, NM_OBJECT_PATH)
+            proxy = bus.get_proxy_object(NM_BUS_NAME, NM_OBJECT_PATH, introspection)
+            self.networkManager = proxy.get_interface("org.freedesktop.NetworkManager")
+            proxy.get_interface("org.freedesktop.DBus.Properties").on_properties_changed(self._onPropertiesChanged)
+
+            self._update(await self.networkManager.get_state(), await self.networkManager.get_connectivity())
+            logging.info("Monitoring connectivity through NetworkManager")
+        except Exception as e:
+            logging.warning(f"NetworkManager unavailable, falling back to probing connectivity: {e}")
+            self.networkManager = None
+            await self.poll(force=True)
+
+    """
+    Refresh our state if we aren't getting signals from NetworkManager, or NetworkManager doesn't know if we have internet access
+
+    :param force: Probe even if we probed recently
+    """
+
+    async def poll(self, force=False):
+        if self.networkManager is not None and self.connectivityKnown:
+            return
+        if not force and time() - self.lastProbe < self.minProbeInterval:
+            return
+        if self.executor is not None:
+            await self.executor.run(self.probe)
+        else:
+            await asyncio.get_event_loop().run_in_executor(None, self.probe)
+
+    """
+    Check our connection by looking for a default route and opening a connection to the probe host, this blocks for up to probeTimeout
+    """
+
+    def probe(self):
+        self.lastProbe = time()
+        hasRoute = self._hasDefaultRoute()
+        hasInternet = hasRoute and self._canConnect()
+        self._publish(hasRoute, hasInternet)
+        return hasInternet
+
+    def _onPropertiesChanged(self, interfaceName, changedProperties, invalidatedProperties):
+        if interfaceName != "org.freedesktop.NetworkManager":
+            return
+        if "State" in changedProperties or "Connectivity" in changedProperties:
+            asyncio.ensure_future(self._refreshFromNetworkManager())
+
+    async def _refreshFromNetworkManager(self):
+        try:
+            self._update(await self.networkManager.get_state(), await self.networkManager.get_connectivity())
+        except Exception as e:
+            logging.error(f"Failed to read NetworkManager state: {e}")
+
+    """
+    Translate NetworkManager's state into ours, when it can't tell if we have internet access we probe for it instead
+    """
+
+    def _update(self, nmState, nmConnectivity):
+        hasNetwork = nmState >= NM_STATE_CONNECTED_LOCAL
+        self.connectivityKnown = nmConnectivity != NM_CONNECTIVITY_UNKNOWN or not hasNetwork
+        if self.connectivityKnown:
+            self._publish(hasNetwork, hasNetwork and nmConnectivity == NM_CONNECTIVITY_FULL)
+        else:
+            # NetworkManager's own connectivity checking is turned off so probe for it without blocking the event loop
+            asyncio.ensure_future(self.poll(force=True))
+
+    def _publish(self, hasNetwork, hasInternet):
+        previous = self.state["internet_access"].value
+        self.state["wifi_connected"].value = int(hasNetwork)
+        self.state["internet_access"].value = int(hasInternet)
+
+        if previous != int(hasInternet):
+            logging.info(f"Internet access changed to {hasInternet}")
+            if self.onChange is not None:
+                self.onChange(hasInternet)
+
+    """
+    Open and close a TCP connection to the probe host, the timeout only applies to this socket
+    """
+
+    def _canConnect(self) -> bool:
+        try:
+            with socket.create_connection((self.probeHost, self.probePort), timeout=self.probeTimeout):
+                return True
+        except OSError:
+            return False
+
+    """
+    Check the kernel routing table for a default route without forking anything
+    """
+
+    def _hasDefaultRoute(self) -> bool:
+        try:
+            with open("/proc/net/route", "r") as routes:
+                next(routes)
+                return any(line.split()[1] == "00000000" for line in routes if len(line.split()) > 1)
+        except (OSError, StopIteration):
+            return False
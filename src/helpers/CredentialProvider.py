@@ -0,0 +1,251 @@
+"""
+Oregon State University, 2024
+
+Process wide access to our API and email credentials, secrets are fetched lazily in the background and cached on disk so nothing blocks on AWS
+
+The cache is only readable by our user, it is also sealed with AES-GCM under a key derived from this device's identifiers. Any local proccess
+can read those identifiers so this only stops a copy of the cache being read on another device, the file permissions are what keep it private
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+from time import time
+
+import botocore
+import botocore.config
+import botocore.session
+from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:
+    AESGCM = None
+
+EMAIL_SECRET_NAME = "sb_notification_email"
+PASSWORD_SECRET_NAME = "sb_notification_password"
+SECRETS_REGION = "us-west-2"
+
+# One provider per secret file in each proccess
+_providers = {}
+_providersLock = threading.Lock()
+
+"""
+Get the credential provider shared by everything in this proccess
+
+:param secretFile: The JSON file our API credentials are stored in
+"""
+def getCredentialProvider(secretFile="config.secret", cacheFile="../data/credentials.cache"):
+    with _providersLock:
+        if secretFile not in _providers:
+            _providers[secretFile] = CredentialProvider(secretFile, cacheFile)
+        return _providers[secretFile]
+
+
+class CredentialProvider:
+    """
+    Create a new credential provider, use getCredentialProvider() instead so every RequestHandler in a proccess shares one
+
+    :param secretFile: The JSON file our API credentials are stored in
+    :param cacheFile: Where secrets fetched from AWS are cached, it is only written when the cryptography package is installed
+    :param ttl: Seconds a cached secret is used before it is refreshed in the background
+    """
+
+    def __init__(self, secretFile="config.secret", cacheFile="../data/credentials.cache", ttl=24 * 3600):
+        self.secretFile = secretFile
+        self.cacheFile = cacheFile
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.listeners = []
+
+        self.apiCredentials = None
+        self.apiCredentialsModified = None
+        self.apiCredentialsError = None
+
+        self.emailCredentials = None
+        self.emailFetchedAt = 0
+        self.fetchThread = None
+        self.secretCache = None
+        self._loadCache()
+
+    """
+    Get our API credentials as a dictionary of apiKey, endpoint and port, the file is only re-read when it changes so credentials written by another proccess are picked up
+
+    :return: The credentials, the last ones that could be read if the file is missing or corrupt or None if it has never been read
+    """
+
+    def getAPICredentials(self) -> dict:
+        try:
+            modified = os.stat(self.secretFile).st_mtime_ns
+            if self.apiCredentials is None or modified != self.apiCredentialsModified:
+                with open(self.secretFile, "r") as secretFile:
+                    credsJson = json.load(secretFile)
+                changed = self.apiCredentials is not None
+                self.apiCredentials = {
+                    "apiKey": credsJson["FASTAPI_CREDS"]["apiKey"],
+                    "endpoint": credsJson["FASTAPI_CREDS"]["endpoint"],
+                    "port": credsJson["FASTAPI_CREDS"]["port"],
+                }
+                self.apiCredentialsModified = modified
+                self.apiCredentialsError = None
+                if changed:
+                    self._notify()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # Only log when the problem changes, this is checked every time the credentials are used
+            if str(e) != self.apiCredentialsError:
+                self.apiCredentialsError = str(e)
+                logging.error(f"Unable to read API credentials from {self.secretFile}: {e}")
+        return self.apiCredentials
+
+    """
+    Store new API credentials, the file is replaced atomically and everyone subscribed in this proccess is told straight away
+
+    :param apiKey: The key used to authenticate with our API
+    :param endpoint: The host of our API
+    :param port: The port of our API
+    """
+
+    def setAPICredentials(self, apiKey, endpoint, port):
+        creds = {
+            "FASTAPI_CREDS": {
+                "apiKey": apiKey,
+                "endpoint": endpoint,
+                "port": int(port),
+            }
+        }
+        tempFile = self.secretFile + ".tmp"
+        with open(tempFile, "w") as file:
+            file.write(json.dumps(creds))
+        os.replace(tempFile, self.secretFile)
+
+        self.reload()
+
+    """
+    Re-read the API credentials from the secret file even if it doesn't look like it changed
+    """
+
+    def reload(self):
+        self.apiCredentialsModified = None
+        return self.getAPICredentials()
+
+    """
+    Register a function that is called whenever the API credentials change
+
+    :param callback: Function taking the new credential dictionary
+    """
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    """
+    Get the email address and app password alerts are sent with, the first call starts fetching them in the background
+
+    :param wait: Seconds to wait for a fetch to finish when we don't have any credentials yet, by default this never blocks on the network
+    :return: Tuple of (emailAddress, password) or None if they haven't been fetched yet
+    """
+
+    def getEmailCredentials(self, wait=None):
+        if self.emailCredentials is None or time() - self.emailFetchedAt > self.ttl:
+            self.refreshEmailCredentials()
+            if self.emailCredentials is None and wait is not None:
+                self.fetchThread.join(wait)
+        return self.emailCredentials
+
+    """
+    Fetch the email credentials from AWS in a background thread if a fetch isn't already running
+    """
+
+    def refreshEmailCredentials(self):
+        with self.lock:
+            if self.fetchThread is not None and self.fetchThread.is_alive():
+                return
+            self.fetchThread = threading.Thread(target=self._fetchEmailCredentials, daemon=True)
+            self.fetchThread.start()
+
+    def _fetchEmailCredentials(self):
+        try:
+            if self.secretCache is None:
+                # Fail fast instead of hanging when we don't have a network connection yet
+                config = botocore.config.Config(connect_timeout=5, read_timeout=10, retries={"max_attempts": 1})
+                client = botocore.session.get_session().create_client("secretsmanager", region_name=SECRETS_REGION, config=config)
+                self.secretCache = SecretCache(config=SecretCacheConfig(), client=client)
+
+            email = self.secretCache.get_secret_string(EMAIL_SECRET_NAME)
+            password = self.secretCache.get_secret_string(PASSWORD_SECRET_NAME)
+        except Exception as e:
+            logging.error(f"Failed to retrieve email credentials: {e}")
+            return
+
+        self.emailCredentials = (email, password)
+        self.emailFetchedAt = time()
+        self._saveCache()
+        logging.info("Retrieved email credentials")
+
+    def _notify(self):
+        for callback in self.listeners:
+            try:
+                callback(self.apiCredentials)
+            except Exception as e:
+                logging.error(f"Credential change listener failed: {e}")
+
+    """
+    Derive the key the on disk cache is sealed with from identifiers unique to this device, a copy of the cache is useless on any other device
+    """
+
+    def _deviceKey(self) -> bytes:
+        identity = b""
+        try:
+            with open("/etc/machine-id", "rb") as f:
+                identity += f.read().strip()
+        except OSError:
+            pass
+
+        # Only the serial number, the rest of cpuinfo can change between boots
+        try:
+            with open("/proc/cpuinfo", "rb") as f:
+                identity += b"".join(line.strip() for line in f if line.startswith(b"Serial"))
+        except OSError:
+            pass
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"binsight-credentials-cache-v2").derive(identity)
+
+    def _saveCache(self):
+        if AESGCM is None:
+            logging.warning("cryptography is not installed, email credentials will not be cached on disk")
+            return
+
+        nonce = os.urandom(12)
+        plaintext = json.dumps({"email": self.emailCredentials, "fetchedAt": self.emailFetchedAt}).encode("utf-8")
+        ciphertext = AESGCM(self._deviceKey()).encrypt(nonce, plaintext, None)
+
+        tempFile = self.cacheFile + ".tmp"
+        try:
+            # Create the file without group or other permissions rather than narrowing them after the secrets are written
+            with os.fdopen(os.open(tempFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as outFile:
+                outFile.write(base64.b64encode(nonce + ciphertext))
+            os.chmod(tempFile, 0o600)
+            os.replace(tempFile, self.cacheFile)
+        except OSError as e:
+            logging.error(f"Failed to save credential cache: {e}")
+
+    """
+    Load secrets cached by a previous run, they are used even if they are past their TTL until a fresh copy has been fetched
+    """
+
+    def _loadCache(self):
+        if AESGCM is None or not os.path.exists(self.cacheFile):
+            return
+        try:
+            with open(self.cacheFile, "rb") as inFile:
+                raw = base64.b64decode(inFile.read())
+            cached = json.loads(AESGCM(self._deviceKey()).decrypt(raw[:12], raw[12:], None))
+            self.emailCredentials = tuple(cached["email"]) if cached["email"] is not None else None
+            self.emailFetchedAt = cached["fetchedAt"]
+        except InvalidTag:
+            logging.error("Credential cache was not created on this device, ignoring it")
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Failed to load credential cache: {e}")
@@ -0,0 +1,140 @@
+"""
+Oregon State University, 2024
+
+Keeps blocking work off of an asyncio event loop and measures how responsive the loop is, used by the bluetooth driver so GATT requests are answered promptly
+"""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+"""
+Wrap a GATT characteristic getter or setter so its run time is checked against the latency budget of the EventLoopMonitor on its service
+
+The service must have a loopMonitor attribute, the handler is run as normal when it is None
+"""
+def timedHandler(func):
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        start = perf_counter()
+        try:
+            return func(self, *args)
+        finally:
+            monitor = getattr(self, "loopMonitor", None)
+            if monitor is not None:
+                monitor.recordHandler(func.__name__, perf_counter() - start)
+
+    return wrapper
+
+
+class BoundedExecutor:
+    """
+    Create a thread pool that refuses new work once too much is queued, so a client spamming writes can't queue up minutes of nmcli calls
+
+    :param maxWorkers: The most functions run at the same time
+    :param maxPending: The most functions running or waiting to run
+    """
+
+    def __init__(self, maxWorkers=2, maxPending=8):
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="blocking")
+        self.maxPending = maxPending
+        self.pending = 0
+
+    """
+    Run a blocking function in the pool without blocking the event loop
+
+    :param func: The function to run
+    :param args: The arguments to pass to the function
+    :param force: Queue the function even if the pool is full, for work that must not be lost like storing credentials
+    :return: The result of the function, or None if the pool is full and the function wasn't run
+    """
+
+    async def run(self, func, *args, force=False):
+        if self.pending >= self.maxPending and not force:
+            logging.warning(f"Too much blocking work queued, dropping {func.__name__}")
+            return None
+
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    """
+    Run a blocking function in the pool without waiting for it, exceptions are logged
+    """
+
+    def submit(self, func, *args):
+        return asyncio.ensure_future(self._runLogged(func, *args))
+
+    async def _runLogged(self, func, *args):
+        try:
+            return await self.run(func, *args)
+        except Exception as e:
+            logging.error(f"{func.__name__} failed: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class EventLoopMonitor:
+    """
+    Create a new monitor, call run() as a task on the loop being measured
+
+    :param state: Dictionary of shared values to publish to, loop_lag_ms and slow_responses are updated when given
+    :param budget: Seconds a GATT handler or a single pass of the loop may take before it is reported as slow
+    :param interval: Seconds between lag measurements
+    """
+
+    def __init__(self, state=None, budget=0.1, interval=0.5):
+        self.state = state
+        self.budget = budget
+        self.interval = interval
+        self.lag = 0
+        self.worstLag = 0
+        self.slowResponses = 0
+        self.lastWarning = 0
+
+    """
+    Measure how late the loop wakes us up, if something blocks the loop the lag is roughly how long it blocked for
+    """
+
+    async def run(self):
+        while True:
+            start = perf_counter()
+            await asyncio.sleep(self.interval)
+            self.recordLag(perf_counter() - start - self.interval)
+
+    def recordLag(self, lag):
+        self.lag = max(0, lag)
+        self.worstLag = max(self.worstLag, self.lag)
+        if self.state is not None:
+            self.state["loop_lag_ms"].value = self.lag * 1000
+        if self.lag > self.budget:
+            self._warn(f"Bluetooth event loop was blocked for {self.lag * 1000:.0f}ms")
+
+    """
+    Record how long a GATT handler took to respond
+
+    :param name: The name of the handler
+    :param duration: Seconds the handler ran for
+    """
+
+    def recordHandler(self, name, duration):
+        if duration <= self.budget:
+            return
+        self.slowResponses += 1
+        if self.state is not None:
+            self.state["slow_responses"].value = self.slowResponses
+        self._warn(f"{name} took {duration * 1000:.0f}ms to respond, over the {self.budget * 1000:.0f}ms budget")
+
+    """
+    Log at most one warning every few seconds so a stalled loop doesn't flood the log
+    """
+
+    def _warn(self, message):
+        if time() - self.lastWarning > 5:
+            self.lastWarning = time()
+            logging.warning(message)
@@ -0,0 +1,323 @@
+"""
+Oregon State University, 2024
+
+Counters, gauges and histograms that live in shared memory so every driver proccess can record to them and the main proccess can serve them in the Prometheus text format
+"""
+
+import logging
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Array, Value
+from time import perf_counter
+
+# Upper bounds in seconds, wide enough to cover a 1ms LidSwitch loop as well as a minute long upload
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+"""
+Format a set of labels the way Prometheus expects them, {driver="NAU7802",endpoint="scan"}
+"""
+def formatLabels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+"""
+Read the resident memory, CPU time and disk writes of a proccess from /proc without any extra dependencies
+
+:param pid: The proccess to read, our own when None
+:return: Dictionary of rss_bytes, peak_rss_bytes, cpu_seconds and disk_write_bytes or None if the proccess is gone,
+    the peak and disk writes are left out on kernels that don't report them
+"""
+def readProcessStats(pid=None) -> dict:
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open(f"/proc/{pid}/stat", "r") as statFile:
+            # The command name can contain spaces so split after its closing bracket
+            fields = statFile.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm", "r") as statmFile:
+            residentPages = int(statmFile.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    ticks = os.sysconf("SC_CLK_TCK")
+    stats = {
+        "rss_bytes": residentPages * os.sysconf("SC_PAGE_SIZE"),
+        # utime and stime are the 12th and 13th fields after the command name
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+    }
+
+    # The high water mark of resident memory is reported in kB
+    try:
+        with open(f"/proc/{pid}/status", "r") as statusFile:
+            for line in statusFile:
+                if line.startswith("VmHWM:"):
+                    stats["peak_rss_bytes"] = int(line.split()[1]) * 1024
+                    break
+    except (OSError, IndexError, ValueError):
+        pass
+
+    # Bytes the proccess caused to be written to storage, unlike wchar this leaves out sockets and pipes
+    try:
+        with open(f"/proc/{pid}/io", "r") as ioFile:
+            for line in ioFile:
+                if line.startswith("write_bytes:"):
+                    stats["disk_write_bytes"] = int(line.split()[1])
+                    break
+    except (OSError, IndexError, ValueError):
+        pass
+    return stats
+
+
+class Counter:
+    """
+    A value that only goes up, create it before the proccesses that record to it are started
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = Value("d", 0.0)
+
+    def inc(self, amount=1):
+        with self.value.get_lock():
+            self.value.value += amount
+
+    """
+    Catch up to a total that is counted elsewhere, like the CPU time of a proccess read from /proc
+    """
+
+    def setTotal(self, total):
+        self.value.value = total
+
+    def render(self) -> list:
+        return [f"{self.name}{formatLabels(self.labels)} {self.value.value}"]
+
+    def snapshot(self):
+        return self.value.value
+
+
+class Gauge(Counter):
+    """
+    A value that can go up and down
+    """
+
+    type = "gauge"
+
+    def set(self, value):
+        self.value.value = value
+
+
+class Histogram:
+    """
+    Counts observations into buckets so percentiles can be estimated without keeping every sample
+
+    :param buckets: Upper bounds of each bucket in ascending order, anything larger goes in an implicit +Inf bucket
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+
+        # Per bucket counts followed by +Inf, the sum and the total count
+        self.values = Array("d", len(self.buckets) + 3)
+
+    def observe(self, value):
+        with self.values.get_lock():
+            self.values[bisect_left(self.buckets, value)] += 1
+            self.values[-2] += value
+            self.values[-1] += 1
+
+    """
+    Observe how long the body of a with block takes
+    """
+
+    @contextmanager
+    def time(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    """
+    Estimate a quantile by interpolating within the bucket it falls in
+
+    :param q: The quantile between 0 and 1
+    :return: The estimate, or 0 if nothing has been observed
+    """
+
+    def quantile(self, q) -> float:
+        with self.values.get_lock():
+            counts = list(self.values[: len(self.buckets) + 1])
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+
+        target = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= target and count > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                # Observations past the last bucket are reported as its bound
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> list:
+        with self.values.get_lock():
+            values = list(self.values)
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), values):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{formatLabels({**self.labels, 'le': bound})} {cumulative}")
+        lines.append(f"{self.name}_sum{formatLabels(self.labels)} {values[-2]}")
+        lines.append(f"{self.name}_count{formatLabels(self.labels)} {values[-1]}")
+        return lines
+
+    def snapshot(self):
+        return {
+            "count": int(self.values[-1]),
+            "sum": round(self.values[-2], 4),
+            "p50": round(self.quantile(0.5), 4),
+            "p95": round(self.quantile(0.95), 4),
+        }
+
+
+class MetricsRegistry:
+    """
+    Create a new registry
+
+    :param prefix: Prepended to the name of every metric
+    :param labels: Labels added to every metric in this registry, such as the driver that owns it
+    """
+
+    def __init__(self, prefix="binsight", labels=None):
+        self.prefix = prefix
+        self.labels = labels if labels is not None else {}
+        self.metrics = {}
+        self.children = []
+        self.collectors = []
+
+    def counter(self, name, help="", **labels) -> Counter:
+        return self._getOrCreate(Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels) -> Gauge:
+        return self._getOrCreate(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._getOrCreate(Histogram, name, help, labels, buckets)
+
+    """
+    Serve the metrics of another registry alongside ours, used to collect the registries of every driver
+    """
+
+    def include(self, registry):
+        self.children.append(registry)
+
+    """
+    Register a function that is called right before the metrics are read, for values that are cheaper to read on demand than to keep up to date
+    """
+
+    def addCollector(self, collector):
+        self.collectors.append(collector)
+
+    def allMetrics(self) -> list:
+        metrics = list(self.metrics.values())
+        for child in self.children:
+            metrics.extend(child.allMetrics())
+        return metrics
+
+    """
+    Render every metric in the Prometheus text exposition format
+    """
+
+    def render(self) -> str:
+        self._collect()
+        byName = {}
+        for metric in self.allMetrics():
+            byName.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name, metrics in byName.items():
+            lines.append(f"# HELP {name} {metrics[0].help}")
+            lines.append(f"# TYPE {name} {metrics[0].type}")
+            for metric in metrics:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    """
+    Summarize every metric in a compact dictionary small enough to include with each upload
+    """
+
+    def snapshot(self) -> dict:
+        self._collect()
+        return {
+            f"{metric.name[len(self.prefix) + 1:]}{formatLabels(metric.labels)}": metric.snapshot()
+            for metric in self.allMetrics()
+        }
+
+    def _collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+        for child in self.children:
+            child._collect()
+
+    def _getOrCreate(self, metricClass, name, help, labels, *args):
+        labels = {**self.labels, **labels}
+        fullName = f"{self.prefix}_{name}"
+        key = (fullName, tuple(sorted(labels.items())))
+        if key not in self.metrics:
+            self.metrics[key] = metricClass(fullName, help, labels, *args)
+        return self.metrics[key]
+
+
+"""
+Serve a registry over HTTP so it can be scraped, only on localhost by default since nothing here is authenticated
+
+:param registry: The MetricsRegistry to serve at /metrics
+:return: The running server, or None if the port couldn't be bound
+"""
+def startMetricsServer(registry, host="127.0.0.1", port=9464):
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes would otherwise be printed to stderr every few seconds
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        logging.error(f"Failed to start metrics server on {host}:{port}: {e}")
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,75 @@
+"""
+Oregon State University, 2024
+
+Encodes WiFi scan results for the bluetooth scan characteristic, strongest networks first and split into pages that each fit in a single GATT read or notification
+"""
+
+import json
+
+# The largest value a GATT characteristic can hold
+MAX_ATTRIBUTE_BYTES = 512
+
+# Short codes for the security types nmcli and NetworkManagerClient report
+SECURITY_CODES = {"Open": 0, "WEP": 1, "WPA1": 2, "WPA2": 3, "WPA3": 4, "WPA1 WPA2": 5, "WPA2 WPA3": 6}
+
+"""
+Sort scan results by signal strength, strongest first
+
+:param networks: Dictionary of SSID to {"strength", "security"}
+:return: List of (ssid, strength, security) tuples
+"""
+def sortNetworks(networks) -> list:
+    return sorted(
+        ((ssid, info["strength"], info["security"]) for ssid, info in networks.items()),
+        key=lambda network: network[1],
+        reverse=True,
+    )
+
+
+"""
+Encode scan results in the original {"ssid": {"strength", "security"}} format, keeping the strongest networks that fit
+
+:param networks: Dictionary of SSID to {"strength", "security"}
+:param maxBytes: The most bytes the encoded result may take up
+"""
+def encodeLegacy(networks, maxBytes=MAX_ATTRIBUTE_BYTES) -> bytes:
+    entries = []
+    size = 2
+    for ssid, strength, security in sortNetworks(networks):
+        entry = json.dumps({ssid: {"strength": strength, "security": security}})[1:-1]
+        entrySize = len(entry.encode("utf-8")) + (2 if len(entries) > 0 else 0)
+        if size + entrySize > maxBytes:
+            break
+        entries.append(entry)
+        size += entrySize
+    return ("{" + ", ".join(entries) + "}").encode("utf-8")
+
+
+"""
+Split scan results into compact pages, each one is {"p": page, "of": pageCount, "n": [[ssid, strength, securityCode], ...]}
+
+Security codes come from SECURITY_CODES, anything else is sent as the security string itself
+
+:param networks: Dictionary of SSID to {"strength", "security"}
+:param maxBytes: The most bytes a single page may take up
+:return: List of encoded pages, there is always at least one even if it is empty
+"""
+def encodePages(networks, maxBytes=MAX_ATTRIBUTE_BYTES) -> list:
+    # Room for the page header with up to three digit page numbers
+    available = maxBytes - len('{"p":999,"of":999,"n":[]}')
+
+    pages = [[]]
+    size = 0
+    for ssid, strength, security in sortNetworks(networks):
+        entry = json.dumps([ssid, strength, SECURITY_CODES.get(security, security)], separators=(",", ":"), ensure_ascii=False)
+        entrySize = len(entry.encode("utf-8"))
+        if len(pages[-1]) > 0 and size + 1 + entrySize > available:
+            pages.append([])
+            size = 0
+        size += entrySize + (1 if len(pages[-1]) > 0 else 0)
+        pages[-1].append(entry)
+
+    return [
+        f'{{"p":{i},"of":{len(pages)},"n":[{",".join(page)}]}}'.encode("utf-8")
+        for i, page in enumerate(pages)
+    ]
@@ -0,0 +1,252 @@
+"""
+Oregon State University, 2024
+
+Asynchronous client for NetworkManager's D-Bus API so WiFi can be scanned, joined and checked without blocking the bluetooth event loop on nmcli
+"""
+
+import asyncio
+import logging
+from time import time
+
+from dbus_next import Variant
+from dbus_next.errors import DBusError
+
+NM_BUS_NAME = "org.freedesktop.NetworkManager"
+NM_OBJECT_PATH = "/org/freedesktop/NetworkManager"
+NM_SETTINGS_PATH = "/org/freedesktop/NetworkManager/Settings"
+NM_INTERFACE = "org.freedesktop.NetworkManager"
+NM_DEVICE_INTERFACE = "org.freedesktop.NetworkManager.Device"
+NM_WIRELESS_INTERFACE = "org.freedesktop.NetworkManager.Device.Wireless"
+NM_AP_INTERFACE = "org.freedesktop.NetworkManager.AccessPoint"
+NM_ACTIVE_INTERFACE = "org.freedesktop.NetworkManager.Connection.Active"
+NM_SETTINGS_INTERFACE = "org.freedesktop.NetworkManager.Settings"
+NM_CONNECTION_INTERFACE = "org.freedesktop.NetworkManager.Settings.Connection"
+
+NM_DEVICE_TYPE_WIFI = 2
+NM_ACTIVE_CONNECTION_ACTIVATED = 2
+NM_ACTIVE_CONNECTION_DEACTIVATED = 4
+
+# NM80211ApFlags and NM80211ApSecurityFlags
+NM_AP_FLAGS_PRIVACY = 0x1
+NM_AP_SEC_KEY_MGMT_SAE = 0x400
+
+# NMWepKeyType values
+NM_WEP_KEY_TYPE_KEY = 1
+NM_WEP_KEY_TYPE_PASSPHRASE = 2
+
+
+class NetworkManagerClient:
+    """
+    Create a new client, nothing is sent until connect() is awaited
+
+    :param bus: A connected dbus-next system MessageBus
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.networkManager = None
+        self.devicePath = None
+        self.wireless = None
+        self.introspections = {}
+
+    """
+    Find the WiFi device that everything else is done on
+
+    :return: True if NetworkManager is running and we have a WiFi device
+    """
+
+    async def connect(self) -> bool:
+        try:
+            self.networkManager = await self._getInterface(NM_OBJECT_PATH, NM_INTERFACE)
+            for devicePath in await self.networkManager.call_get_devices():
+                device = await self._getInterface(devicePath, NM_DEVICE_INTERFACE)
+                if await device.get_device_type() == NM_DEVICE_TYPE_WIFI:
+                    self.devicePath = devicePath
+                    self.wireless = await self._getInterface(devicePath, NM_WIRELESS_INTERFACE)
+                    logging.info(f"Using WiFi device {await device.get_interface()} through NetworkManager")
+                    return True
+        except DBusError as e:
+            logging.error(f"Failed to connect to NetworkManager: {e}")
+            return False
+
+        logging.error("NetworkManager has no WiFi device")
+        return False
+
+    """
+    Ask for a fresh scan and return every network in range
+
+    :param timeout: The most seconds to wait for the scan to finish
+    :return: Dictionary of SSID to {"strength", "security"}, the strongest access point is kept when several share a name
+    """
+
+    async def scan(self, timeout=10) -> dict:
+        lastScan = await self.wireless.get_last_scan()
+        try:
+            await self.wireless.call_request_scan({})
+        except DBusError as e:
+            # NetworkManager refuses to scan again right after a scan, the existing results are still fresh
+            logging.info(f"Scan not started: {e}")
+        else:
+            deadline = time() + timeout
+            while time() < deadline and await self.wireless.get_last_scan() == lastScan:
+                await asyncio.sleep(0.5)
+
+        networks = {}
+        for apPath in await self.wireless.call_get_all_access_points():
+            try:
+                accessPoint = await self._getInterface(apPath, NM_AP_INTERFACE)
+                ssid = bytes(await accessPoint.get_ssid()).decode("utf-8", errors="replace")
+                strength = int(await accessPoint.get_strength())
+                security = self._describeSecurity(
+                    await accessPoint.get_flags(), await accessPoint.get_wpa_flags(), await accessPoint.get_rsn_flags()
+                )
+            except DBusError:
+                # Access points disappear while we are reading them
+                continue
+
+            if len(ssid) > 0 and (ssid not in networks or networks[ssid]["strength"] < strength):
+                networks[ssid] = {"strength": strength, "security": security}
+        return networks
+
+    """
+    Join a network and wait for the connection to come up
+
+    :param ssid: The network name to connect to
+    :param password: The password of the network, empty for open networks
+    :param timeout: The most seconds to wait for the connection to activate
+    :return: Tuple of (success, message)
+    """
+
+    async def connectToNetwork(self, ssid, password, timeout=45):
+        settings = {
+            "connection": {
+                "id": Variant("s", ssid),
+                "type": Variant("s", "802-11-wireless"),
+                # Enable unlimited reconnection attempts for the given network
+                "autoconnect-retries": Variant("i", 0),
+            },
+            "802-11-wireless": {"ssid": Variant("ay", ssid.encode("utf-8"))},
+        }
+
+        # Like nmcli we only give the secret and activate on the access point itself, NetworkManager fills in the key management it uses (WPA, WPA3 or WEP)
+        apPath, flags, wpaFlags, rsnFlags = await self._findAccessPoint(ssid)
+        if len(password) > 0:
+            if flags & NM_AP_FLAGS_PRIVACY and wpaFlags == 0 and rsnFlags == 0:
+                # Raw WEP keys are 5 or 13 characters or 10 or 26 hex digits, anything else is a passphrase
+                isKey = len(password) in (5, 13) or (len(password) in (10, 26) and all(c in "0123456789abcdefABCDEF" for c in password))
+                settings["802-11-wireless-security"] = {
+                    "wep-key0": Variant("s", password),
+                    "wep-key-type": Variant("u", NM_WEP_KEY_TYPE_KEY if isKey else NM_WEP_KEY_TYPE_PASSPHRASE),
+                }
+            else:
+                settings["802-11-wireless-security"] = {"psk": Variant("s", password)}
+
+        try:
+            _, activePath = await self.networkManager.call_add_and_activate_connection(settings, self.devicePath, apPath)
+            activeConnection = await self._getInterface(activePath, NM_ACTIVE_INTERFACE)
+
+            message = "Timed out waiting for the connection to activate"
+            deadline = time() + timeout
+            while time() < deadline:
+                state = await activeConnection.get_state()
+                if state == NM_ACTIVE_CONNECTION_ACTIVATED:
+                    return True, "Wi-Fi configuration successful"
+                if state == NM_ACTIVE_CONNECTION_DEACTIVATED:
+                    message = "The connection was rejected, check the password"
+                    break
+                await asyncio.sleep(0.5)
+        except DBusError as e:
+            return False, str(e)
+
+        # Don't leave a profile with the wrong password behind to be retried forever
+        await self.deleteConnection(ssid)
+        return False, message
+
+    """
+    Find the strongest access point broadcasting a network from the last scan
+
+    :return: Tuple of (path, flags, wpaFlags, rsnFlags), the path is "/" with no flags if the network isn't in range
+    """
+
+    async def _findAccessPoint(self, ssid):
+        best = ("/", 0, 0, 0)
+        bestStrength = -1
+        try:
+            apPaths = await self.wireless.call_get_all_access_points()
+        except DBusError as e:
+            logging.error(f"Failed to list access points: {e}")
+            return best
+
+        for apPath in apPaths:
+            try:
+                accessPoint = await self._getInterface(apPath, NM_AP_INTERFACE)
+                if bytes(await accessPoint.get_ssid()).decode("utf-8", errors="replace") != ssid:
+                    continue
+                strength = int(await accessPoint.get_strength())
+                if strength > bestStrength:
+                    bestStrength = strength
+                    best = (apPath, await accessPoint.get_flags(), await accessPoint.get_wpa_flags(), await accessPoint.get_rsn_flags())
+            except DBusError:
+                continue
+        return best
+
+    """
+    Remove every saved connection profile with the given name
+
+    :return: True if a profile was removed
+    """
+
+    async def deleteConnection(self, ssid) -> bool:
+        settings = await self._getInterface(NM_SETTINGS_PATH, NM_SETTINGS_INTERFACE)
+        deleted = False
+        for connectionPath in await settings.call_list_connections():
+            try:
+                connection = await self._getInterface(connectionPath, NM_CONNECTION_INTERFACE)
+                connectionSettings = await connection.call_get_settings()
+                if connectionSettings["connection"]["id"].value == ssid:
+                    await connection.call_delete()
+                    deleted = True
+            except DBusError as e:
+                logging.error(f"Failed to delete connection {connectionPath}: {e}")
+        return deleted
+
+    """
+    Get the names of the connections that are currently active
+    """
+
+    async def activeConnections(self) -> list:
+        names = []
+        for activePath in await self.networkManager.get_active_connections():
+            try:
+                activeConnection = await self._getInterface(activePath, NM_ACTIVE_INTERFACE)
+                names.append(await activeConnection.get_id())
+            except DBusError:
+                continue
+        return names
+
+    """
+    Map the flags of an access point onto the same names nmcli reports
+    """
+
+    def _describeSecurity(self, flags, wpaFlags, rsnFlags) -> str:
+        security = []
+        if wpaFlags != 0:
+            security.append("WPA1")
+        if rsnFlags & NM_AP_SEC_KEY_MGMT_SAE:
+            security.append("WPA3")
+        elif rsnFlags != 0:
+            security.append("WPA2")
+        if len(security) == 0 and flags & NM_AP_FLAGS_PRIVACY:
+            security.append("WEP")
+        return " ".join(security) if len(security) > 0 else "Open"
+
+    """
+    Get a proxy interface for an object, objects of the same kind share an introspection so every access point doesn't cost an extra round trip
+    """
+
+    async def _getInterface(self, path, interfaceName):
+        introspection = self.introspections.get(interfaceName)
+        if introspection is None:
+            introspection = await self.bus.introspect(NM_BUS_NAME, path)
+            self.introspections[interfaceName] = introspection
+        return self.bus.get_proxy_object(NM_BUS_NAME, path, introspection).get_interface(interfaceName)
@@ -0,0 +1,155 @@
+"""
+Oregon State University, 2024
+
+Schedules failed uploads to be retried with jittered exponential backoff and stops all attempts while the connection is known to be down
+"""
+
+import heapq
+import itertools
+import logging
+import random
+from time import time
+
+
+class RetryScheduler:
+    """
+    Create a new retry scheduler
+
+    :param baseDelay: Seconds to wait before the first retry
+    :param maxDelay: The longest we will ever wait between retries of a single item
+    :param jitter: Fraction of each delay that is randomized so a fleet of devices doesn't retry in lockstep
+    """
+
+    def __init__(self, baseDelay=5.0, maxDelay=900.0, jitter=0.5):
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self.attempts = {}
+        self.heap = []
+        self.counter = itertools.count()
+
+    """
+    Get how long to wait before the next attempt of an item that has failed a given number of times
+    """
+
+    def backoff(self, attempts) -> float:
+        delay = min(self.maxDelay, self.baseDelay * 2 ** max(0, attempts - 1))
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+    """
+    Schedule an item to be retried after it failed, each consecutive failure doubles the wait
+
+    :param key: Unique identifier of the item such as the scan uid
+    :param item: The item that will be handed back when it is due
+    """
+
+    def retry(self, key, item):
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        delay = self.backoff(self.attempts[key])
+        heapq.heappush(self.heap, (time() + delay, next(self.counter), key, item))
+        logging.info(f"Retrying {key} in {delay:.1f} seconds after {self.attempts[key]} failed attempts")
+
+    """
+    Hold onto an item that wasn't attempted at all, it is due straight away and its backoff isn't increased
+    """
+
+    def defer(self, key, item):
+        heapq.heappush(self.heap, (time(), next(self.counter), key, item))
+
+    """
+    Forget the failure count of an item once it has succeeded
+    """
+
+    def success(self, key):
+        self.attempts.pop(key, None)
+
+    """
+    Check if any items are ready to be attempted again
+    """
+
+    def hasDue(self) -> bool:
+        return len(self.heap) > 0 and self.heap[0][0] <= time()
+
+    """
+    Take the item that has been waiting the longest off the schedule, None if nothing is due
+    """
+
+    def popDue(self):
+        if not self.hasDue():
+            return None
+        return heapq.heappop(self.heap)[3]
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class CircuitBreaker:
+    """
+    Create a new circuit breaker, after enough consecutive failures it opens and blocks requests until a single probe is allowed through
+
+    :param failureThreshold: Consecutive failures before the breaker opens
+    :param resetTimeout: Seconds the breaker stays open before letting a probe through, doubled every time a probe fails
+    :param maxResetTimeout: The longest the breaker will stay open before probing
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+
+    def __init__(self, failureThreshold=3, resetTimeout=30.0, maxResetTimeout=600.0):
+        self.failureThreshold = failureThreshold
+        self.baseResetTimeout = resetTimeout
+        self.maxResetTimeout = maxResetTimeout
+        self.resetTimeout = resetTimeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openUntil = 0
+        self.hasConnectivity = True
+
+    """
+    Check if requests are currently being blocked
+    """
+
+    def isOpen(self) -> bool:
+        if not self.hasConnectivity:
+            return True
+        return self.state == self.OPEN and time() < self.openUntil
+
+    """
+    Check if the next request is a probe to see if the connection has come back
+    """
+
+    def isProbing(self) -> bool:
+        return self.state == self.OPEN and not self.isOpen()
+
+    def recordSuccess(self):
+        if self.state == self.OPEN:
+            logging.info("Connection restored, closing circuit breaker")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.resetTimeout = self.baseResetTimeout
+
+    def recordFailure(self):
+        self.failures += 1
+        if self.state == self.OPEN:
+            # A failed probe keeps us open for twice as long
+            self.resetTimeout = min(self.maxResetTimeout, self.resetTimeout * 2)
+        elif self.failures < self.failureThreshold:
+            return
+
+        self.state = self.OPEN
+        self.openUntil = time() + self.resetTimeout
+        logging.warning(f"Circuit breaker open, next attempt in {self.resetTimeout:.0f} seconds")
+
+    """
+    Feed in the connectivity state reported by the rest of the system, nothing is attempted while we know we are offline and a probe is allowed as soon as we come back
+
+    :param hasConnectivity: True or False, None if it isn't known yet
+    """
+
+    def setConnectivity(self, hasConnectivity):
+        if hasConnectivity is None or hasConnectivity == self.hasConnectivity:
+            return
+
+        self.hasConnectivity = hasConnectivity
+        if hasConnectivity and self.state == self.OPEN:
+            self.openUntil = time()
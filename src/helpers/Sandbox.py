@@ -0,0 +1,149 @@
+"""
+Oregon State University, 2024
+
+Runs the firmware away from the device's data and API, a throwaway copy of the directory layout gets its own data directory and
+credentials pointing at a local mock of the scan API so simulated scans never reach the real server
+"""
+
+import json
+import os
+import shutil
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Value
+from pathlib import Path
+from time import sleep
+
+
+class CountingWriter():
+    """
+    Wraps the file a response is written to so every byte sent back to the device is counted
+    """
+    def __init__(self, file, counter: Value):
+        self.file = file
+        self.counter = counter
+
+    def write(self, data):
+        with self.counter.get_lock():
+            self.counter.value += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class MockScanAPI():
+    """
+    Minimal stand in for the scan API that acknowledges every scan, it is served from its own proccess so handling uploads isn't counted against the firmware
+
+    :param latency: Seconds to wait before answering each request to simulate a slow link
+    """
+    def __init__(self, host="127.0.0.1", latency=0.0):
+        self.latency = latency
+        self.stats = {name: Value("d", 0.0) for name in ("requests", "scans", "bytes_received", "bytes_sent")}
+
+        # The socket is bound here so the port is known before the server proccess is started
+        self.server = ThreadingHTTPServer((host, 0), self._createHandler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.proccess = None
+
+    def start(self):
+        self.proccess = Process(target=self.server.serve_forever, daemon=True)
+        self.proccess.start()
+
+    def kill(self):
+        if self.proccess is not None:
+            self.proccess.terminate()
+        self.server.server_close()
+
+    def get(self, name) -> float:
+        return self.stats[name].value
+
+    def _count(self, name, amount=1):
+        with self.stats[name].get_lock():
+            self.stats[name].value += amount
+
+    def _createHandler(self):
+        api = self
+
+        class MockRequestHandler(BaseHTTPRequestHandler):
+            def setup(self):
+                super().setup()
+                self.wfile = CountingWriter(self.wfile, api.stats["bytes_sent"])
+
+            def do_GET(self):
+                self.readRequest()
+                if self.path.startswith("/api/health/"):
+                    self.reply({"is_alive": True})
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                body = self.readRequest()
+                sleep(api.latency)
+                if self.path == "/api/scan":
+                    api._count("scans")
+                    self.reply({"status": True})
+                elif self.path == "/api/scan/batch":
+                    uids = [scan["uid"] for scan in self.readForm(body).get("scans", [])]
+                    api._count("scans", len(uids))
+                    self.reply({"status": True, "results": {uid: {"status": True} for uid in uids}})
+                else:
+                    self.send_error(404)
+
+            def readRequest(self) -> bytes:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                api._count("requests")
+                api._count("bytes_received", len(self.raw_requestline) + len(self.headers.as_bytes()) + len(body))
+                return body
+
+            # Only the JSON data field of the multipart form is needed to acknowledge a batch
+            def readForm(self, body) -> dict:
+                message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+                for part in message.iter_parts():
+                    if part.get_param("name", header="content-disposition") == "data":
+                        return json.loads(part.get_content())
+                return {}
+
+            def reply(self, response):
+                body = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MockRequestHandler
+
+
+"""
+Create a copy of the directory layout the firmware expects with its own data directory and credentials pointing at the mock API
+
+:param workdir: The directory to create the layout in
+:param port: The port the mock API is listening on
+:param muted: Whether to skip the voice prompts the way a muted device does, unless config says otherwise
+:param config: Settings to start config.json from, like a copy of the device's own
+:return: The source directory to run from
+"""
+def createSandbox(workdir, port, muted=False, config=None):
+    repoDir = Path(__file__).absolute().parent.parent.parent
+    srcDir = os.path.join(workdir, "src")
+    dataDir = os.path.join(workdir, "data")
+    os.makedirs(srcDir, exist_ok=True)
+    os.makedirs(dataDir, exist_ok=True)
+
+    for name in ("media", "whisper.cpp"):
+        if not os.path.exists(os.path.join(workdir, name)):
+            os.symlink(repoDir / name, os.path.join(workdir, name))
+    shutil.copy(repoDir / "src" / "CalibrationDetails.json", srcDir)
+
+    with open(os.path.join(srcDir, "config.secret"), "w") as secretFile:
+        json.dump({"FASTAPI_CREDS": {"apiKey": "benchmark", "endpoint": "http://127.0.0.1", "port": port}}, secretFile)
+    with open(os.path.join(dataDir, "config.json"), "w") as configFile:
+        json.dump({"muted": muted, **(config if config is not None else {})}, configFile)
+    return srcDir
@@ -0,0 +1,163 @@
+"""
+Oregon State University, 2024
+
+Packs every artifact of a scan into a single archive with a manifest so it can be stored, uploaded and deleted as one file
+"""
+
+import json
+import logging
+import os
+import tempfile
+import uuid
+import zipfile
+from contextlib import contextmanager
+from time import gmtime, strftime, time
+
+MANIFEST_NAME = "manifest.json"
+BUNDLE_VERSION = 1
+
+# Images are already compressed so deflating them again just burns CPU
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+"""
+Given a generic file name like colorImage.jpg format it to be saved in ../data/colorImage_2024-04-16--19-00-12-345_1a2b3c.jpg,
+the milliseconds and random suffix keep two captures in the same second from overwriting each other
+
+:param fileName: The generic name of the file
+:param currentTime: The time the data was captured, defaults to now
+:param dataDir: The directory the file will be saved in
+"""
+def formatFileName(fileName: str, currentTime=None, dataDir="../data") -> str:
+    if currentTime is None:
+        currentTime = time()
+    stem, extension = os.path.splitext(fileName)
+    timestamp = strftime("%Y-%m-%d--%H-%M-%S", gmtime(currentTime))
+    milliseconds = int((currentTime % 1) * 1000)
+    return os.path.join(dataDir, f"{stem}_{timestamp}-{milliseconds:03d}_{uuid.uuid4().hex[:6]}{extension}")
+
+
+class ScanBundle:
+    """
+    Open an existing scan bundle
+
+    :param path: The path to the .zip bundle
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    """
+    Pack the given files into a new bundle named after the scan's uid, the bundle is written to a temporary file and moved into place so it is never seen half written
+
+    :param uid: The unique identifier of the scan
+    :param fileNames: Dictionary of artifact name to file path such as {"colorImage": "../data/colorImage_....jpg"}
+    :param dataDir: The directory the bundle will be saved in
+    :param removeSources: Whether the loose files should be deleted once they are packed
+    """
+
+    @staticmethod
+    def create(uid: str, fileNames: dict, dataDir="../data", removeSources=True):
+        path = os.path.join(dataDir, f"scan_{uid}.zip")
+        tempPath = path + ".tmp"
+
+        members = {}
+        with zipfile.ZipFile(tempPath, "w") as archive:
+            for key, fileName in fileNames.items():
+                if not fileName or not os.path.isfile(fileName):
+                    logging.warning(f"Missing {key} file for scan {uid}")
+                    continue
+
+                extension = os.path.splitext(fileName)[1].lower()
+                arcName = f"{key}{extension}"
+                compression = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                archive.write(fileName, arcName, compress_type=compression)
+                members[key] = {"name": arcName, "originalName": os.path.basename(fileName)}
+
+            manifest = {"version": BUNDLE_VERSION, "uid": uid, "created": time(), "members": members}
+            archive.writestr(MANIFEST_NAME, json.dumps(manifest), compress_type=zipfile.ZIP_DEFLATED)
+        os.replace(tempPath, path)
+
+        if removeSources:
+            for key in members:
+                os.remove(fileNames[key])
+
+        return ScanBundle(path)
+
+    """
+    Read the manifest describing the bundle
+    """
+
+    def manifest(self) -> dict:
+        with zipfile.ZipFile(self.path, "r") as archive:
+            return json.loads(archive.read(MANIFEST_NAME))
+
+    """
+    Get the original file names of every artifact in the bundle keyed by artifact name
+    """
+
+    def memberNames(self) -> dict:
+        return {key: member["originalName"] for key, member in self.manifest()["members"].items()}
+
+    """
+    Get the contents of a single artifact
+
+    :param key: The artifact name such as voiceRecording
+    """
+
+    def read(self, key: str) -> bytes:
+        with zipfile.ZipFile(self.path, "r") as archive:
+            member = json.loads(archive.read(MANIFEST_NAME))["members"][key]
+            return archive.read(member["name"])
+
+    """
+    Temporarily extract a single artifact for tools that need a real file such as whisper, the file is removed afterwards
+
+    :param key: The artifact name such as voiceRecording
+    """
+
+    @contextmanager
+    def extracted(self, key: str):
+        extension = os.path.splitext(self.manifest()["members"][key]["name"])[1]
+        handle, tempPath = tempfile.mkstemp(suffix=extension)
+        try:
+            with os.fdopen(handle, "wb") as outFile:
+                outFile.write(self.read(key))
+            yield tempPath
+        finally:
+            os.remove(tempPath)
+
+    """
+    Rewrite the bundle with some artifacts removed or modified, used to shrink scans when we are low on space
+
+    :param dropKeys: Artifact names that should be left out of the new bundle
+    :param transforms: Dictionary of artifact name to a function taking and returning the artifact's bytes
+    """
+
+    def rewrite(self, dropKeys=(), transforms=None):
+        transforms = transforms or {}
+        tempPath = self.path + ".tmp"
+
+        with zipfile.ZipFile(self.path, "r") as source, zipfile.ZipFile(tempPath, "w") as archive:
+            manifest = json.loads(source.read(MANIFEST_NAME))
+            members = {}
+            for key, member in manifest["members"].items():
+                if key in dropKeys:
+                    continue
+
+                contents = source.read(member["name"])
+                if key in transforms:
+                    contents = transforms[key](contents)
+                archive.writestr(member["name"], contents, compress_type=source.getinfo(member["name"]).compress_type)
+                members[key] = member
+
+            manifest["members"] = members
+            archive.writestr(MANIFEST_NAME, json.dumps(manifest), compress_type=zipfile.ZIP_DEFLATED)
+        os.replace(tempPath, self.path)
+
+    """
+    Check if a dictionary of file names refers to a bundle rather than loose files
+    """
+
+    @staticmethod
+    def isBundle(fileNames: dict) -> bool:
+        return "bundle" in fileNames
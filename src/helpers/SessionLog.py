@@ -0,0 +1,256 @@
+"""
+Oregon State University, 2024
+
+Records what a bin does during a session so it can be replayed on a dev machine, the main proccess polls the data every driver publishes along with their events and only the changes are written out
+
+Each line is one compact JSON record, "t" is milliseconds since the session started and "k" is the kind of record:
+    h - header with the unix time the session started in "s", the firmware commit in "c" and the poll interval in "i"
+    d - data of driver "m" that changed, "f" is a dictionary of field to new value
+    e - event "n" of driver "m" was set (v=1) or cleared (v=0)
+    a - files of scan "u" in "f" as artifact name to [path, bytes]
+"""
+
+import gzip
+import json
+import logging
+import math
+import os
+import threading
+from bisect import bisect_right
+from datetime import datetime
+from multiprocessing.sharedctypes import Synchronized
+from time import time
+
+"""
+Get a new session log path in a data directory named after the current time
+"""
+def defaultSessionPath(dataDir="../data"):
+    return os.path.join(dataDir, "sessions", f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+
+
+"""
+Open a session log for reading, logs compressed after they were copied off of a device are read as they are
+"""
+def openSessionFile(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+class SessionRecorder:
+    """
+    Create a new recorder, nothing is recorded until it is started with a DriverManager
+
+    :param path: The file to write the session to, a new one in ../data/sessions is named after the time when None
+    :param interval: Seconds between each poll of the drivers, changes that are undone faster than this are missed
+    :param precision: Decimal places floats are rounded to so noise below it doesn't produce a record every poll
+    :param maxBytes: The size the recording stops growing at so a forgotten recording can't fill the disk
+    """
+
+    def __init__(self, path=None, interval=0.1, precision=2, maxBytes=64 * 1024**2):
+        self.path = path
+        self.interval = interval
+        self.precision = precision
+        self.maxBytes = maxBytes
+        self.manager = None
+        self.startTime = 0.0
+        self.bytesWritten = 0
+        self.lastValues = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    """
+    Start recording the drivers of a manager in a background thread of the main proccess
+
+    :param manager: The DriverManager whose data and events are recorded
+    :param commitID: The firmware commit to note in the header
+    """
+
+    def start(self, manager, commitID=""):
+        if self.path is None:
+            self.path = defaultSessionPath()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        self.manager = manager
+        self.startTime = time()
+        self._write({"t": 0, "k": "h", "s": int(self.startTime * 1000), "c": commitID, "i": self.interval})
+        self.poll()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        logging.info(f"Recording session to {self.path}")
+
+    """
+    Stop recording, the last changes are polled before the thread exits
+    """
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    """
+    Record the files a scan produced, they are referenced by path so only their names and sizes end up in the log
+
+    :param uid: The unique identifier the scan was queued for upload with
+    :param fileNames: Dictionary of artifact name to file path
+    """
+
+    def recordArtifacts(self, uid, fileNames: dict):
+        if self.manager is None:
+            return
+        files = {name: [os.path.abspath(fileName), os.path.getsize(fileName) if os.path.isfile(fileName) else 0] for name, fileName in fileNames.items()}
+        self._write({"t": self._now(), "k": "a", "u": uid, "f": files})
+
+    """
+    Record everything that changed since the last poll
+    """
+
+    def poll(self):
+        now = self._now()
+        for module, entry in self.manager.getData().items():
+            changed = {}
+            for field, value in entry["data"].items():
+                value = self._toRecordValue(value)
+                if value is not None and self.lastValues.get((module, field)) != value:
+                    self.lastValues[(module, field)] = value
+                    changed[field] = value
+            if len(changed) > 0:
+                self._write({"t": now, "k": "d", "m": module, "f": changed})
+
+            for name, (event, _) in entry["events"].items():
+                isSet = int(event.is_set())
+                if self.lastValues.get((module, "." + name), 0) != isSet:
+                    self.lastValues[(module, "." + name)] = isSet
+                    self._write({"t": now, "k": "e", "m": module, "n": name, "v": isSet})
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error(f"Failed to record session: {e}")
+        self.poll()
+
+    def _now(self) -> int:
+        return int((time() - self.startTime) * 1000)
+
+    """
+    Unwrap a shared value into something small enough to record, anything that isn't a plain value (like the BME688 history) is left out
+    """
+
+    def _toRecordValue(self, value):
+        if type(value) == Synchronized:
+            value = value.value
+        if isinstance(value, float):
+            return round(value, self.precision) if math.isfinite(value) else None
+        if isinstance(value, (bool, int, str)):
+            return value
+        return None
+
+    def _write(self, record):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        with self.lock:
+            if self.bytesWritten + len(line) > self.maxBytes:
+                if self.bytesWritten <= self.maxBytes:
+                    logging.error(f"Session recording reached {self.maxBytes} bytes, nothing more will be recorded")
+                    self.bytesWritten = self.maxBytes + 1
+                return
+
+            try:
+                with open(self.path, "ab") as sessionFile:
+                    sessionFile.write(line)
+                self.bytesWritten += len(line)
+            except OSError as e:
+                logging.error(f"Failed to write session record: {e}")
+
+
+class SessionLog:
+    """
+    Read a recorded session so it can be replayed or summarized
+
+    :param path: The session log written by a SessionRecorder, it can be gzipped
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = {}
+        self.timelines = {}
+        self.events = []
+        self.artifacts = []
+        self.duration = 0.0
+
+        with openSessionFile(path) as sessionFile:
+            for line in sessionFile:
+                try:
+                    record = json.loads(line)
+                    seconds = record["t"] / 1000
+                    kind = record["k"]
+                except (ValueError, KeyError, TypeError):
+                    # The last line of a session that was cut off by a power loss can be incomplete
+                    continue
+
+                self.duration = max(self.duration, seconds)
+                if kind == "h":
+                    self.header = record
+                elif kind == "d":
+                    for field, value in record.get("f", {}).items():
+                        times, values = self.timelines.setdefault((record["m"], field), ([], []))
+                        times.append(seconds)
+                        values.append(value)
+                elif kind == "e":
+                    self.events.append((seconds, record["m"], record["n"], bool(record["v"])))
+                elif kind == "a":
+                    self.artifacts.append((seconds, record["u"], record.get("f", {})))
+
+    """
+    The unix time the session started
+    """
+
+    def startTime(self) -> float:
+        return self.header.get("s", 0) / 1000
+
+    """
+    Every value a field of a driver took during the session
+
+    :return: Tuple of (seconds since the start, values), both empty if the field was never recorded
+    """
+
+    def timeline(self, module, field):
+        return self.timelines.get((module, field), ([], []))
+
+    """
+    The value of every recorded field of a driver at a point in the session, fields that hadn't been recorded yet are left out
+    """
+
+    def valuesAt(self, module, seconds) -> dict:
+        values = {}
+        for (timelineModule, field), (times, fieldValues) in self.timelines.items():
+            index = bisect_right(times, seconds) - 1
+            if timelineModule == module and index >= 0:
+                values[field] = fieldValues[index]
+        return values
+
+    """
+    The events of a driver that were set within a stretch of the session
+
+    :return: List of event names in the order they were set
+    """
+
+    def eventsSet(self, module, start, end) -> list:
+        return [name for seconds, eventModule, name, isSet in self.events if eventModule == module and isSet and start < seconds <= end]
+
+    """
+    Find a file a scan produced, either where it was on the device or next to the session log when it was copied off with it
+
+    :return: The path to the file or None if it wasn't kept
+    """
+
+    def resolveArtifact(self, fileName):
+        for candidate in (fileName, os.path.join(os.path.dirname(os.path.abspath(self.path)), os.path.basename(fileName))):
+            if os.path.isfile(candidate):
+                return candidate
+        return None
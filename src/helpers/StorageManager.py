@@ -0,0 +1,181 @@
+"""
+Oregon State University, 2024
+
+Keeps the scans waiting to be uploaded in ../data within a disk quota, degrading the oldest scans first when we run out of room
+"""
+
+import logging
+import os
+import shutil
+
+import cv2
+import numpy as np
+
+from helpers.ScanBundle import ScanBundle
+
+# Order scans are degraded in when over quota, the cheapest data to lose goes first
+DROP_POINT_CLOUD = "dropPointCloud"
+DOWNSCALE_IMAGES = "downscaleImages"
+IMAGE_KEYS = ("colorImage", "depthImage", "heatmapImage")
+
+
+class StorageManager:
+    """
+    Create a new storage manager
+
+    :param dataDir: The directory scan artifacts are written to
+    :param quotaBytes: The most space scans are allowed to take up
+    :param minFreeBytes: Treat the quota as exceeded whenever the disk has less than this much free space
+    :param downscaleFactor: How much images are shrunk by when downscaling
+    """
+
+    def __init__(self, dataDir="../data", quotaBytes=1024**3, minFreeBytes=256 * 1024**2, downscaleFactor=0.5):
+        self.dataDir = dataDir
+        self.quotaBytes = quotaBytes
+        self.minFreeBytes = minFreeBytes
+        self.downscaleFactor = downscaleFactor
+
+    """
+    Get the number of bytes a single scan is using on the disk
+
+    :param fileNames: Dictionary of the files that belong to the scan
+    """
+
+    def scanBytes(self, fileNames: dict) -> int:
+        total = 0
+        for fileName in fileNames.values():
+            if fileName and os.path.isfile(fileName):
+                total += os.path.getsize(fileName)
+        return total
+
+    """
+    Get usage metrics for all of the scans waiting to be uploaded
+
+    :param cachedQueue: Dictionary of uid to {"fileNames", "data"} for every scan still on the device
+    """
+
+    def usage(self, cachedQueue: dict) -> dict:
+        scanBytes = {uid: self.scanBytes(entry["fileNames"]) for uid, entry in cachedQueue.items()}
+        try:
+            freeBytes = shutil.disk_usage(self.dataDir).free
+        except OSError:
+            freeBytes = -1
+        return {
+            "totalBytes": sum(scanBytes.values()),
+            "quotaBytes": self.quotaBytes,
+            "freeDiskBytes": freeBytes,
+            "scanCount": len(scanBytes),
+            "scanBytes": scanBytes,
+        }
+
+    """
+    Check if we need to free up space
+
+    :param totalBytes: The bytes currently used by scans
+    """
+
+    def _overQuota(self, totalBytes) -> bool:
+        if totalBytes > self.quotaBytes:
+            return True
+        try:
+            return shutil.disk_usage(self.dataDir).free < self.minFreeBytes
+        except OSError:
+            return False
+
+    """
+    Bring the scans back within the quota, first dropping point clouds, then downscaling images and finally deleting the oldest scans
+
+    :param cachedQueue: Dictionary of uid to {"fileNames", "data"} ordered oldest first, it is modified in place
+    :param protectedUids: Scans that must not be deleted entirely such as the one currently being uploaded
+    :return: List of uids that were deleted
+    """
+
+    def enforce(self, cachedQueue: dict, protectedUids=()) -> list:
+        totalBytes = self.usage(cachedQueue)["totalBytes"]
+        evicted = []
+
+        for step in (DROP_POINT_CLOUD, DOWNSCALE_IMAGES):
+            for uid, entry in cachedQueue.items():
+                if not self._overQuota(totalBytes):
+                    return evicted
+
+                degraded = entry.setdefault("degraded", [])
+                if step in degraded:
+                    continue
+
+                before = self.scanBytes(entry["fileNames"])
+                if step == DROP_POINT_CLOUD:
+                    self._dropPointCloud(entry["fileNames"])
+                else:
+                    self._downscaleImages(entry["fileNames"])
+                degraded.append(step)
+                totalBytes -= before - self.scanBytes(entry["fileNames"])
+                logging.warning(f"Storage over quota, applied {step} to scan {uid}")
+
+        for uid in list(cachedQueue.keys()):
+            if not self._overQuota(totalBytes):
+                break
+            if uid in protectedUids:
+                continue
+
+            totalBytes -= self.scanBytes(cachedQueue[uid]["fileNames"])
+            self.deleteFiles(cachedQueue[uid]["fileNames"])
+            del cachedQueue[uid]
+            evicted.append(uid)
+            logging.warning(f"Storage over quota, deleted scan {uid}")
+
+        return evicted
+
+    """
+    Delete the point cloud of a scan, it is by far the largest artifact
+    """
+
+    def _dropPointCloud(self, fileNames: dict):
+        if ScanBundle.isBundle(fileNames):
+            ScanBundle(fileNames["bundle"]).rewrite(dropKeys=("topologyMap",))
+        else:
+            self.deleteFiles({"topologyMap": fileNames.get("topologyMap")})
+
+    """
+    Shrink every image in a scan and re-encode it in place
+    """
+
+    def _downscaleImages(self, fileNames: dict):
+        if ScanBundle.isBundle(fileNames):
+            ScanBundle(fileNames["bundle"]).rewrite(transforms={key: self._downscaleEncoded for key in IMAGE_KEYS})
+            return
+
+        for key in IMAGE_KEYS:
+            fileName = fileNames.get(key)
+            if not fileName or not os.path.isfile(fileName):
+                continue
+
+            image = cv2.imread(fileName)
+            if image is None:
+                continue
+            image = cv2.resize(image, None, fx=self.downscaleFactor, fy=self.downscaleFactor, interpolation=cv2.INTER_AREA)
+            cv2.imwrite(fileName, image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+
+    """
+    Shrink an encoded image that is stored inside of a bundle
+    """
+
+    def _downscaleEncoded(self, contents: bytes) -> bytes:
+        image = cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return contents
+        image = cv2.resize(image, None, fx=self.downscaleFactor, fy=self.downscaleFactor, interpolation=cv2.INTER_AREA)
+        success, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        return encoded.tobytes() if success else contents
+
+    """
+    Remove every file in a dictionary of file names that still exists, used once a scan has been uploaded too
+    """
+
+    def deleteFiles(self, fileNames: dict):
+        for fileName in fileNames.values():
+            if fileName and os.path.isfile(fileName):
+                try:
+                    os.remove(fileName)
+                except OSError as e:
+                    logging.error(f"Failed to delete {fileName}: {e}")
@@ -0,0 +1,181 @@
+"""
+Oregon State University, 2024
+
+Traces where the time of each scan goes from the lid closing to the upload being acknowledged, every proccess records its own spans against the trace ID the main proccess stamps
+"""
+
+import json
+import logging
+import math
+import os
+from contextlib import contextmanager
+from multiprocessing import Array
+from time import time
+from uuid import uuid4
+
+from helpers.Metrics import MetricsRegistry
+
+# Every stage a scan goes through in the order they usually happen
+STAGES = (
+    "lid_debounce",
+    "camera_delay",
+    "prompt",
+    "record",
+    "capture_depth",
+    "capture_thermal",
+    "capture_wait",
+    "weigh",
+    "weigh_debounce",
+    "collect",
+    "transcribe",
+    "upload",
+)
+
+# Trace durations range from a few milliseconds to hours when a scan waits offline
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 300, 3600)
+
+"""
+Get a percentile of a list of values with the nearest rank method
+
+:param values: Sorted list of values
+:param q: The percentile between 0 and 1
+"""
+def percentile(values, q) -> float:
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+"""
+Summarize persisted trace records as latency percentiles per stage, end_to_end covers traces from their first span to their upload
+
+:param paths: The trace files to read, older rotated files can be included
+:return: Dictionary of stage to {"count", "p50", "p95"} in seconds
+"""
+def summarizeTraces(paths=("../data/traces.jsonl.1", "../data/traces.jsonl")) -> dict:
+    durations = {}
+    traces = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r") as traceFile:
+            for line in traceFile:
+                try:
+                    record = json.loads(line)
+                    start, duration = record["b"] / 1000, record["d"] / 1000
+                except (ValueError, KeyError):
+                    continue
+                durations.setdefault(record["s"], []).append(duration)
+                trace = traces.setdefault(record["t"], {"start": start, "end": start + duration, "uploaded": False})
+                trace["start"] = min(trace["start"], start)
+                trace["end"] = max(trace["end"], start + duration)
+                trace["uploaded"] = trace["uploaded"] or record["s"] == "upload"
+
+    durations["end_to_end"] = [trace["end"] - trace["start"] for trace in traces.values() if trace["uploaded"]]
+
+    summary = {}
+    for stage, values in durations.items():
+        values.sort()
+        summary[stage] = {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95)}
+    return summary
+
+
+class Tracer:
+    """
+    Create a new tracer, it must be created before the proccesses that record to it are started
+
+    :param path: The file spans are appended to as one compact JSON record per line
+    :param maxBytes: The size the file is rotated at, one older file is kept
+    :param enabled: A disabled tracer records nothing, drivers have one until the DriverManager gives them the shared tracer
+    """
+
+    def __init__(self, path="../data/traces.jsonl", maxBytes=1024**2, enabled=True):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.enabled = enabled
+        self.metrics = MetricsRegistry()
+        self.stageTimes = {}
+        if not enabled:
+            return
+
+        self.traceId = Array("c", 16)
+        for stage in STAGES:
+            self.stageTimes[stage] = self.metrics.histogram(
+                "scan_stage_seconds", "Time each stage of a scan took", buckets=STAGE_BUCKETS, stage=stage
+            )
+
+    """
+    Start a new trace, spans recorded from here on in any proccess belong to it
+
+    :return: The ID of the new trace
+    """
+
+    def start(self) -> str:
+        if not self.enabled:
+            return ""
+        traceId = uuid4().hex[:16]
+        self.traceId.value = traceId.encode("ascii")
+        return traceId
+
+    """
+    Stop attaching spans to the current trace, spans can still be recorded against it by passing its ID
+    """
+
+    def end(self):
+        if self.enabled:
+            self.traceId.value = b""
+
+    """
+    Get the ID of the trace in progress or an empty string if there isn't one
+    """
+
+    def currentTrace(self) -> str:
+        return self.traceId.value.decode("ascii") if self.enabled else ""
+
+    """
+    Time the body of a with block as a stage of a trace, nothing is recorded if there isn't a trace
+
+    :param stage: The name of the stage, one of STAGES
+    :param traceId: The trace to record against, the one in progress when None
+    """
+
+    @contextmanager
+    def span(self, stage, traceId=None):
+        traceId = traceId if traceId is not None else self.currentTrace()
+        start = time()
+        try:
+            yield
+        finally:
+            self.record(traceId, stage, start, time())
+
+    """
+    Record a span that was already timed
+
+    :param traceId: The trace the span belongs to, nothing is recorded if it is empty
+    :param stage: The name of the stage
+    :param start: When the stage started as a unix timestamp
+    :param end: When the stage ended as a unix timestamp
+    """
+
+    def record(self, traceId, stage, start, end):
+        if not self.enabled or not traceId:
+            return
+
+        if stage in self.stageTimes:
+            self.stageTimes[stage].observe(end - start)
+
+        line = json.dumps(
+            {"t": traceId, "s": stage, "b": int(start * 1000), "d": int((end - start) * 1000)}, separators=(",", ":")
+        )
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.maxBytes:
+                os.replace(self.path, self.path + ".1")
+
+            # A single write to a file opened for appending keeps lines from different proccesses from interleaving
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (line + "\n").encode("utf-8"))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.error(f"Failed to record trace span: {e}")
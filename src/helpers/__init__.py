@@ -1,18 +1,18 @@
 import json
 import logging
 import os
-import smtplib
 import socket
 import sys
 import uuid
+from contextlib import nullcontext
 from csv import excel_tab
-from email.mime.text import MIMEText
 from time import time
 
-import botocore
 import httpx
-from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+
+from helpers.AlertNotifier import SMTPTransport
+from helpers.CredentialProvider import getCredentialProvider
+from helpers.ScanBundle import ScanBundle
 
 
 TWO_HOURS_SECONDS = 7200
@@ -57,8 +57,8 @@ class Logging:
         if not verbose:
             loggingLevel = logging.WARNING
 
-        # Check if we want to specify an output file for the logging
-        if len(sys.argv) < 2:
+        # Check if we want to specify an output file for the logging, options like --simulate come after it
+        if len(sys.argv) < 2 or sys.argv[1].startswith("-"):
             logging.basicConfig(format=FORMAT, level=loggingLevel)
             logging.info(
                 "No output file specified file logging will be disabled to enable: ./main.py <outputfilepath>"
@@ -107,19 +107,20 @@ Handles requests to remote APIs (S3 and FastAPI)
 
 
 class RequestHandler:
-    def __init__(self, dataDir="../data", secret_file="config.secret"):
+    """
+    :param metrics: The MetricsRegistry request timings are recorded to, it must be created before the proccess using this handler is started
+    """
+    def __init__(self, dataDir="../data", secret_file="config.secret", metrics=None):
         self.secret_file = secret_file
         self.dataDir = dataDir
-        self.apiKey, self.endpoint, self.port = self.loadFastAPICredentials(secret_file)
-        self.appPassword, self.emailAddress = self.loadEmailCredentials()
-
-        # Check if the app password is equal to FAILED then we know it didn't get the email credentials and should retry when we have a network connection
-        if self.appPassword == "FAILED":
-            self.gotEmailCreds = False
-        else:
-            self.gotEmailCreds = True
-
-        self.endpoint = f"https://{self.endpoint}:{self.port}"
+        self.requestTimes = {}
+        if metrics is not None:
+            for name in ("heartbeat", "secure_heartbeat", "scan", "scan_batch"):
+                self.requestTimes[name] = metrics.histogram("request_seconds", "Time taken by requests to our API", endpoint=name)
+
+        # Credentials are shared by every handler in the proccess, the email secrets are only fetched the first time an email is sent
+        # so handlers created before the drivers are forked don't leave a fetch thread running in the parent
+        self.credentials = getCredentialProvider(secret_file)
         self.serial = self._getSerial()
 
         logging.basicConfig(
@@ -128,15 +129,48 @@ class RequestHandler:
             level=logging.DEBUG,
         )
 
+    """
+    The key used to authenticate with our API, always the most recent one written to the secret file, None if it has never been readable
+    """
+
+    @property
+    def apiKey(self):
+        creds = self.credentials.getAPICredentials()
+        return creds["apiKey"] if creds is not None else None
+
+    @property
+    def port(self):
+        creds = self.credentials.getAPICredentials()
+        return creds["port"] if creds is not None else None
+
+    """
+    The base URL of our API including the port, None if the secret file has never been readable
+    """
+
+    @property
+    def endpoint(self):
+        creds = self.credentials.getAPICredentials()
+        if creds is None:
+            return None
+        return self._formatEndpoint(creds["endpoint"], creds["port"])
+
+    """
+    Get the full URL of a path on our API, None if the secret file has never been readable
+    """
+
+    def apiURL(self, path):
+        endpoint = self.endpoint
+        return endpoint + path if endpoint is not None else None
+
     """
     Check to see if our bucket can communicate with the internet at all, effictvely ping 8.8.8.8
     """
 
     def checkNetworkConnection(self, host="8.8.8.8", port=53, timeout=3) -> bool:
         try:
-            socket.setdefaulttimeout(timeout)
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-            return True
+            # The timeout only applies to this socket rather than changing the default for the whole proccess
+            with socket.create_connection((host, port), timeout=timeout):
+                return True
         except socket.error as ex:
             logging.error(f"Failed to connect to {host}: {ex}")
             return False
@@ -155,13 +189,16 @@ class RequestHandler:
     """
 
     def sendHeartbeat(self):
-        endpoint = self.endpoint + "/api/health/heartbeat"
+        endpoint = self.apiURL("/api/health/heartbeat")
+        if endpoint is None:
+            return False
         client = httpx.Client(verify=False)
 
         # Attempt to send the packet
         failed = False
         try:
-            response = client.get(endpoint).json()
+            with self._timeRequest("heartbeat"):
+                response = client.get(endpoint).json()
         except Exception as e:
             logging.error(f"Exception occurred while sending hearbeat: {e}")
             return False
@@ -173,14 +210,8 @@ class RequestHandler:
             logging.info("Succsessfully recieved hearbeat!")
 
             # If we weren't able to get the email creds last time now that we for sure have network we should try again
-            if not self.gotEmailCreds:
-                self.appPassword, self.emailAddress = self.loadEmailCredentials()
-
-                # Check if the app password is equal to FAILED then we know it didn't get the email credentials and should retry when we have a network connection
-                if self.appPassword == "FAILED":
-                    self.gotEmailCreds = False
-                else:
-                    self.gotEmailCreds = True
+            if self.credentials.getEmailCredentials() is None:
+                self.credentials.refreshEmailCredentials()
 
             return True
         else:
@@ -192,23 +223,23 @@ class RequestHandler:
     """
 
     def updateAPICreds(self):
-        self.apiKey, self.endpoint, self.port = self.loadFastAPICredentials(
-            self.secret_file
-        )
-        self.endpoint = f"https://{self.endpoint}:{self.port}"
+        self.credentials.reload()
 
     """
     Send a secure heartbeat request to the API
     """
 
     def sendSecureHeartbeat(self):
-        endpoint = self.endpoint + "/api/health/secure_heartbeat"
+        endpoint = self.apiURL("/api/health/secure_heartbeat")
+        if endpoint is None:
+            return False
         headers = {
             "token": self.apiKey,
         }
         client = httpx.Client(verify=False)
         try:
-            response = client.get(endpoint, headers=headers).json()
+            with self._timeRequest("secure_heartbeat"):
+                response = client.get(endpoint, headers=headers).json()
         except Exception as e:
             logging.error(f"Exception occurred while sending hearbeat: {e}")
             client.close()
@@ -224,23 +255,124 @@ class RequestHandler:
             return False
 
     def sendAPIRequest(self, fileNames: dict, data: dict, commitID: str):
-        endpoint = self.endpoint + "/api/scan"
+        # Without credentials the upload fails like any other so it is retried once they are fixed
+        endpoint = self.apiURL("/api/scan")
+        if endpoint is None:
+            return (False, -1, "No API credentials")
+        headers = {
+            "token": self.apiKey,
+            "accept": "application/json",
+        }
+        payload, files = self._buildScanRequest(fileNames, data, commitID)
+        data = {"data": json.dumps(payload)}
+
+        with httpx.Client(headers=headers, timeout=60, verify=False) as client:
+            try:
+                with self._timeRequest("scan"):
+                    response = client.post(
+                        endpoint,
+                        files=files,
+                        data=data,
+                    )
+                response_json = response.json()
+                logging.debug(f"Scan upload returned {response}")
+            except Exception as e:
+                logging.error(f"Exception occurred while sending API request: {e}")
+                return (False, -1, str(e))
+            finally:
+                for _, fileHandle in files:
+                    fileHandle.close()
+
+            if "status" in response_json and response_json["status"] == True:
+                logging.info("Data successfully uploaded!")
+                return (True, response.status_code, response.text)
+            else:
+                logging.error("Failed to upload data to API.")
+                return (False, response.status_code, response.text)
 
-        # Get current timestamp
-        # Create file names for colorImage, depthImage, heatmapImage, topologyMap, and voiceRecording
+    """
+    Upload several scans in a single request so draining a backlog isn't bound by round trips, the server acknowledges each scan individually
+
+    :param scans: List of tuples of (uid, fileNames, data) to upload
+    :param commitID: The commit the firmware is currently running
+    :return: Tuple of (list of uids that were accepted, response code, response text)
+    """
 
-        basenames = {k: os.path.basename(v) for k, v in fileNames.items()}
+    def sendBatchRequest(self, scans: list, commitID: str):
+        endpoint = self.apiURL("/api/scan/batch")
+        if endpoint is None:
+            return ([], -1, "No API credentials")
         headers = {
             "token": self.apiKey,
             "accept": "application/json",
         }
 
+        # Every part is named after the uid it belongs to so the server can tell the scans apart
+        payloads = []
+        files = []
+        for uid, fileNames, data in scans:
+            payload, scanFiles = self._buildScanRequest(fileNames, data, commitID)
+            payload["uid"] = uid
+            payloads.append(payload)
+            files.extend((f"{uid}:{name}", fileHandle) for name, fileHandle in scanFiles)
+        data = {"data": json.dumps({"scans": payloads})}
+
+        with httpx.Client(headers=headers, timeout=120, verify=False) as client:
+            try:
+                with self._timeRequest("scan_batch"):
+                    response = client.post(
+                        endpoint,
+                        files=files,
+                        data=data,
+                    )
+            except Exception as e:
+                logging.error(f"Exception occurred while sending batch API request: {e}")
+                return ([], -1, str(e))
+            finally:
+                for _, fileHandle in files:
+                    fileHandle.close()
+
+        # Errors like a 404 from a server without batch support can be an HTML page from a proxy, the caller needs the status code either way
+        if not response.is_success:
+            logging.error(f"Batch upload failed with status {response.status_code}")
+            return ([], response.status_code, response.text)
+        try:
+            response_json = response.json()
+        except ValueError as e:
+            logging.error(f"Batch upload returned an invalid response: {e}")
+            return ([], response.status_code, response.text)
+
+        results = response_json.get("results", {}) if isinstance(response_json, dict) else {}
+        acked = [uid for uid, _, _ in scans if results.get(uid, {}).get("status") == True]
+        logging.info(f"Batch upload accepted {len(acked)} of {len(scans)} scans")
+        return (acked, response.status_code, response.text)
+
+    """
+    Build the JSON payload and the file parts for a single scan
+
+    :param fileNames: Dictionary of artifact name to file path, or a single bundle
+    :param data: The JSON data packet collected with the scan
+    :param commitID: The commit the firmware is currently running
+    :return: Tuple of (payload dictionary, list of (part name, open file) tuples)
+    """
+
+    def _buildScanRequest(self, fileNames: dict, data: dict, commitID: str):
+        # Files may have been dropped by the storage manager to save space, those are sent as empty names and left out of the upload
+        fileNames = {k: v for k, v in fileNames.items() if v and os.path.isfile(v)}
+
+        # Bundled scans are uploaded as a single archive, the original file names come from its manifest
+        bundleName = fileNames.get("bundle")
+        if bundleName is not None:
+            basenames = ScanBundle(bundleName).memberNames()
+        else:
+            basenames = {k: os.path.basename(v) for k, v in fileNames.items()}
+
         payload = {
-            "colorImage": str(basenames["colorImage"]),
-            "depthImage": str(basenames["depthImage"]),
-            "heatmapImage": str(basenames["heatmapImage"]),
-            "topologyMap": str(basenames["topologyMap"]),
-            "voiceRecording": str(basenames["voiceRecording"]),
+            "colorImage": str(basenames.get("colorImage", "")),
+            "depthImage": str(basenames.get("depthImage", "")),
+            "heatmapImage": str(basenames.get("heatmapImage", "")),
+            "topologyMap": str(basenames.get("topologyMap", "")),
+            "voiceRecording": str(basenames.get("voiceRecording", "")),
             "total_weight": float(data["NAU7802"]["data"]["weight"]),
             "weight_delta": float(data["NAU7802"]["data"]["weight_delta"]),
             "temperature": float(data["BME688"]["data"]["temperature(c)"]),
@@ -249,12 +381,14 @@ class RequestHandler:
             "iaq": float(data["BME688"]["data"]["iaq"]),
             "co2_eq": float(data["BME688"]["data"]["CO2-eq"]),
             "tvoc": float(data["BME688"]["data"]["bVOC-eq"]),
+            "environment_history": data["BME688"]["data"].get("history", {}),
+            "metrics": data.get("Metrics", {}),
             "transcription": str(data["SoundController"]["data"]["TranscribedText"]),
             "userTrigger": bool(data["DriverManager"]["data"]["userTrigger"]),
             "deviceID": str(self.serial),
             "commitID": commitID,
+            "bundle": os.path.basename(bundleName) if bundleName is not None else "",
         }
-        data = {"data": json.dumps(payload)}
 
         file_keys = [
             "colorImage",
@@ -263,30 +397,14 @@ class RequestHandler:
             "topologyMap",
             "voiceRecording",
         ]
-        files = [("files", open(fileNames[k], "rb")) for k in file_keys]
-
-        with httpx.Client(headers=headers, timeout=60, verify=False) as client:
-            try:
-                response = client.post(
-                    endpoint,
-                    files=files,
-                    data=data,
-                )
-                response_json = response.json()
-                print(f"DEBUG: {response}")
-            except Exception as e:
-                logging.error(f"Exception occurred while sending API request: {e}")
-                return (False, -1, str(e))
-
-            if "status" in response_json and response_json["status"] == True:
-                logging.info("Data successfully uploaded!")
-                return (True, response.status_code, response.text)
-            else:
-                logging.error("Failed to upload data to API.")
-                return (False, response.status_code, response.text)
+        if bundleName is not None:
+            files = [("bundle", open(bundleName, "rb"))]
+        else:
+            files = [("files", open(fileNames[k], "rb")) for k in file_keys if k in fileNames]
+        return payload, files
 
     """
-    Sends an email to our support server when an error occurs when attempting to upload a packer
+    Sends an email to our support server when an error occurs when attempting to upload a packer, the AsyncPublisher sends these through an AlertNotifier instead so it doesn't block
 
     :param error_code: The code that was returned from the request
     :param error_message: The exception or the error that was returned by the request
@@ -295,67 +413,32 @@ class RequestHandler:
     def sendErrorEmail(self, error_code, error_message):
         subject = f"[Bucket Upload Error] Device: {self.serial} encountered a {error_code} error code."
         body = f"The following was returned as the error in question:\t{error_message}"
+        # This already blocks on SMTP so wait for the first fetch rather than dropping the email
+        return SMTPTransport(lambda: self.credentials.getEmailCredentials(wait=15)).send(subject, body, [])
 
-        msg = MIMEText(body)
-        msg["Subject"] = subject
-        msg["From"] = self.emailAddress
-        msg["To"] = self.emailAddress
+    """
+    Get the email address and app password alerts are sent with, None if we haven't been able to retrieve them yet
+    """
 
-        try:
-            with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp_server:
-                
-                    smtp_server.login(self.emailAddress, self.appPassword)
-                    smtp_server.sendmail(
-                        self.emailAddress, self.emailAddress, msg.as_string()
-                    )
-                    return True
-        except Exception as e:
-            logging.error("Error occurred sending email: {e}")
-            return False
+    def getEmailCredentials(self):
+        return self.credentials.getEmailCredentials()
 
     """
-    Load and return our Fast API credentials
-
-    :param file: The file our credentials are stored in
+    Time a request if we were given somewhere to record it, failed requests are timed too
     """
 
-    def loadFastAPICredentials(self, file):
-        secretFile = open(file, "r")
-        credsJson = json.load(secretFile)
-        secretFile.close()
-        return (
-            credsJson["FASTAPI_CREDS"]["apiKey"],
-            credsJson["FASTAPI_CREDS"]["endpoint"],
-            credsJson["FASTAPI_CREDS"]["port"],
-        )
+    def _timeRequest(self, name):
+        histogram = self.requestTimes.get(name)
+        return histogram.time() if histogram is not None else nullcontext()
 
     """
-    Load a Gmail app password from a file
-
-    :param file: The file the credentials are stored in
+    Build the base URL of the API, https is assumed unless the endpoint already has a scheme such as http://127.0.0.1 for the stand in server
     """
 
-    def loadEmailCredentials(self):
-        try:
-            client = botocore.session.get_session().create_client(
-                "secretsmanager", region_name="us-west-2"
-            )
-            cache_config = SecretCacheConfig()
-            cache = SecretCache(config=cache_config, client=client)
-            email = cache.get_secret_string("sb_notification_email")
-            pword = cache.get_secret_string("sb_notification_password")
-            return pword, email
-        except Exception as e:
-            logging.error(f"Failed to retrieve email credentials: {e}")
-            return "FAILED", "FAILED"
-
-        # secretFile = open(file, "r")
-        # credsJson = json.load(secretFile)
-        # secretFile.close()
-        # return (
-        #     credsJson["EMAIL_LOGGING"]["appCode"],
-        #     credsJson["EMAIL_LOGGING"]["email"],
-        # )
+    def _formatEndpoint(self, endpoint, port):
+        if "://" in endpoint:
+            return f"{endpoint}:{port}"
+        return f"https://{endpoint}:{port}"
 
     """
     Get the serial number of this specific raspberry Pi by querying /proc/cpuinfo
@@ -8,19 +8,30 @@ Detection Loop for all Binsight Devices
 Records data when the lid is opened and then closed and once every 2 hours
 """
 
+import argparse
+import json
+import logging
 import os
+import shutil
+import tempfile
 from time import sleep
 
 from drivers.MainController import MainController
 from helpers import Logging, TimeHelper
+from helpers.SessionLog import SessionRecorder, defaultSessionPath
 
 
-def main():
+"""
+:param simulation: A drivers.Simulation.Simulation to run against instead of the real hardware
+:param sessionRecorder: A helpers.SessionLog.SessionRecorder to record the session to
+:param srcDir: The source directory to run from, the one this file is in when None
+"""
+def main(simulation=None, sessionRecorder=None, srcDir=None):
     # Change our current working directory to this file so our relative paths still work no matter where this file was called from
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(srcDir if srcDir is not None else os.path.dirname(os.path.abspath(__file__)))
 
     # Create the instance of our controller
-    controller = MainController()
+    controller = MainController(simulation, sessionRecorder)
     
     # Register a callback for when the lid is closed so we can sample our data
     while(True):
@@ -34,5 +45,56 @@ def main():
             break
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Binsight detection loop")
+    parser.add_argument("logFile", nargs="?", help="File to write the log to as well as the console, read by helpers.Logging")
+    parser.add_argument("--simulate", nargs="?", const="", metavar="DATA_DIR", help="Run without any hardware, replaying recordings from DATA_DIR when given and synthesizing everything else")
+    parser.add_argument("--scan-interval", type=float, default=60, help="Seconds between simulated lid openings")
+    parser.add_argument("--first-open", type=float, default=45, help="Seconds before the simulated lid first opens, long enough for the controller to finish its setup")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Multiplier on how long simulated hardware takes to respond, 0 for instant")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthesized data")
+    parser.add_argument("--record", nargs="?", const="", metavar="SESSION_LOG", help="Record the session so it can be replayed, to ../data/sessions when no file is given")
+    parser.add_argument("--replay", metavar="SESSION_LOG", help="Replay a recorded session without any hardware, recordings in the --simulate DATA_DIR are used for the camera frames")
+    parser.add_argument("--speed", type=float, default=1.0, help="How many times faster than real time to replay the time between scans")
+    parser.add_argument("--workdir", default=None, help="Directory simulations run in, a temporary one is created and removed when not given")
+    args = parser.parse_args()
+
+    # Paths on the command line are relative to where we were called from, main changes to the source directory
+    sourceDir = os.path.dirname(os.path.abspath(__file__))
+    dataDir = os.path.abspath(args.simulate) if args.simulate else None
+
     logger = Logging(verbose=True)
-    main()
+    simulation = None
+    if args.replay is not None:
+        from drivers.Simulation import Replay
+        simulation = Replay(os.path.abspath(args.replay), speed=args.speed, dataDir=dataDir, timeScale=args.time_scale, seed=args.seed)
+    elif args.simulate is not None:
+        from drivers.Simulation import Simulation
+        simulation = Simulation(dataDir, scanInterval=args.scan_interval, firstOpen=args.first_open, timeScale=args.time_scale, seed=args.seed)
+
+    # Sessions are kept with the device's data even when a simulation runs somewhere else
+    sessionRecorder = None
+    if args.record is not None:
+        sessionRecorder = SessionRecorder(os.path.abspath(args.record) if args.record else defaultSessionPath(os.path.join(sourceDir, "../data")))
+
+    if simulation is None:
+        main(None, sessionRecorder)
+    else:
+        # Simulated scans go to a local mock of the scan API from a throwaway data directory so they never reach the real server or the device's cache
+        from helpers.Sandbox import MockScanAPI, createSandbox
+
+        config = None
+        if os.path.exists(os.path.join(sourceDir, "../data/config.json")):
+            with open(os.path.join(sourceDir, "../data/config.json"), "r") as configFile:
+                config = json.load(configFile)
+
+        workdir = os.path.abspath(args.workdir) if args.workdir is not None else tempfile.mkdtemp(prefix="simulation_")
+        api = MockScanAPI()
+        api.start()
+        logging.info(f"Simulating in {workdir}, scans are uploaded to a mock API on port {api.port}")
+        try:
+            main(simulation, sessionRecorder, createSandbox(workdir, api.port, config=config))
+        finally:
+            logging.info(f"The mock API acknowledged {api.get('scans'):.0f} scans")
+            api.kill()
+            if args.workdir is None:
+                shutil.rmtree(workdir, ignore_errors=True)
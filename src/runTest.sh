@@ -47,4 +47,31 @@ case $1 in
     sound)
         python3 -m tests.soundTest
         ;;
+    mixer)
+        python3 -m tests.mixerBenchmark
+        ;;
+    whisper)
+        python3 -m tests.whisperBenchmark
+        ;;
+    alerts)
+        python3 -m tests.alertTest
+        ;;
+    networkmanager)
+        python3 -m tests.networkManagerTest
+        ;;
+    simulate)
+        python3 -m tests.simulationTest "${@:2}"
+        ;;
+    traces)
+        python3 -m tests.traceSummary "${@:2}"
+        ;;
+    server)
+        python3 -m tests.standInServer "${@:2}"
+        ;;
+    benchmark)
+        python3 -m tests.scanBenchmark "${@:2}"
+        ;;
+    session)
+        python3 -m tests.sessionSummary "${@:2}"
+        ;;
 esac
\ No newline at end of file
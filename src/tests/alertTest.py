@@ -0,0 +1,77 @@
+"""
+Sends a burst of upload errors through the AlertNotifier to a local SMTP stub and prints the digests it receives
+"""
+import os
+import socketserver
+import threading
+from pathlib import Path
+from time import sleep
+
+from helpers import Logging
+
+from helpers.AlertNotifier import AlertNotifier, SMTPTransport
+
+received = []
+
+"""
+Just enough of SMTP to accept a message and remember what was sent
+"""
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode("utf-8"))
+
+    def handle(self):
+        self.reply("220 localhost stub ready")
+        inData = False
+        message = []
+        for rawLine in self.rfile:
+            line = rawLine.decode("utf-8").rstrip("\r\n")
+            if inData:
+                if line == ".":
+                    inData = False
+                    received.append("\n".join(message))
+                    message = []
+                    self.reply("250 OK")
+                else:
+                    message.append(line)
+                continue
+
+            command = line.split(" ")[0].upper()
+            if command == "DATA":
+                inData = True
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+if __name__ == "__main__":
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+    logger = Logging()
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    transport = SMTPTransport(lambda: ("device@example.com", ""), host="127.0.0.1", port=port, useSSL=False)
+    notifier = AlertNotifier(transport, serial="TEST0001", window=2)
+    notifier.start()
+
+    # Forty failures of two distinct kinds should arrive as a single digest with two entries
+    for i in range(20):
+        notifier.report(500, f"Internal server error while handling scan {i}")
+        notifier.report(-1, "All connection attempts failed")
+    sleep(3)
+
+    # Repeats of errors we were already told about are suppressed
+    notifier.report(500, "Internal server error while handling scan 99")
+    notifier.stop()
+    server.shutdown()
+
+    print(f"Received {len(received)} digests")
+    for message in received:
+        print(message)
+        print("-" * 40)
@@ -0,0 +1,73 @@
+"""
+Measures how long a single mute toggle takes with each mixer backend compared to forking amixer for every toggle
+
+The amixer session applies toggles in the background, so a toggle is only counted once flushing the session confirms it was applied.
+The time to queue them is printed alongside but isn't comparable to the fork per toggle baseline
+
+Usage: python3 -m tests.mixerBenchmark [--iterations 50]
+"""
+import argparse
+import os
+import subprocess
+from pathlib import Path
+from time import perf_counter
+
+from helpers import Logging
+
+from drivers.sensors.AudioMixer import AudioMixer
+
+"""
+Time a number of mute/unmute toggles, any toggle that fails raises rather than being timed
+
+:param toggle: Function taking the new mute state and returning whether it succeeded
+:param flush: Function waiting until every toggle has been applied and returning whether they all succeeded
+:return: Tuple of the average milliseconds to queue a toggle and to apply one
+"""
+def timeToggles(toggle, iterations, flush=lambda: True):
+    start = perf_counter()
+    for i in range(iterations):
+        if not toggle(i % 2 == 0):
+            raise RuntimeError(f"toggle {i + 1} of {iterations} failed")
+    queued = perf_counter() - start
+
+    if not flush():
+        raise RuntimeError("the toggles weren't applied")
+    return queued / iterations * 1000, (perf_counter() - start) / iterations * 1000
+
+if __name__ == "__main__":
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+
+    # Options start with a dash so Logging doesn't take them as the log file
+    parser = argparse.ArgumentParser(description="Time mute toggles with each mixer backend")
+    parser.add_argument("--iterations", type=int, default=50, help="Toggles to average over for each backend")
+    iterations = parser.parse_args().iterations
+    logger = Logging()
+
+    for backend in ["fake", "amixer", "alsa"]:
+        mixer = AudioMixer(backend)
+        try:
+            if not mixer.open():
+                print(f"{backend}: unavailable")
+                continue
+            queued, applied = timeToggles(lambda muted: mixer.setMuted("Mic", muted), iterations, mixer.flush)
+            print(f"{backend}: {applied:.3f} ms per toggle applied ({queued:.3f} ms to queue)")
+        except Exception as e:
+            print(f"{backend}: failed ({e})")
+        finally:
+            mixer.close()
+
+    # Baseline of what every toggle used to cost
+    card = AudioMixer("amixer").findCard()
+    if card is not None:
+        with open(os.devnull, "wb") as devnull:
+            _, applied = timeToggles(
+                lambda muted: subprocess.call(
+                    ["/usr/bin/amixer", "-c", str(card), "sset", "Mic", "mute" if muted else "unmute"],
+                    stdout=devnull,
+                    stderr=subprocess.STDOUT,
+                ) == 0,
+                iterations,
+            )
+        print(f"amixer fork per toggle: {applied:.3f} ms per toggle applied")
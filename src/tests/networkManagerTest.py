@@ -0,0 +1,248 @@
+"""
+Runs the NetworkManagerClient against a mock NetworkManager on a private D-Bus daemon, checking the event loop stays responsive while it scans and connects
+"""
+import asyncio
+import os
+import subprocess
+from pathlib import Path
+from time import time
+
+from dbus_next import Variant
+from dbus_next.aio import MessageBus
+from dbus_next.errors import DBusError
+from dbus_next.service import PropertyAccess, ServiceInterface, dbus_property, method
+
+from helpers import Logging
+
+from helpers.NetworkManagerClient import NM_BUS_NAME, NM_OBJECT_PATH, NM_SETTINGS_PATH, NetworkManagerClient
+
+DEVICE_PATH = "/org/freedesktop/NetworkManager/Devices/1"
+
+# SSID, strength, flags, WPA flags, RSN flags
+ACCESS_POINTS = [
+    ("Binsight Lab", 82, 0x1, 0x0, 0x188),
+    ("OSU_Access", 64, 0x1, 0x0, 0x388),
+    ("OSU_Access", 40, 0x1, 0x0, 0x388),
+    ("Guest", 35, 0x0, 0x0, 0x0),
+    ("Home:Network", 20, 0x1, 0x188, 0x188),
+    ("", 15, 0x1, 0x0, 0x188),
+]
+
+"""
+Just enough of NetworkManager's D-Bus API for the client
+"""
+class MockNetworkManager(ServiceInterface):
+    def __init__(self, bus):
+        super().__init__("org.freedesktop.NetworkManager")
+        self.bus = bus
+        self.active = []
+        self.connections = []
+        self.created = 0
+
+    @method()
+    def GetDevices(self) -> "ao":
+        return [DEVICE_PATH]
+
+    @method()
+    async def AddAndActivateConnection(self, connection: "a{sa{sv}}", device: "o", specificObject: "o") -> "oo":
+        ssid = connection["connection"]["id"].value
+        index = self.created
+        self.created += 1
+        settingsPath = f"{NM_SETTINGS_PATH}/{index}"
+        activePath = f"/org/freedesktop/NetworkManager/ActiveConnection/{index}"
+        self.connections.append(MockConnection(self, settingsPath, connection))
+        self.bus.export(settingsPath, self.connections[-1])
+
+        # Only the lab network accepts our password, everything else fails after a short delay like a bad PSK
+        success = ssid == "Binsight Lab" and connection["802-11-wireless-security"]["psk"].value == "compost"
+        activeConnection = MockActiveConnection(ssid)
+        self.bus.export(activePath, activeConnection)
+        self.active.append(activePath)
+        asyncio.ensure_future(self._activate(activePath, activeConnection, success))
+        return [settingsPath, activePath]
+
+    async def _activate(self, activePath, activeConnection, success):
+        await activeConnection.finish(success, 1.5)
+        if not success:
+            self.active.remove(activePath)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ActiveConnections(self) -> "ao":
+        return self.active
+
+
+class MockDevice(ServiceInterface):
+    def __init__(self):
+        super().__init__("org.freedesktop.NetworkManager.Device")
+
+    @dbus_property(access=PropertyAccess.READ)
+    def DeviceType(self) -> "u":
+        return 2
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Interface(self) -> "s":
+        return "wlan0"
+
+
+class MockWireless(ServiceInterface):
+    def __init__(self):
+        super().__init__("org.freedesktop.NetworkManager.Device.Wireless")
+        self.lastScan = 1000
+        self.scanning = False
+
+    @method()
+    def RequestScan(self, options: "a{sv}"):
+        if self.scanning:
+            raise DBusError("org.freedesktop.NetworkManager.Device.NotAllowed", "Scanning not allowed while already scanning")
+        self.scanning = True
+        asyncio.get_event_loop().call_later(2, self._finishScan)
+
+    def _finishScan(self):
+        self.scanning = False
+        self.lastScan += 2000
+
+    @method()
+    def GetAllAccessPoints(self) -> "ao":
+        return [f"/org/freedesktop/NetworkManager/AccessPoint/{i}" for i in range(len(ACCESS_POINTS))]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def LastScan(self) -> "x":
+        return self.lastScan
+
+
+class MockAccessPoint(ServiceInterface):
+    def __init__(self, ssid, strength, flags, wpaFlags, rsnFlags):
+        super().__init__("org.freedesktop.NetworkManager.AccessPoint")
+        self.values = (ssid.encode("utf-8"), strength, flags, wpaFlags, rsnFlags)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Ssid(self) -> "ay":
+        return self.values[0]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Strength(self) -> "y":
+        return self.values[1]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "u":
+        return self.values[2]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def WpaFlags(self) -> "u":
+        return self.values[3]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def RsnFlags(self) -> "u":
+        return self.values[4]
+
+
+class MockActiveConnection(ServiceInterface):
+    def __init__(self, ssid):
+        super().__init__("org.freedesktop.NetworkManager.Connection.Active")
+        self.ssid = ssid
+        self.state = 1
+
+    async def finish(self, success, delay):
+        await asyncio.sleep(delay)
+        self.state = 2 if success else 4
+
+    @dbus_property(access=PropertyAccess.READ)
+    def State(self) -> "u":
+        return self.state
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Id(self) -> "s":
+        return self.ssid
+
+
+class MockSettings(ServiceInterface):
+    def __init__(self, networkManager):
+        super().__init__("org.freedesktop.NetworkManager.Settings")
+        self.networkManager = networkManager
+
+    @method()
+    def ListConnections(self) -> "ao":
+        return [connection.path for connection in self.networkManager.connections]
+
+
+class MockConnection(ServiceInterface):
+    def __init__(self, networkManager, path, settings):
+        super().__init__("org.freedesktop.NetworkManager.Settings.Connection")
+        self.networkManager = networkManager
+        self.path = path
+        self.settings = settings
+
+    @method()
+    def GetSettings(self) -> "a{sa{sv}}":
+        return {"connection": {"id": Variant("s", self.settings["connection"]["id"].value)}}
+
+    @method()
+    def Delete(self):
+        self.networkManager.connections.remove(self)
+        self.networkManager.bus.unexport(self.path)
+
+
+async def startMockNetworkManager(address):
+    bus = await MessageBus(bus_address=address).connect()
+    networkManager = MockNetworkManager(bus)
+    bus.export(NM_OBJECT_PATH, networkManager)
+    bus.export(DEVICE_PATH, MockDevice())
+    bus.export(DEVICE_PATH, MockWireless())
+    bus.export(NM_SETTINGS_PATH, MockSettings(networkManager))
+    for i, accessPoint in enumerate(ACCESS_POINTS):
+        bus.export(f"/org/freedesktop/NetworkManager/AccessPoint/{i}", MockAccessPoint(*accessPoint))
+    await bus.request_name(NM_BUS_NAME)
+    return bus
+
+
+"""
+Count how late a timer that should fire every 10ms is, this would be in the seconds if anything blocked the loop
+"""
+async def measureLag(results, stop):
+    worst = 0
+    while not stop.is_set():
+        start = time()
+        await asyncio.sleep(0.01)
+        worst = max(worst, time() - start - 0.01)
+    results["worst"] = worst
+
+
+async def runTest(address):
+    await startMockNetworkManager(address)
+    bus = await MessageBus(bus_address=address).connect()
+    client = NetworkManagerClient(bus)
+    print(f"Connected: {await client.connect()}")
+
+    lag = {}
+    stop = asyncio.Event()
+    lagTask = asyncio.ensure_future(measureLag(lag, stop))
+
+    start = time()
+    networks = await client.scan()
+    print(f"Scan took {time() - start:.2f}s and found {len(networks)} networks")
+    for ssid, network in networks.items():
+        print(f"\t{ssid}: {network}")
+
+    print(f"Wrong password: {await client.connectToNetwork('OSU_Access', 'hunter2')}")
+    print(f"Right password: {await client.connectToNetwork('Binsight Lab', 'compost')}")
+    print(f"Active connections: {await client.activeConnections()}")
+    print(f"Deleted: {await client.deleteConnection('Binsight Lab')}")
+
+    stop.set()
+    await lagTask
+    print(f"Worst event loop lag while scanning and connecting: {lag['worst'] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+    logger = Logging()
+
+    # A private bus so the mock never conflicts with the real NetworkManager
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"], stdout=subprocess.PIPE)
+    try:
+        address = daemon.stdout.readline().decode("utf-8").strip()
+        asyncio.get_event_loop().run_until_complete(runTest(address))
+    finally:
+        daemon.terminate()
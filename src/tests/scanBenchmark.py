@@ -0,0 +1,360 @@
+"""
+Benchmark the scan pipeline end to end against simulated sensors and a local mock of the scan API, reporting scan throughput,
+lid close to upload latency, the CPU time, peak memory and disk writes of every driver proccess and the bytes sent over the wire.
+The capture, image, point cloud and bundling code is also timed on its own so small regressions aren't lost in the noise of a full run
+
+Everything runs in a throwaway copy of the directory layout so the device's data, config.secret and traces are never touched.
+Disk writes are read from /proc and only count real storage, put the work directory on a tmpfs and they will read as 0
+
+Results are printed as JSON, pass the results of an earlier run as the baseline to exit with an error when anything got worse by more than the tolerance
+
+A session recorded on a bin with main.py --record can be replayed instead of the synthetic lid schedule to profile what happened in the field
+
+Usage: python3 -m tests.scanBenchmark [--scans 3] [--scan-interval 20] [--first-open 30] [--time-scale 1.0] [--iterations 10] [--data DATA_DIR]
+                                      [--session SESSION_LOG] [--speed 1.0] [--muted] [--latency 0.0] [--output results.json] [--baseline old.json]
+                                      [--tolerance 0.2] [--workdir DIR]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import wave
+from multiprocessing import Pipe
+from time import perf_counter, process_time, sleep, time
+
+from drivers.MainController import MainController
+from drivers.Simulation import Replay, SimulatedMLX90640, SimulatedRealsenseCam, Simulation, synthesizeSpeech
+from helpers import Logging
+from helpers.Metrics import readProcessStats
+from helpers.Sandbox import MockScanAPI, createSandbox
+from helpers.ScanBundle import ScanBundle, formatFileName
+from helpers.Tracing import percentile, summarizeTraces
+
+# Results compared against the baseline and whether bigger numbers are better, * matches every key present in both runs
+REGRESSION_CHECKS = (
+    ("scans.throughput_per_minute", True),
+    ("scans.latency.end_to_end.p50", False),
+    ("totals.cpu_seconds_per_scan", False),
+    ("totals.peak_rss_bytes", False),
+    ("totals.disk_write_bytes_per_scan", False),
+    ("wire.bytes_per_scan", False),
+    ("processes.*.cpu_seconds_per_scan", False),
+    ("components.*.p50", False),
+    ("components.*.cpu_mean", False),
+)
+
+
+"""
+Read the stats of the main proccess and every driver proccess
+"""
+def readAllStats(manager) -> dict:
+    stats = {"DriverManager": readProcessStats()}
+    for proccess in manager.proccessList:
+        stats[proccess.driver.moduleName] = readProcessStats(proccess.pid)
+    return {name: value for name, value in stats.items() if value is not None}
+
+
+"""
+Get the time the first scan started and the last one was acknowledged from the trace file
+
+:return: Tuple of (first span start, last upload end) as unix timestamps or None if nothing was uploaded
+"""
+def readScanWindow(path="../data/traces.jsonl"):
+    starts, uploads = [], []
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as traceFile:
+        for line in traceFile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            starts.append(record["b"] / 1000)
+            if record["s"] == "upload":
+                uploads.append((record["b"] + record["d"]) / 1000)
+    return (min(starts), max(uploads)) if len(uploads) > 0 else None
+
+
+"""
+Run the full detection loop until the mock API has acknowledged the requested number of scans
+
+:return: Tuple of (the running controller, the results of the run)
+"""
+def runScans(simulation: Simulation, api: MockScanAPI, scans: int, timeout: float):
+    controller = MainController(simulation)
+    manager = controller.manager
+    print(f"Controller ready after {simulation.elapsed():.1f}s")
+
+    # Resource usage is measured from here so the one off cost of starting every proccess isn't counted
+    before = readAllStats(manager)
+    deadline = time() + timeout
+    try:
+        while api.get("scans") < scans and time() < deadline:
+            controller.handleCallbacks()
+            sleep(0.001)
+    except KeyboardInterrupt:
+        pass
+    after = readAllStats(manager)
+
+    # The publisher records the upload span after the mock has already acknowledged the scan
+    completed = int(api.get("scans"))
+    spanDeadline = time() + 5
+    while summarizeTraces(("../data/traces.jsonl",))["end_to_end"]["count"] < completed and time() < spanDeadline:
+        sleep(0.1)
+
+    if completed < scans:
+        print(f"Only {completed} of {scans} scans were acknowledged before the timeout")
+    perScan = max(completed, 1)
+
+    processes = {}
+    for name, stats in after.items():
+        start = before.get(name, {})
+        cpuSeconds = stats["cpu_seconds"] - start.get("cpu_seconds", 0)
+        processes[name] = {
+            "cpu_seconds": round(cpuSeconds, 3),
+            "cpu_seconds_per_scan": round(cpuSeconds / perScan, 3),
+            "peak_rss_bytes": stats.get("peak_rss_bytes", stats["rss_bytes"]),
+            "disk_write_bytes": stats.get("disk_write_bytes", 0) - start.get("disk_write_bytes", 0),
+        }
+
+    window = readScanWindow()
+    duration = window[1] - window[0] if window is not None else 0
+    results = {
+        "scans": {
+            "completed": completed,
+            "duration_seconds": round(duration, 2),
+            "throughput_per_minute": round(completed / duration * 60, 3) if duration > 0 else 0.0,
+            "latency": {stage: {k: round(v, 3) for k, v in summary.items()} for stage, summary in summarizeTraces(("../data/traces.jsonl",)).items()},
+        },
+        "processes": processes,
+        "totals": {
+            "cpu_seconds_per_scan": round(sum(p["cpu_seconds"] for p in processes.values()) / perScan, 3),
+            # Pages shared between the forked proccesses are counted once per proccess so this overstates the real total
+            "peak_rss_bytes": sum(p["peak_rss_bytes"] for p in processes.values()),
+            "disk_write_bytes_per_scan": sum(p["disk_write_bytes"] for p in processes.values()) // perScan,
+        },
+        "wire": {
+            "requests": int(api.get("requests")),
+            "bytes_received": int(api.get("bytes_received")),
+            "bytes_sent": int(api.get("bytes_sent")),
+            "bytes_per_scan": int(api.get("bytes_received") + api.get("bytes_sent")) // perScan,
+        },
+    }
+    return controller, results
+
+
+"""
+Time a piece of code over a number of iterations
+
+:param run: Called once per iteration, anything it returns is passed to cleanup which isn't timed
+:return: Dictionary of the wall time percentiles and mean CPU time in seconds
+"""
+def timeComponent(iterations, run, cleanup=None) -> dict:
+    wallTimes, cpuTimes = [], []
+    for _ in range(iterations):
+        startWall, startCpu = perf_counter(), process_time()
+        result = run()
+        wallTimes.append(perf_counter() - startWall)
+        cpuTimes.append(process_time() - startCpu)
+        if cleanup is not None:
+            cleanup(result)
+
+    wallTimes.sort()
+    return {
+        "iterations": iterations,
+        "p50": round(percentile(wallTimes, 0.5), 4),
+        "p95": round(percentile(wallTimes, 0.95), 4),
+        "cpu_mean": round(sum(cpuTimes) / len(cpuTimes), 4),
+    }
+
+
+"""
+Set up a driver to be used outside of its proccess, its events are wrapped the same way the DriverManager does
+"""
+def prepareDriver(driver):
+    driver.createDataDict()
+    for name, event in driver.getEvents().items():
+        driver.events[name] = [event, None]
+    driver.initialize()
+    return driver
+
+
+"""
+Trigger a capture on a driver outside of its proccess and get the files it saved
+"""
+def captureOnce(driver, connection) -> dict:
+    driver.getEvent("CAPTURE").set()
+    driver.measure()
+    return connection.recv()
+
+
+def removeFiles(fileNames: dict):
+    for fileName in fileNames.values():
+        if os.path.exists(fileName):
+            os.remove(fileName)
+
+
+"""
+Time the capture, image, point cloud and bundling code on its own against simulated hardware that responds instantly
+
+:param manager: A running DriverManager to time collecting the scan packet against
+"""
+def benchmarkComponents(iterations, dataDir=None, seed=0, manager=None) -> dict:
+    simulation = Simulation(dataDir, timeScale=0, seed=seed)
+    components = {}
+
+    depthConnection, depthChild = Pipe()
+    depthCamera = prepareDriver(SimulatedRealsenseCam(simulation, depthChild))
+    components["depth_capture"] = timeComponent(iterations, lambda: captureOnce(depthCamera, depthConnection), removeFiles)
+
+    thermalConnection, thermalChild = Pipe()
+    thermalCamera = prepareDriver(SimulatedMLX90640(simulation, thermalChild))
+    components["thermal_capture"] = timeComponent(iterations, lambda: captureOnce(thermalCamera, thermalConnection), removeFiles)
+
+    # Bundle the same set of files every iteration, the size of each artifact is reported so growing outputs show up too
+    fileNames = {**captureOnce(depthCamera, depthConnection), **captureOnce(thermalCamera, thermalConnection)}
+    fileNames["voiceRecording"] = formatFileName("recording.wav")
+    with wave.open(fileNames["voiceRecording"], "wb") as waveFile:
+        waveFile.setnchannels(1)
+        waveFile.setsampwidth(2)
+        waveFile.setframerate(16000)
+        waveFile.writeframes(synthesizeSpeech(16000, simulation.rng("benchmark")).tobytes())
+    components["scan_bundle"] = timeComponent(
+        iterations,
+        lambda: ScanBundle.create("benchmark", fileNames, removeSources=False).path,
+        lambda path: os.remove(path),
+    )
+    components["artifact_bytes"] = {name: os.path.getsize(fileName) for name, fileName in fileNames.items()}
+    removeFiles(fileNames)
+    thermalCamera.kill()
+
+    if manager is not None:
+        components["collect_packet"] = timeComponent(iterations, lambda: (manager.getJSON(), manager.getMetricsSnapshot()))
+    return components
+
+
+"""
+Flatten nested results into dotted keys so they can be matched against the regression checks
+"""
+def flatten(results, prefix="") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+"""
+Compare results against a baseline run
+
+:param tolerance: The fraction a result can get worse by before it counts as a regression
+:return: List of descriptions of every regression
+"""
+def findRegressions(results, baseline, tolerance) -> list:
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for pattern, higherIsBetter in REGRESSION_CHECKS:
+        head, _, tail = pattern.partition("*")
+        for key in sorted(current):
+            if key not in previous or not key.startswith(head) or not key.endswith(tail):
+                continue
+            if (tail and "." in key[len(head):-len(tail)]) or (not tail and key != head):
+                continue
+
+            old, new = previous[key], current[key]
+            if old <= 0:
+                continue
+            change = (new - old) / old
+            if (higherIsBetter and change < -tolerance) or (not higherIsBetter and change > tolerance):
+                regressions.append(f"{key} went from {old} to {new} ({change:+.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scan pipeline against simulated sensors and a local mock API")
+    parser.add_argument("--scans", type=int, default=None, help="Scans to upload before stopping, 3 or every scan in the session being replayed")
+    parser.add_argument("--scan-interval", type=float, default=20, help="Seconds between simulated lid openings")
+    parser.add_argument("--first-open", type=float, default=30, help="Seconds before the lid first opens, long enough for the controller to finish its setup")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Multiplier on how long simulated hardware takes to respond")
+    parser.add_argument("--iterations", type=int, default=10, help="Iterations of each component benchmark, 0 skips them")
+    parser.add_argument("--data", default=None, help="Directory of recordings to replay instead of synthesized data")
+    parser.add_argument("--session", default=None, help="Session log recorded with main.py --record to replay instead of the lid schedule")
+    parser.add_argument("--speed", type=float, default=1.0, help="How many times faster than real time to replay the time between the session's scans")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--muted", action="store_true", help="Skip the voice prompts like a muted device")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock API waits before answering each request")
+    parser.add_argument("--output", default=None, help="File to write the JSON results to")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction a result can get worse by before it counts as a regression")
+    parser.add_argument("--workdir", default=None, help="Directory to run in, a temporary one is created and removed when not given")
+    args = parser.parse_args()
+
+    # Paths from the command line are relative to where we were called from, not the sandbox
+    dataDir = os.path.abspath(args.data) if args.data is not None else None
+    outputPath = os.path.abspath(args.output) if args.output is not None else None
+    baselinePath = os.path.abspath(args.baseline) if args.baseline is not None else None
+    sessionPath = os.path.abspath(args.session) if args.session is not None else None
+
+    logger = Logging()
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="scanBenchmark_")
+    api = MockScanAPI(latency=args.latency)
+    api.start()
+    os.chdir(createSandbox(workdir, api.port, args.muted))
+
+    if sessionPath is not None:
+        simulation = Replay(sessionPath, speed=args.speed, dataDir=dataDir, timeScale=args.time_scale, seed=args.seed)
+        sessionScans = simulation.scanCount(simulation.startTime + simulation.session.duration)
+        scans = args.scans if args.scans is not None else sessionScans
+        timeout = simulation.session.duration + scans * 60 + 120
+    else:
+        simulation = Simulation(
+            dataDir, scanInterval=args.scan_interval, lidOpenTime=2, firstOpen=args.first_open, timeScale=args.time_scale, seed=args.seed
+        )
+        scans = args.scans if args.scans is not None else 3
+        timeout = args.first_open + scans * args.scan_interval * 3 + 120
+    controller = None
+    try:
+        controller, results = runScans(simulation, api, scans, timeout)
+        results["config"] = {
+            "scans": scans,
+            "scan_interval": args.scan_interval,
+            "time_scale": args.time_scale,
+            "seed": args.seed,
+            "data": args.data,
+            "session": args.session,
+            "speed": args.speed,
+            "muted": args.muted,
+            "latency": args.latency,
+            "commit": controller.commitID,
+            "timestamp": int(time()),
+        }
+        if args.iterations > 0:
+            results["components"] = benchmarkComponents(args.iterations, dataDir, args.seed, controller.manager)
+    finally:
+        # Killing the drivers doesn't stop their proccesses, on the device Ctrl + C does that
+        if controller is not None:
+            controller.kill()
+            for proccess in controller.manager.proccessList:
+                proccess.terminate()
+        api.kill()
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if outputPath is not None:
+        with open(outputPath, "w") as outFile:
+            outFile.write(output + "\n")
+
+    if baselinePath is not None:
+        with open(baselinePath, "r") as baselineFile:
+            regressions = findRegressions(results, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of the baseline")
@@ -0,0 +1,50 @@
+"""
+Prints an overview of a session recorded with main.py --record, when each scan happened, what it weighed and the files it produced, followed by how often every event fired
+
+Usage: python3 -m tests.sessionSummary SESSION_LOG
+"""
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from helpers import Logging
+from helpers.SessionLog import SessionLog
+
+if __name__ == "__main__":
+    # Paths on the command line are relative to where we were called from
+    sessionPath = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 and not sys.argv[1].startswith("-") else None
+
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+    logger = Logging()
+
+    if sessionPath is None:
+        print("Usage: python3 -m tests.sessionSummary SESSION_LOG")
+        sys.exit(1)
+
+    session = SessionLog(sessionPath)
+    started = datetime.fromtimestamp(session.startTime()).strftime("%Y-%m-%d %H:%M:%S")
+    print(f"Session started {started} on commit {session.header.get('c', 'unknown')} and ran for {session.duration:.0f}s")
+
+    lidTimes, lidStates = session.timeline("LidSwitch", "Lid_State")
+    closes = [seconds for i, seconds in enumerate(lidTimes) if i > 0 and lidStates[i - 1] and not lidStates[i]]
+    print(f"The lid was closed {len(closes)} times and {len(session.artifacts)} scans were queued for upload\n")
+
+    print(f"{'Scan':<6}{'Time (s)':>10}{'Weight (g)':>12}{'Delta (g)':>12}{'Files':>8}{'Bytes':>12}{'Kept':>6}")
+    for scan, (seconds, uid, files) in enumerate(session.artifacts):
+        # The weight the scan was uploaded with is only polled after its files are recorded
+        weights = session.valuesAt("NAU7802", seconds + session.header.get("i", 0.1))
+        weight, delta = weights.get("weight", 0.0), weights.get("weight_delta", 0.0)
+        totalBytes = sum(size for _, size in files.values())
+        kept = sum(session.resolveArtifact(fileName) is not None for fileName, _ in files.values())
+        print(f"{scan + 1:<6}{seconds:>10.1f}{weight:>12.1f}{delta:>12.1f}{len(files):>8}{totalBytes:>12}{kept:>6}")
+
+    counts = {}
+    for _, module, name, isSet in session.events:
+        if isSet:
+            counts[f"{module}.{name}"] = counts.get(f"{module}.{name}", 0) + 1
+    print(f"\n{'Event':<40}{'Times set':>10}")
+    for event, count in sorted(counts.items()):
+        print(f"{event:<40}{count:>10}")
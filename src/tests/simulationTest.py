@@ -0,0 +1,86 @@
+"""
+Run every sensor driver against simulated hardware and collect a few scans the same way the MainController does, no devices are needed
+
+Usage: python3 -m tests.simulationTest [--data DATA_DIR] [--scans 3] [--time-scale 1.0]
+"""
+import argparse
+import os
+from multiprocessing import Pipe, Queue
+from pathlib import Path
+from time import sleep, time
+
+from drivers.DriverManager import DriverManager
+from drivers.Simulation import (
+    SimulatedBME688,
+    SimulatedLEDDriver,
+    SimulatedLidSwitch,
+    SimulatedMLX90640,
+    SimulatedNAU7802,
+    SimulatedRealsenseCam,
+    SimulatedSoundController,
+    Simulation,
+)
+from helpers import Logging
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default=None, help="Directory of recordings to replay")
+    parser.add_argument("--scans", type=int, default=3)
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    simulation = Simulation(args.data, scanInterval=15, lidOpenTime=2, firstOpen=5, timeScale=args.time_scale)
+
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+
+    # Create our data folder if it doesn't exist already
+    if not os.path.exists("../data/"):
+        os.mkdir("../data/")
+
+    logger = Logging()
+    soundParent, soundChild = Pipe()
+    realsenseParent, realsenseChild = Pipe()
+    mlxParent, mlxChild = Pipe()
+    manager = DriverManager(
+        SimulatedLEDDriver(simulation, False, commandQueue=Queue()),
+        SimulatedNAU7802(simulation),
+        SimulatedBME688(simulation),
+        SimulatedMLX90640(simulation, mlxChild),
+        SimulatedLidSwitch(simulation),
+        SimulatedRealsenseCam(simulation, realsenseChild),
+        SimulatedSoundController(simulation, soundChild, muted=True),
+        metricsPort=None,
+    )
+    print(f"All drivers initialized: {manager.allProcsInitialized}")
+
+    manager.setEvent("NAU7802.TARE")
+    while manager.getEvent("NAU7802.TARE"):
+        sleep(0.1)
+    manager.clearAllEvents()
+
+    try:
+        for scan in range(args.scans):
+            print(f"Waiting for the lid to close, scan {scan + 1} of {args.scans}...")
+            while not manager.getEvent("LidSwitch.LID_CLOSED"):
+                sleep(0.05)
+            manager.clearEvent("LidSwitch.LID_CLOSED")
+
+            start = time()
+            for event in ("SoundController.RECORD", "Realsense.CAPTURE", "MLX90640.CAPTURE"):
+                manager.setEvent(event)
+            while manager.getEvent("Realsense.CAPTURE") or manager.getEvent("MLX90640.CAPTURE") or manager.getEvent("SoundController.RECORD"):
+                sleep(0.05)
+
+            fileNames = {**soundParent.recv(), **realsenseParent.recv(), **mlxParent.recv()}
+            print(f"Captured in {time() - start:.2f}s, expected {simulation.weight():.1f}g and weighed {manager.getData()['NAU7802']['data']['weight'].value:.1f}g")
+            for name, fileName in fileNames.items():
+                print(f"\t{name}: {fileName} ({os.path.getsize(fileName)} bytes)")
+    except KeyboardInterrupt:
+        pass
+
+    # Killing the drivers doesn't stop their proccesses, on the device Ctrl + C does that
+    manager.kill()
+    for proccess in manager.proccessList:
+        proccess.terminate()
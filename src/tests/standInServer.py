@@ -0,0 +1,116 @@
+"""
+Local stand in for the scan API so uploads and backlog draining can be tested without the real server
+
+Requires fastapi, uvicorn and python-multipart which are not installed on the device by default
+
+Usage: python3 -m tests.standInServer [--port 8000] [--latency 0.5] [--fail-rate 0.1]
+Then point FASTAPI_CREDS in config.secret at {"endpoint": "http://127.0.0.1", "port": 8000}
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+from pathlib import Path
+
+import uvicorn
+from fastapi import FastAPI, Header, Request
+
+app = FastAPI()
+settings = {"latency": 0.0, "failRate": 0.0, "outputDir": None, "apiKey": None}
+stats = {"requests": 0, "scans": 0, "bytes": 0}
+
+"""
+Check the token sent by the device if we were given one to expect
+"""
+def isAuthorized(token):
+    return settings["apiKey"] is None or token == settings["apiKey"]
+
+"""
+Save an uploaded part to the output directory and return how many bytes it was
+"""
+async def saveUpload(uid, upload):
+    contents = await upload.read()
+    scanDir = os.path.join(settings["outputDir"], uid)
+    os.makedirs(scanDir, exist_ok=True)
+    with open(os.path.join(scanDir, os.path.basename(upload.filename or "upload")), "wb") as outFile:
+        outFile.write(contents)
+    return len(contents)
+
+@app.get("/api/health/heartbeat")
+def heartbeat():
+    return {"is_alive": True}
+
+@app.get("/api/health/secure_heartbeat")
+def secureHeartbeat(token: str = Header(None)):
+    return {"is_alive": isAuthorized(token)}
+
+@app.post("/api/scan")
+async def scan(request: Request, token: str = Header(None)):
+    await asyncio.sleep(settings["latency"])
+    stats["requests"] += 1
+    if not isAuthorized(token):
+        return {"status": False, "detail": "Invalid token"}
+
+    form = await request.form()
+    payload = json.loads(form["data"])
+    uid = payload.get("bundle") or payload.get("colorImage") or "scan"
+    for _, upload in form.multi_items():
+        if hasattr(upload, "filename"):
+            stats["bytes"] += await saveUpload(uid, upload)
+
+    stats["scans"] += 1
+    print(f"Received scan, {stats['scans']} scans in {stats['requests']} requests totalling {stats['bytes']} bytes")
+    return {"status": True}
+
+@app.post("/api/scan/batch")
+async def scanBatch(request: Request, token: str = Header(None)):
+    await asyncio.sleep(settings["latency"])
+    stats["requests"] += 1
+    form = await request.form()
+    scans = json.loads(form["data"])["scans"]
+
+    # Parts are named uid:part so they can be matched back up with their scan
+    uploads = {}
+    for name, upload in form.multi_items():
+        if hasattr(upload, "filename") and ":" in name:
+            uploads.setdefault(name.split(":", 1)[0], []).append(upload)
+
+    results = {}
+    for payload in scans:
+        uid = payload["uid"]
+        if not isAuthorized(token):
+            results[uid] = {"status": False, "detail": "Invalid token"}
+        elif random.random() < settings["failRate"]:
+            results[uid] = {"status": False, "detail": "Simulated failure"}
+        else:
+            for upload in uploads.get(uid, []):
+                stats["bytes"] += await saveUpload(uid, upload)
+            stats["scans"] += 1
+            results[uid] = {"status": True}
+
+    print(f"Received batch of {len(scans)}, {stats['scans']} scans in {stats['requests']} requests totalling {stats['bytes']} bytes")
+    return {"status": all(result["status"] for result in results.values()), "results": results}
+
+if __name__ == "__main__":
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+
+    parser = argparse.ArgumentParser(description="Run a local stand in for the scan upload API")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request to simulate a slow link")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of scans in a batch to reject to test partial acknowledgements")
+    parser.add_argument("--api-key", type=str, default=None, help="Token to require from the device, any token is accepted by default")
+    parser.add_argument("--output", type=str, default=None, help="Directory to save uploads to, defaults to a temporary directory")
+    args = parser.parse_args()
+
+    settings["latency"] = args.latency
+    settings["failRate"] = args.fail_rate
+    settings["apiKey"] = args.api_key
+    settings["outputDir"] = args.output if args.output is not None else tempfile.mkdtemp(prefix="scans_")
+    print(f"Saving uploads to {settings['outputDir']}")
+
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,26 @@
+"""
+Prints the p50 and p95 latency of each stage of a scan from the trace records saved on the device
+"""
+import os
+import sys
+from pathlib import Path
+
+from helpers import Logging
+
+from helpers.Tracing import STAGES, summarizeTraces
+
+if __name__ == "__main__":
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+    logger = Logging()
+
+    # Trace files copied off of a device can be passed in instead
+    paths = sys.argv[1:] if len(sys.argv) > 1 else ("../data/traces.jsonl.1", "../data/traces.jsonl")
+    summary = summarizeTraces(paths)
+
+    print(f"{'Stage':<16}{'Count':>8}{'p50 (s)':>12}{'p95 (s)':>12}")
+    for stage in (*STAGES, "end_to_end"):
+        if stage in summary:
+            stats = summary[stage]
+            print(f"{stage:<16}{stats['count']:>8}{stats['p50']:>12.3f}{stats['p95']:>12.3f}")
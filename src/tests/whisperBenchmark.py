@@ -0,0 +1,156 @@
+"""
+Benchmarks the available whisper models on this device using our own prompt recordings and selects the fastest one that is accurate enough
+
+Usage: python3 -m tests.whisperBenchmark [--models small.en,base.en-q5_0] [--threads 2,4] [--max-wer 0.15] [--references refs.json]
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import subprocess
+import tempfile
+import wave
+from pathlib import Path
+from time import time
+
+import numpy as np
+from scipy.signal import resample_poly
+
+from helpers import Logging
+
+from drivers.sensors.AudioTranscriber import TRANSCRIBER_CONFIG_FILE
+
+"""
+Convert a prompt to the 16kHz mono wav whisper expects and return its duration in seconds
+"""
+def convertTo16k(inputFile, outputFile):
+    with wave.open(inputFile, "rb") as wf:
+        channels = wf.getnchannels()
+        rate = wf.getframerate()
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+
+    mono = samples.reshape(-1, channels).mean(axis=1)
+    divisor = np.gcd(16000, rate)
+    resampled = resample_poly(mono, 16000 // divisor, rate // divisor)
+
+    with wave.open(outputFile, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(16000)
+        wf.writeframes(np.clip(resampled, -32768, 32767).astype(np.int16).tobytes())
+    return len(resampled) / 16000
+
+"""
+Transcribe a file with the given model and thread count returning the text and the time it took
+"""
+def transcribe(model, threads, inputFile):
+    start = time()
+    process = subprocess.run(
+        ["../whisper.cpp/main", "-m", f"../whisper.cpp/models/ggml-{model}.bin", "-t", str(threads), "-f", inputFile, "-np", "-nt"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    text = process.stdout.decode("utf-8").replace("[BLANK_AUDIO]", "").strip()
+    return text, time() - start
+
+"""
+Lowercase and strip punctuation so only the words are compared
+"""
+def normalize(text):
+    return re.sub(r"[^a-z0-9' ]", " ", text.lower()).split()
+
+"""
+Word error rate of a hypothesis against a reference using the edit distance between the word lists
+"""
+def wordErrorRate(reference, hypothesis):
+    ref = normalize(reference)
+    hyp = normalize(hypothesis)
+    if len(ref) == 0:
+        return 0.0 if len(hyp) == 0 else 1.0
+
+    distances = list(range(len(hyp) + 1))
+    for i in range(1, len(ref) + 1):
+        previous, distances[0] = distances[0], i
+        for j in range(1, len(hyp) + 1):
+            current = distances[j]
+            distances[j] = min(distances[j] + 1, distances[j - 1] + 1, previous + (ref[i - 1] != hyp[j - 1]))
+            previous = current
+    return distances[len(hyp)] / len(ref)
+
+if __name__ == "__main__":
+    # Change our current working directory to this file so our relative paths still work no matter where this file was called from
+    path = Path(__file__)
+    os.chdir(path.parent.absolute().parent.absolute())
+
+    cores = os.cpu_count() or 4
+    parser = argparse.ArgumentParser(description="Select the fastest whisper model that meets a word error rate threshold")
+    parser.add_argument("--models", type=str, default=None, help="Comma separated list of models, defaults to every model that has been downloaded")
+    parser.add_argument("--threads", type=str, default=",".join(str(t) for t in sorted({max(1, cores // 2), cores})), help="Comma separated list of thread counts to try")
+    parser.add_argument("--max-wer", type=float, default=0.15, help="Highest acceptable word error rate")
+    parser.add_argument("--references", type=str, default=None, help="JSON file mapping prompt file names to their expected text, defaults to the output of the largest model")
+    parser.add_argument("--media", type=str, default="../media", help="Directory of .wav recordings to benchmark against")
+    parser.add_argument("--output", type=str, default=None, help="File to write the full results to as JSON")
+    parser.add_argument("--dry-run", action="store_true", help="Don't save the selected model")
+    args = parser.parse_args()
+
+    logger = Logging()
+
+    if args.models is not None:
+        models = args.models.split(",")
+    else:
+        models = [os.path.basename(f)[len("ggml-"):-len(".bin")] for f in glob.glob("../whisper.cpp/models/ggml-*.bin")]
+
+    # Largest model first so it can act as the reference when none are given
+    models.sort(key=lambda model: os.path.getsize(f"../whisper.cpp/models/ggml-{model}.bin"), reverse=True)
+    threadCounts = [int(t) for t in args.threads.split(",")]
+
+    references = {}
+    if args.references is not None:
+        with open(args.references, "r") as inFile:
+            references = json.load(inFile)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tempDir:
+        clips = {}
+        for clip in sorted(glob.glob(os.path.join(args.media, "*.wav"))):
+            convertedFile = os.path.join(tempDir, os.path.basename(clip))
+            clips[os.path.basename(clip)] = (convertedFile, convertTo16k(clip, convertedFile))
+
+        for model in models:
+            for threads in threadCounts:
+                totalAudio = 0
+                totalTime = 0
+                errors = []
+                for name, (convertedFile, duration) in clips.items():
+                    text, elapsed = transcribe(model, threads, convertedFile)
+                    if name not in references:
+                        references[name] = text
+                    errors.append(wordErrorRate(references[name], text))
+                    totalAudio += duration
+                    totalTime += elapsed
+
+                result = {
+                    "model": model,
+                    "threads": threads,
+                    "rtf": totalTime / totalAudio,
+                    "wer": float(np.mean(errors)),
+                }
+                results.append(result)
+                print(f"{model:>20} threads={threads:<3} rtf={result['rtf']:.3f} wer={result['wer']:.3f}")
+
+    acceptable = [result for result in results if result["wer"] <= args.max_wer]
+    selected = min(acceptable, key=lambda result: result["rtf"]) if len(acceptable) > 0 else None
+
+    if args.output is not None:
+        with open(args.output, "w") as outFile:
+            json.dump({"results": results, "selected": selected, "references": references}, outFile, indent=4)
+
+    if selected is None:
+        print(f"No model met the word error rate threshold of {args.max_wer}")
+    else:
+        print(f"Selected {selected['model']} with {selected['threads']} threads")
+        if not args.dry_run:
+            os.makedirs(os.path.dirname(TRANSCRIBER_CONFIG_FILE), exist_ok=True)
+            with open(TRANSCRIBER_CONFIG_FILE, "w") as outFile:
+                json.dump({"model": selected["model"], "threads": selected["threads"]}, outFile)